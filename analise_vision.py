@@ -0,0 +1,363 @@
+"""
+Motor de Análise com Vision API
+Envia um único AnnotateImageRequest com todas as features pedidas
+e converte a resposta combinada no dicionário 'resultados' da aplicação
+O módulo google.cloud.vision só é importado quando o primeiro pedido é construído
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, InvalidStateError, TimeoutError
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Features disponíveis (nome interno -> nome do tipo de feature da Vision API)
+FEATURES_VISION = {
+    'labels': 'LABEL_DETECTION',
+    'texto': 'TEXT_DETECTION',
+    'rostos': 'FACE_DETECTION',
+    'safe_search': 'SAFE_SEARCH_DETECTION',
+    'cores': 'IMAGE_PROPERTIES',
+}
+
+# Por omissão pedem-se todas as features
+FEATURES_PADRAO = tuple(FEATURES_VISION)
+
+# Limite de imagens por batch_annotate_images imposto pela Vision API
+LIMITE_LOTE_API = 16
+
+# Configuração do agrupamento de pedidos (micro-batching)
+LOTE_TAMANHO_MAX = int(os.environ.get('VISION_LOTE_TAMANHO_MAX', LIMITE_LOTE_API))
+LOTE_ESPERA_MAX = float(os.environ.get('VISION_LOTE_ESPERA_MS', 10)) / 1000
+LOTE_PEDIDOS_CONCORRENTES = int(os.environ.get('VISION_LOTE_PEDIDOS_CONCORRENTES', 4))
+
+# Bytes de imagem por lote: o pedido à Vision API tem um limite de tamanho (~10 MB
+# em JSON, com as imagens em base64, +33%); uma imagem maior que isto vai sozinha
+LOTE_BYTES_MAX = int(os.environ.get('VISION_LOTE_KB_MAX', 7 * 1024)) * 1024
+
+# Espera máxima pela resposta de um lote antes de enviar a imagem num pedido próprio
+LOTE_TIMEOUT = float(os.environ.get('VISION_LOTE_TIMEOUT_S', 60))
+
+
+def construir_pedido(imagem, features=FEATURES_PADRAO):
+    """
+    Construir o AnnotateImageRequest com todas as features pedidas
+    'imagem' pode ser os bytes da imagem ou um vision.Image já construído
+    """
+    from google.cloud import vision
+
+    if isinstance(imagem, (bytes, bytearray)):
+        imagem = vision.Image(content=imagem)
+
+    return vision.AnnotateImageRequest(
+        image=imagem,
+        features=[vision.Feature(type_=vision.Feature.Type[FEATURES_VISION[nome]]) for nome in features]
+    )
+
+
+def analisar_imagem(vision_client, imagem, features=FEATURES_PADRAO, completo=False):
+    """
+    Analisar uma imagem com uma única chamada à Vision API
+    Retorna (resultados, tempos) onde 'tempos' tem a duração em ms
+    do pedido e da conversão de cada feature
+    """
+    pedido = construir_pedido(imagem, features)
+
+    inicio = time.perf_counter()
+    response = vision_client.annotate_image(request=pedido)
+    tempo_pedido = (time.perf_counter() - inicio) * 1000
+
+    resultados, tempos = converter_resposta(response, features, completo)
+    tempos['pedido'] = tempo_pedido
+    _registar_tempos(features, tempos)
+    return resultados, tempos
+
+
+def analisar_variantes(vision_client, variantes, completo=False):
+    """
+    Analisar versões da mesma imagem com features diferentes num só batch_annotate_images
+    (ex: resolução menor para labels/rostos e maior para OCR, ver normalizacao.py)
+    'variantes' é uma lista de (imagem, features); retorna (resultados combinados, tempos)
+    """
+    if len(variantes) == 1:
+        imagem, features = variantes[0]
+        return analisar_imagem(vision_client, imagem, features, completo)
+
+    inicio = time.perf_counter()
+    response = vision_client.batch_annotate_images(
+        requests=[construir_pedido(imagem, features) for imagem, features in variantes]
+    )
+    tempo_pedido = (time.perf_counter() - inicio) * 1000
+
+    return _combinar_respostas(variantes, response.responses, tempo_pedido, completo)
+
+
+def _combinar_respostas(variantes, respostas, tempo_pedido, completo):
+    """Juntar os resultados das respostas de cada variante (as features não se repetem)"""
+    resultados = {}
+    tempos = {}
+    for (_, features), response in zip(variantes, respostas):
+        resultados_variante, tempos_variante = converter_resposta(response, features, completo)
+        resultados.update(resultados_variante)
+        tempos.update(tempos_variante)
+
+    tempos['pedido'] = tempo_pedido
+    _registar_tempos([nome for _, features in variantes for nome in features], tempos)
+    return resultados, tempos
+
+
+def converter_resposta(response, features=FEATURES_PADRAO, completo=False):
+    """
+    Converter um AnnotateImageResponse no dicionário 'resultados'
+    Com completo=True inclui os campos extra guardados pela Cloud Function
+    (mid dos labels, fragmentos de texto, raiva/tristeza dos rostos)
+    """
+    if response.error.message:
+        raise RuntimeError(f"Vision API devolveu erro: {response.error.message}")
+
+    resultados = {}
+    tempos = {}
+
+    for nome in features:
+        inicio = time.perf_counter()
+        _CONVERSORES[nome](response, resultados, completo)
+        tempos[nome] = (time.perf_counter() - inicio) * 1000
+
+    return resultados, tempos
+
+
+def _registar_tempos(features, tempos):
+    """Registar no log a duração do pedido e da conversão de cada feature"""
+    logger.info(
+        f"Vision API: {len(features)} features num pedido ({tempos['pedido']:.0f} ms) - " +
+        ", ".join(f"{nome}: {tempos[nome]:.1f} ms" for nome in features)
+    )
+
+
+# ============================================================================
+# AGRUPAMENTO DE PEDIDOS ENTRE REQUESTS (MICRO-BATCHING)
+# ============================================================================
+
+class AgrupadorVision:
+    """
+    Junta pedidos concorrentes de várias threads num único batch_annotate_images
+    Cada chamada a analisar() espera no máximo 'espera_max' segundos por outras
+    imagens antes do lote ser enviado, e recebe de volta os seus próprios resultados
+    Um lote fecha ao atingir 'tamanho_max' imagens ou 'bytes_max' bytes de imagem
+    """
+
+    def __init__(self, vision_client, tamanho_max=LOTE_TAMANHO_MAX, espera_max=LOTE_ESPERA_MAX,
+                 pedidos_concorrentes=LOTE_PEDIDOS_CONCORRENTES, bytes_max=LOTE_BYTES_MAX, timeout=LOTE_TIMEOUT):
+        self.vision_client = vision_client
+        self.tamanho_max = max(1, min(tamanho_max, LIMITE_LOTE_API))
+        self.bytes_max = bytes_max
+        self.timeout = timeout
+        self.espera_max = espera_max
+        self.pedidos_concorrentes = pedidos_concorrentes
+        self.total_lotes = 0
+        self.total_imagens = 0
+
+        self._fila = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._executor = None
+
+    def analisar(self, imagem, features=FEATURES_PADRAO, completo=False):
+        """Analisar uma imagem através do próximo lote; retorna (resultados, tempos)"""
+        return self.analisar_variantes([(imagem, features)], completo)
+
+    def analisar_variantes(self, variantes, completo=False):
+        """
+        Como analisar_variantes(): cada (imagem, features) entra no lote como um pedido
+        e os resultados são combinados; retorna (resultados, tempos)
+        Sem resposta do lote em 'timeout' segundos (thread parada ou lote preso), as
+        variantes são enviadas diretamente, num pedido só delas
+        """
+        futuros = [Future() for _ in variantes]
+        self._iniciar()
+
+        inicio = time.perf_counter()
+        limite = time.monotonic() + self.timeout
+        for (imagem, features), futuro in zip(variantes, futuros):
+            tamanho = len(imagem) if isinstance(imagem, (bytes, bytearray)) else 0
+            self._fila.put((construir_pedido(imagem, features), futuro, tamanho))
+        try:
+            respostas = [futuro.result(timeout=max(0, limite - time.monotonic())) for futuro in futuros]
+        except TimeoutError:
+            logger.warning(f"Lote Vision sem resposta em {self.timeout:g} s, a enviar a imagem diretamente")
+            for futuro in futuros:
+                futuro.cancel()
+            return analisar_variantes(self.vision_client, variantes, completo)
+        tempo_pedido = (time.perf_counter() - inicio) * 1000
+
+        return _combinar_respostas(variantes, respostas, tempo_pedido, completo)
+
+    def estatisticas(self):
+        """Número de lotes enviados, imagens analisadas e tamanho médio dos lotes"""
+        return {
+            'lotes': self.total_lotes,
+            'imagens': self.total_imagens,
+            'tamanho_medio': self.total_imagens / self.total_lotes if self.total_lotes else 0
+        }
+
+    def _iniciar(self):
+        """Arrancar a thread de agrupamento (só na primeira chamada, já depois do fork do gunicorn)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.pedidos_concorrentes,
+                    thread_name_prefix='vision-lote'
+                )
+                self._thread = threading.Thread(target=self._ciclo, name='vision-agrupador', daemon=True)
+                self._thread.start()
+
+    def _ciclo(self):
+        """
+        Formar lotes: esperar pelo primeiro pedido e juntar os que chegarem na janela
+        Um pedido que faria o lote passar de bytes_max fecha o lote e abre o seguinte
+        """
+        seguinte = None
+        while True:
+            primeiro = seguinte or self._fila.get()
+            seguinte = None
+            lote = [primeiro]
+            total_bytes = primeiro[2]
+            limite = time.monotonic() + self.espera_max
+
+            while len(lote) < self.tamanho_max:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                try:
+                    entrada = self._fila.get(timeout=restante)
+                except queue.Empty:
+                    break
+                if total_bytes + entrada[2] > self.bytes_max:
+                    seguinte = entrada
+                    break
+                lote.append(entrada)
+                total_bytes += entrada[2]
+
+            self._executor.submit(self._enviar, lote)
+
+    def _enviar(self, lote):
+        """Enviar um lote e entregar a cada chamador a sua resposta"""
+        # Os pedidos de chamadores que desistiram por timeout (futuro cancelado) já foram
+        # enviados diretamente; os restantes ficam 'em curso' e deixam de poder ser cancelados
+        lote = [entrada for entrada in lote if entrada[1].set_running_or_notify_cancel()]
+        if not lote:
+            return
+        try:
+            response = self.vision_client.batch_annotate_images(
+                requests=[pedido for pedido, _, _ in lote]
+            )
+            with self._lock:
+                self.total_lotes += 1
+                self.total_imagens += len(lote)
+            logger.info(f"Lote Vision enviado com {len(lote)} imagem(ns)")
+
+            for (_, futuro, _), resposta in zip(lote, response.responses):
+                _entregar(futuro.set_result, resposta)
+        except Exception as e:
+            logger.error(f"Erro no lote Vision: {str(e)}")
+            for _, futuro, _ in lote:
+                _entregar(futuro.set_exception, e)
+
+
+def _entregar(definir, valor):
+    """Entregar o resultado ao chamador (que pode já ter desistido por timeout)"""
+    try:
+        definir(valor)
+    except InvalidStateError:
+        pass
+
+
+# ============================================================================
+# CONVERSORES POR FEATURE
+# ============================================================================
+
+def _converter_labels(response, resultados, completo):
+    """Label Detection (Detecção de Objetos/Rótulos)"""
+    resultados['labels'] = []
+    for label in response.label_annotations:
+        item = {'descricao': label.description, 'score': float(label.score)}
+        if completo:
+            item['mid'] = label.mid
+        resultados['labels'].append(item)
+
+
+def _converter_texto(response, resultados, completo):
+    """Text Detection (OCR) - o primeiro elemento é o texto completo"""
+    if response.text_annotations:
+        resultados['texto_completo'] = response.text_annotations[0].description
+    else:
+        resultados['texto_completo'] = ""
+
+    resultados['textos'] = []
+    if completo:
+        resultados['textos'] = [
+            {
+                'texto': text.description,
+                'confianca': float(text.confidence) if text.confidence else 0
+            }
+            for text in response.text_annotations[1:] if text.description.strip()
+        ]
+
+
+def _converter_rostos(response, resultados, completo):
+    """Face Detection (Detecção de Rostos)"""
+    resultados['rostos'] = []
+    for face in response.face_annotations:
+        item = {
+            'confianca': float(face.detection_confidence),
+            'alegria': int(face.joy_likelihood),
+            'surpresa': int(face.surprise_likelihood)
+        }
+        if completo:
+            item['raiva'] = int(face.anger_likelihood)
+            item['tristeza'] = int(face.sorrow_likelihood)
+        resultados['rostos'].append(item)
+
+
+def _converter_safe_search(response, resultados, completo):
+    """Safe Search Detection (Classificação de conteúdo seguro)"""
+    resultados['safe_search'] = {
+        'adulto': str(response.safe_search_annotation.adult),
+        'violencia': str(response.safe_search_annotation.violence),
+        'spoof': str(response.safe_search_annotation.spoof),
+        'medical': str(response.safe_search_annotation.medical),
+        'racy': str(response.safe_search_annotation.racy)
+    }
+
+
+def _converter_cores(response, resultados, completo):
+    """Image Properties (cores dominantes)"""
+    try:
+        resultados['cores_dominantes'] = [
+            {
+                'cor_rgb': {
+                    'red': int(color.color.red),
+                    'green': int(color.color.green),
+                    'blue': int(color.color.blue)
+                },
+                'score': float(color.score),
+                'pixel_fraction': float(color.pixel_fraction)
+            }
+            for color in response.image_properties_annotation.dominant_colors.colors
+        ]
+    except Exception as e:
+        logger.warning(f"Erro ao processar cores: {e}")
+        resultados['cores_dominantes'] = []
+
+
+_CONVERSORES = {
+    'labels': _converter_labels,
+    'texto': _converter_texto,
+    'rostos': _converter_rostos,
+    'safe_search': _converter_safe_search,
+    'cores': _converter_cores,
+}
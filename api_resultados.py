@@ -2,12 +2,15 @@
 API para Consultar Resultados das Análises no Firestore
 """
 from flask import Flask, jsonify, request
-from google.cloud import firestore
 from datetime import datetime
 import logging
 
+import paginacao
+from cache_documentos import CacheDocumentos
+import clientes
+
 app = Flask(__name__)
-db = firestore.Client()
+db = clientes.cliente('firestore')
 
 # Logging
 logging.basicConfig(level=logging.INFO)
@@ -15,6 +18,21 @@ logger = logging.getLogger(__name__)
 
 PROJECT_ID = "projectcloud-484416"
 
+# Cache dos documentos consultados pelos endpoints /resultados/<doc_id>/...
+# (os deletes são feitos noutro processo: uma análise apagada deixa de ser servida ao fim de CACHE_DOCS_TTL)
+cache_documentos = CacheDocumentos()
+
+
+def _ler_documento(doc_id):
+    """Ler uma análise do Firestore (None se não existir)"""
+    doc = db.collection('analises_imagens').document(doc_id).get()
+    return doc.to_dict() if doc.exists else None
+
+
+def _obter_documento(doc_id):
+    """Ler uma análise através da cache de documentos"""
+    return cache_documentos.obter(doc_id, _ler_documento)
+
 
 @app.route('/resultados/<doc_id>', methods=['GET'])
 def obter_resultado(doc_id):
@@ -22,12 +40,11 @@ def obter_resultado(doc_id):
     try:
         logger.info(f"Consultando resultado: {doc_id}")
         
-        doc = db.collection('analises_imagens').document(doc_id).get()
+        resultado = _obter_documento(doc_id)
         
-        if not doc.exists:
+        if resultado is None:
             return jsonify({'erro': 'Documento não encontrado'}), 404
         
-        resultado = doc.to_dict()
         resultado['id'] = doc_id
         
         # Converter timestamps para string
@@ -47,27 +64,32 @@ def listar_resultados():
     Listar todas as análises realizadas
     Parâmetros opcionais:
     - limit: número de resultados (padrão: 20, máximo: 100)
-    - offset: número de resultados a pular (para paginação)
+    - cursor: token 'proximo_cursor' da página anterior (paginação)
+    - offset: número de resultados a pular (obsoleto, usar cursor)
     """
     try:
         limit = min(int(request.args.get('limit', 20)), 100)
+        cursor = request.args.get('cursor')
         offset = int(request.args.get('offset', 0))
         
-        logger.info(f"Listando resultados - limit: {limit}, offset: {offset}")
-        
-        query = db.collection('analises_imagens').order_by(
-            'data_processamento', 
-            direction=firestore.Query.DESCENDING
-        )
-        
-        # Aplicar limit
-        docs = query.limit(limit + offset).stream()
+        logger.info(f"Listando resultados - limit: {limit}, cursor: {cursor}, offset: {offset}")
+        
+        colecao = db.collection('analises_imagens')
+        if offset and not cursor:
+            # Compatibilidade: o Firestore salta os documentos sem os enviar
+            query = colecao.order_by(
+                'data_processamento',
+                direction='DESCENDING'
+            ).order_by('__name__', direction='DESCENDING')
+            docs = list(query.offset(offset).limit(limit).stream())
+            proximo_cursor = None
+            if len(docs) == limit:
+                proximo_cursor = paginacao.codificar_cursor(docs[-1].get('data_processamento'), docs[-1].id)
+        else:
+            docs, proximo_cursor = paginacao.pagina_firestore(colecao, limit, cursor)
         
         resultados = []
-        for i, doc in enumerate(docs):
-            if i < offset:  # Pular os offset primeiros
-                continue
-            
+        for doc in docs:
             resultado = doc.to_dict()
             resultado['id'] = doc.id
             
@@ -81,9 +103,12 @@ def listar_resultados():
             'total': len(resultados),
             'limit': limit,
             'offset': offset,
+            'proximo_cursor': proximo_cursor,
             'resultados': resultados
-        }), 200
+        }), 200, {paginacao.CABECALHO_CURSOR: proximo_cursor or ''}
         
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
     except Exception as e:
         logger.error(f"Erro ao listar resultados: {str(e)}")
         return jsonify({'erro': str(e)}), 500
@@ -110,7 +135,7 @@ def buscar_por_nome():
         # Então consultamos todos e filtramos em Python (não recomendado para grandes volumes)
         docs = db.collection('analises_imagens').order_by(
             'data_processamento',
-            direction=firestore.Query.DESCENDING
+            direction='DESCENDING'
         ).limit(100).stream()
         
         resultados = []
@@ -140,12 +165,11 @@ def buscar_por_nome():
 def obter_labels(doc_id):
     """Obter apenas os labels detectados de uma análise"""
     try:
-        doc = db.collection('analises_imagens').document(doc_id).get()
+        resultado = _obter_documento(doc_id)
         
-        if not doc.exists:
+        if resultado is None:
             return jsonify({'erro': 'Documento não encontrado'}), 404
         
-        resultado = doc.to_dict()
         labels = resultado.get('resultados', {}).get('labels', [])
         
         # Ordenar por score (confiança)
@@ -166,12 +190,11 @@ def obter_labels(doc_id):
 def obter_texto(doc_id):
     """Obter o texto detectado (OCR) de uma análise"""
     try:
-        doc = db.collection('analises_imagens').document(doc_id).get()
+        resultado = _obter_documento(doc_id)
         
-        if not doc.exists:
+        if resultado is None:
             return jsonify({'erro': 'Documento não encontrado'}), 404
         
-        resultado = doc.to_dict()
         dados = resultado.get('resultados', {})
         
         return jsonify({
@@ -190,12 +213,11 @@ def obter_texto(doc_id):
 def obter_rostos(doc_id):
     """Obter informações de rostos detectados"""
     try:
-        doc = db.collection('analises_imagens').document(doc_id).get()
+        resultado = _obter_documento(doc_id)
         
-        if not doc.exists:
+        if resultado is None:
             return jsonify({'erro': 'Documento não encontrado'}), 404
         
-        resultado = doc.to_dict()
         rostos = resultado.get('resultados', {}).get('rostos', [])
         
         return jsonify({
@@ -213,12 +235,11 @@ def obter_rostos(doc_id):
 def obter_safe_search(doc_id):
     """Obter análise de segurança de conteúdo"""
     try:
-        doc = db.collection('analises_imagens').document(doc_id).get()
+        resultado = _obter_documento(doc_id)
         
-        if not doc.exists:
+        if resultado is None:
             return jsonify({'erro': 'Documento não encontrado'}), 404
         
-        resultado = doc.to_dict()
         safe_search = resultado.get('resultados', {}).get('safe_search', {})
         
         return jsonify({
@@ -231,6 +252,12 @@ def obter_safe_search(doc_id):
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/cache/estatisticas', methods=['GET'])
+def estatisticas_cache():
+    """Taxa de acerto e memória da cache de documentos"""
+    return jsonify(cache_documentos.estatisticas()), 200
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -250,11 +277,13 @@ def index():
             'GET /resultados/<doc_id>/texto': 'Obter texto detectado (OCR)',
             'GET /resultados/<doc_id>/rostos': 'Obter rostos detectados',
             'GET /resultados/<doc_id>/safe-search': 'Obter análise de segurança',
+            'GET /cache/estatisticas': 'Estatísticas da cache de documentos',
             'GET /health': 'Verificar status da API'
         },
         'parâmetros_opcionais': {
             'limit': 'Número máximo de resultados (padrão: 20)',
-            'offset': 'Número de resultados a pular (para paginação)'
+            'cursor': 'Token proximo_cursor da página anterior (para paginação)',
+            'offset': 'Número de resultados a pular (obsoleto, usar cursor)'
         }
     }), 200
 
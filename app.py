@@ -8,18 +8,31 @@ Uma aplicação completa que:
 - Mostra resultados em tempo real
 """
 
-from flask import Flask, render_template_string, request, jsonify, send_file
-from google.cloud import storage
-from google.cloud import vision
-from google.cloud import firestore
-from google.cloud import pubsub_v1
+from flask import Flask, render_template_string, request, jsonify, send_file, redirect, url_for, Response, stream_with_context
 import json
 import os
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from io import BytesIO
 import base64
 
+from analise_vision import AgrupadorVision, FEATURES_PADRAO
+from cache_vision import CacheVision, CacheFirestore, chave_cache_sha256
+import hash_perceptual
+import armazenamento_imagens
+import miniaturas
+import paginacao
+import tarefas
+import limpeza
+import upload_lote
+import ingestao
+import normalizacao
+import publicacao
+import feed_resultados
+from cache_documentos import CacheDocumentos
+import clientes
+
 # Configuração de Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,17 +40,59 @@ logger = logging.getLogger(__name__)
 # Inicializar Flask
 app = Flask(__name__)
 
-# Inicializar clientes Google Cloud
-storage_client = storage.Client()
-vision_client = vision.ImageAnnotatorClient()
-db = firestore.Client()
-publisher_client = pubsub_v1.PublisherClient()
+# Clientes Google Cloud (criados na primeira utilização, ver clientes.py)
+storage_client = clientes.cliente('storage')
+vision_client = clientes.cliente('vision')
+db = clientes.cliente('firestore')
+
+# Agrupa as análises de uploads concorrentes em pedidos batch_annotate_images
+agrupador_vision = AgrupadorVision(vision_client)
+
+# Cache de resultados Vision (memória + coleção 'vision_cache')
+cache_vision = CacheVision(CacheFirestore(db))
 
 # Configurações
 PROJECT_ID = "projectcloud-484416"
 BUCKET_NAME = "meu-bucket-imagens"
 PUBSUB_TOPIC = "imagem-processada"
 
+# Notificações Pub/Sub: publicação em lotes sem bloquear o processamento (ver publicacao.py)
+publicador = publicacao.Publicador(PROJECT_ID, PUBSUB_TOPIC)
+
+# Bucket onde ficam as imagens das análises
+bucket = clientes.preguicoso(lambda: storage_client.bucket(BUCKET_NAME), 'bucket')
+
+# Tarefas em segundo plano (limpeza, ...)
+registo_tarefas = tarefas.RegistoTarefas()
+
+# Processamento dos uploads: pool limitado de workers com fila de tamanho máximo
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 8))
+UPLOAD_FILA_MAX = int(os.environ.get('UPLOAD_FILA_MAX', 500))
+registo_uploads = tarefas.RegistoTarefas(
+    max_workers=UPLOAD_WORKERS, max_tarefas=1000, max_pendentes=UPLOAD_FILA_MAX, prefixo='upload'
+)
+
+# Pool partilhado pelos pedidos de /upload/batch
+executor_lote = ThreadPoolExecutor(max_workers=upload_lote.LOTE_WORKERS, thread_name_prefix='lote')
+
+# Cache dos detalhes das análises (/api/resultados/<doc_id>)
+cache_documentos = CacheDocumentos()
+
+# Campos devolvidos pela listagem leve da galeria (/api/resultados)
+CAMPOS_RESUMO = [
+    'nome_arquivo', 'data_processamento', 'status',
+    'total_labels', 'total_textos', 'total_rostos', 'imagem_blob', 'miniaturas'
+]
+
+# Campos do detalhe de uma análise (tudo exceto a imagem)
+CAMPOS_DETALHE = CAMPOS_RESUMO + ['resultados', 'phash', 'duplicado_de']
+
+# Alterações das análises para /api/stream (o listener do Firestore só é criado no primeiro cliente)
+feed = feed_resultados.FeedAlteracoes(
+    campos=CAMPOS_RESUMO,
+    fonte=lambda feed: feed_resultados.ouvir_firestore(feed, db.collection('analises_imagens'))
+)
+
 # HTML do Frontend (embutido)
 FRONTEND_HTML = """
 <!DOCTYPE html>
@@ -188,6 +243,15 @@ FRONTEND_HTML = """
             transform: scale(1.02);
         }
         
+        .resultado-card .miniatura {
+            width: 100%;
+            height: 140px;
+            object-fit: cover;
+            border-radius: 5px;
+            margin-bottom: 10px;
+            background: #e0e0e0;
+        }
+        
         .resultado-card h3 {
             color: #667eea;
             word-break: break-word;
@@ -392,8 +456,8 @@ FRONTEND_HTML = """
                 <h2>1. Enviar Imagem</h2>
                 <div class="upload-box" id="dropZone">
                     <p style="font-size: 2em; margin-bottom: 10px;">📤</p>
-                    <p>Clique ou arraste uma imagem aqui</p>
-                    <input type="file" id="fileInput" accept="image/*">
+                    <p>Clique ou arraste uma ou mais imagens (ou um .zip) aqui</p>
+                    <input type="file" id="fileInput" accept="image/*,.zip" multiple>
                     <label class="file-input-label" for="fileInput">Seleccionar ficheiro</label>
                 </div>
                 <div style="text-align: center;">
@@ -707,6 +771,21 @@ FRONTEND_HTML = """
                 return;
             }
             
+            // Várias imagens ou um zip: enviar num só pedido para /upload/batch
+            if (fileInput.files.length > 1 || file.name.toLowerCase().endsWith('.zip')) {
+                uploadBtn.disabled = true;
+                try {
+                    await uploadLote(fileInput.files, statusDiv);
+                    fileInput.value = '';
+                    atualizarGaleria();
+                } catch (erro) {
+                    mostrarStatus(statusDiv, '❌ Erro: ' + erro.message, 'error');
+                } finally {
+                    uploadBtn.disabled = false;
+                }
+                return;
+            }
+            
             const formData = new FormData();
             formData.append('file', file);
             
@@ -722,9 +801,15 @@ FRONTEND_HTML = """
                 const dados = await response.json();
                 
                 if (response.ok) {
-                    mostrarStatus(statusDiv, '✅ Processamento concluído! Atualizando...', 'success');
+                    // O processamento corre em segundo plano: acompanhar a tarefa
                     fileInput.value = '';
-                    setTimeout(() => carregarResultados(), 1000);
+                    const tarefa = await aguardarTarefa(dados.job_id);
+                    if (tarefa.estado === 'concluida') {
+                        mostrarStatus(statusDiv, '✅ Processamento concluído! Atualizando...', 'success');
+                        atualizarGaleria();
+                    } else {
+                        mostrarStatus(statusDiv, '❌ Erro: ' + tarefa.erro, 'error');
+                    }
                 } else {
                     mostrarStatus(statusDiv, '❌ Erro: ' + dados.erro, 'error');
                 }
@@ -735,58 +820,181 @@ FRONTEND_HTML = """
             }
         }
         
-        async function carregarResultados() {
-            try {
-                const response = await fetch('/api/resultados');
-                const resultados = await response.json();
-                
-                const contador = document.getElementById('contadorResultados');
-                contador.textContent = `Total: ${resultados.length} análise(s)`;
-                
-                let html = '';
-                
-                resultados.forEach(resultado => {
-                    const data = new Date(resultado.data_processamento);
-                    const dataFormatada = data.toLocaleDateString('pt-PT') + ' ' + 
-                                         data.toLocaleTimeString('pt-PT', {hour: '2-digit', minute:'2-digit'});
+        async function uploadLote(ficheiros, statusDiv) {
+            const formData = new FormData();
+            for (const ficheiro of ficheiros) {
+                formData.append('files', ficheiro);
+            }
+            
+            mostrarStatus(statusDiv, '⏳ Enviando e processando...', 'loading');
+            const response = await fetch('/upload/batch', {
+                method: 'POST',
+                body: formData
+            });
+            
+            // Resposta NDJSON: uma linha por imagem processada, a última com o resumo
+            const leitor = response.body.getReader();
+            const decoder = new TextDecoder();
+            let pendente = '';
+            let processadas = 0;
+            while (true) {
+                const { done, value } = await leitor.read();
+                if (done) break;
+                pendente += decoder.decode(value, { stream: true });
+                const linhas = pendente.split('\n');
+                pendente = linhas.pop();
+                for (const linha of linhas.filter(l => l.trim())) {
+                    const dados = JSON.parse(linha);
+                    if (dados.resumo) {
+                        const tipo = dados.resumo.erros ? 'error' : 'success';
+                        mostrarStatus(statusDiv, `✅ ${dados.resumo.sucesso} de ${dados.resumo.total} imagens processadas`, tipo);
+                    } else if (dados.arquivo) {
+                        processadas++;
+                        mostrarStatus(statusDiv, `⏳ ${processadas} imagens processadas (última: ${dados.arquivo})`, 'loading');
+                    }
+                }
+            }
+        }
+        
+        // Galeria: id -> resumo da análise, atualizada pela listagem completa ou pelos eventos de /api/stream
+        const galeria = new Map();
+        const SEM_RESULTADOS = '<p style="text-align: center; color: #999;">Nenhuma análise realizada ainda.</p>';
+        let carregamento = null;
+        let feedLigado = false;
+        
+        function carregarResultados() {
+            carregamento = (async () => {
+                try {
+                    const response = await fetch('/api/resultados');
+                    const resultados = await response.json();
                     
-                    html += `
-                        <div class="resultado-card">
-                            <div class="card-actions">
-                                <button class="btn-icon" onclick="abrirImagemModal('${resultado.id}', '${resultado.nome_arquivo}'); event.stopPropagation();" title="Visualizar imagem">
-                                    👁️
-                                </button>
+                    galeria.clear();
+                    resultados.forEach(resultado => galeria.set(resultado.id, resultado));
+                    desenharGaleria();
+                } catch (erro) {
+                    console.error('Erro:', erro);
+                }
+            })();
+            return carregamento;
+        }
+        
+        // Com o feed ligado as alterações chegam sozinhas; sem ele, voltar a pedir a listagem
+        function atualizarGaleria() {
+            if (!feedLigado) {
+                carregarResultados();
+            }
+        }
+        
+        function desenharGaleria() {
+            const ordenados = [...galeria.values()].sort(compararResultados);
+            document.getElementById('resultados').innerHTML = ordenados.map(cartaoResultado).join('') || SEM_RESULTADOS;
+            atualizarContador();
+        }
+        
+        // Aplicar um evento do feed só ao cartão afetado
+        function aplicarAlteracao(tipo, dados) {
+            const contentor = document.getElementById('resultados');
+            const cartaoAtual = document.getElementById('card-' + dados.id);
+            
+            if (tipo === 'removida') {
+                galeria.delete(dados.id);
+                if (cartaoAtual) cartaoAtual.remove();
+                if (!galeria.size) contentor.innerHTML = SEM_RESULTADOS;
+            } else {
+                if (!galeria.size) contentor.innerHTML = '';
+                galeria.set(dados.id, dados);
+                if (cartaoAtual) cartaoAtual.remove();
+                
+                const modelo = document.createElement('template');
+                modelo.innerHTML = cartaoResultado(dados).trim();
+                // Manter a ordem da listagem: antes do primeiro cartão mais antigo
+                const seguinte = [...contentor.children].find(cartao =>
+                    galeria.has(cartao.dataset.id) && compararResultados(dados, galeria.get(cartao.dataset.id)) < 0);
+                contentor.insertBefore(modelo.content.firstChild, seguinte || null);
+            }
+            atualizarContador();
+        }
+        
+        function compararResultados(a, b) {
+            return (b.data_processamento || '').localeCompare(a.data_processamento || '') || b.id.localeCompare(a.id);
+        }
+        
+        function atualizarContador() {
+            document.getElementById('contadorResultados').textContent = `Total: ${galeria.size} análise(s)`;
+        }
+        
+        function cartaoResultado(resultado) {
+            const data = new Date(resultado.data_processamento);
+            const dataFormatada = data.toLocaleDateString('pt-PT') + ' ' + 
+                                 data.toLocaleTimeString('pt-PT', {hour: '2-digit', minute:'2-digit'});
+            
+            return `
+                <div class="resultado-card" id="card-${resultado.id}" data-id="${resultado.id}">
+                    <div class="card-actions">
+                        <button class="btn-icon" onclick="abrirImagemModal('${resultado.id}', '${resultado.nome_arquivo}'); event.stopPropagation();" title="Visualizar imagem">
+                            👁️
+                        </button>
+                    </div>
+                    <div onclick="abrirDetalhes('${resultado.id}')">
+                        <img class="miniatura" loading="lazy" decoding="async" alt=""
+                             src="/api/imagem/${resultado.id}/miniatura/pequena">
+                        <h3>${resultado.nome_arquivo}</h3>
+                        <div class="data">📅 ${dataFormatada}</div>
+                        <div class="stats">
+                            <div>
+                                <div class="stat-number">${resultado.total_labels}</div>
+                                <div class="stat-label">Objetos</div>
+                            </div>
+                            <div>
+                                <div class="stat-number">${resultado.total_textos}</div>
+                                <div class="stat-label">Textos</div>
                             </div>
-                            <div onclick="abrirDetalhes('${resultado.id}', ${JSON.stringify(resultado).replace(/"/g, '&quot;')})">
-                                <h3>${resultado.nome_arquivo}</h3>
-                                <div class="data">📅 ${dataFormatada}</div>
-                                <div class="stats">
-                                    <div>
-                                        <div class="stat-number">${resultado.total_labels}</div>
-                                        <div class="stat-label">Objetos</div>
-                                    </div>
-                                    <div>
-                                        <div class="stat-number">${resultado.total_textos}</div>
-                                        <div class="stat-label">Textos</div>
-                                    </div>
-                                    <div>
-                                        <div class="stat-number">${resultado.total_rostos}</div>
-                                        <div class="stat-label">Rostos</div>
-                                    </div>
-                                </div>
+                            <div>
+                                <div class="stat-number">${resultado.total_rostos}</div>
+                                <div class="stat-label">Rostos</div>
                             </div>
                         </div>
-                    `;
-                });
-                
-                document.getElementById('resultados').innerHTML = html || '<p style="text-align: center; color: #999;">Nenhuma análise realizada ainda.</p>';
-            } catch (erro) {
-                console.error('Erro:', erro);
+                    </div>
+                </div>
+            `;
+        }
+        
+        // Feed de alterações (Server-Sent Events); o navegador volta a ligar sozinho com Last-Event-ID
+        function ligarFeed() {
+            if (!window.EventSource) {
+                carregarResultados();
+                return;
             }
+            
+            const fonte = new EventSource('/api/stream');
+            // A listagem só é pedida com o feed ligado, para não perder alterações entre os dois
+            fonte.addEventListener('pronto', () => {
+                feedLigado = true;
+                if (!carregamento) carregarResultados();
+            });
+            fonte.addEventListener('reiniciar', () => carregarResultados());
+            // 'saiu_janela' (análise que deixou de ser das mais recentes) é ignorado: o cartão fica
+            ['analise', 'removida'].forEach(tipo => fonte.addEventListener(tipo, evento => {
+                const dados = JSON.parse(evento.data);
+                // Eventos recebidos durante um carregamento são aplicados depois dele
+                carregamento.then(() => aplicarAlteracao(tipo, dados));
+            }));
+            fonte.onerror = () => {
+                feedLigado = false;
+                if (!carregamento) carregarResultados();
+            };
         }
         
-        function abrirDetalhes(docId, resultado) {
+        async function abrirDetalhes(docId) {
             const modal = document.getElementById('detailModal');
+            
+            const response = await fetch(`/api/resultados/${docId}`);
+            const resultado = await response.json();
+            if (!response.ok) {
+                alert('Erro ao carregar detalhes: ' + resultado.erro);
+                return;
+            }
+            
             document.getElementById('modalTitle').textContent = resultado.nome_arquivo;
             
             // Labels
@@ -872,17 +1080,12 @@ FRONTEND_HTML = """
         
         async function abrirImagemModal(docId, nomeArquivo) {
             try {
-                const response = await fetch(`/api/imagem/${docId}`);
-                const data = await response.json();
-                
-                if (response.ok && data.imagem_base64) {
-                    document.getElementById('imageTitle').textContent = nomeArquivo;
-                    document.getElementById('imagePreview').src = 'data:image/jpeg;base64,' + data.imagem_base64;
-                    document.getElementById('imageModal').classList.add('show');
-                    currentImageId = docId;
-                } else {
-                    alert('Erro ao carregar imagem.');
-                }
+                const preview = document.getElementById('imagePreview');
+                preview.onerror = () => alert('Erro ao carregar imagem.');
+                preview.src = `/api/imagem/${docId}/miniatura/media`;
+                document.getElementById('imageTitle').textContent = nomeArquivo;
+                document.getElementById('imageModal').classList.add('show');
+                currentImageId = docId;
             } catch (erro) {
                 alert('Erro: ' + erro.message);
             }
@@ -901,7 +1104,7 @@ FRONTEND_HTML = """
                 if (response.ok) {
                     alert('✅ Imagem eliminada com sucesso.');
                     fecharImageModal();
-                    carregarResultados();
+                    atualizarGaleria();
                 } else {
                     alert('❌ Erro ao eliminar imagem.');
                 }
@@ -940,8 +1143,14 @@ FRONTEND_HTML = """
                 const dados = await response.json();
                 
                 if (response.ok) {
-                    alert(`✅ Base de dados limpa!\\n\\n${dados.total} imagens foram eliminadas.`);
-                    carregarResultados();
+                    // A limpeza corre em segundo plano: acompanhar a tarefa
+                    const tarefa = await aguardarTarefa(dados.job_id);
+                    if (tarefa.estado === 'concluida') {
+                        alert(`✅ Base de dados limpa!\\n\\n${tarefa.resultado.total} imagens foram eliminadas.`);
+                    } else {
+                        alert('❌ Erro: ' + tarefa.erro);
+                    }
+                    atualizarGaleria();
                 } else {
                     alert('❌ Erro: ' + dados.erro);
                 }
@@ -950,6 +1159,17 @@ FRONTEND_HTML = """
             }
         }
         
+        async function aguardarTarefa(jobId) {
+            while (true) {
+                const response = await fetch(`/api/jobs/${jobId}`);
+                const tarefa = await response.json();
+                if (!response.ok || tarefa.estado === 'concluida' || tarefa.estado === 'erro') {
+                    return tarefa;
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000));
+            }
+        }
+        
         window.onclick = function(event) {
             const modal = document.getElementById('detailModal');
             const imageModal = document.getElementById('imageModal');
@@ -961,7 +1181,7 @@ FRONTEND_HTML = """
             }
         }
         
-        carregarResultados();
+        ligarFeed();
     </script>
 </body>
 </html>
@@ -980,57 +1200,116 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_imagem():
-    """Upload e processamento de imagem"""
+    """
+    Receber a imagem e agendar o processamento
+    Aceita multipart (campo 'file') ou a imagem no corpo do pedido
+    (Content-Type: image/*, nome em ?nome=), copiada em blocos para disco
+    Retorna 202 com o job_id; o estado e o documento_id ficam em /api/jobs/<job_id>
+    """
     try:
-        if 'file' not in request.files:
-            return jsonify({'erro': 'Nenhum arquivo enviado'}), 400
-        
-        file = request.files['file']
+        if request.mimetype.startswith('image/'):
+            nome_arquivo = os.path.basename(request.args.get('nome', ''))
+            origem = request.stream
+        else:
+            if 'file' not in request.files:
+                return jsonify({'erro': 'Nenhum arquivo enviado'}), 400
+            file = request.files['file']
+            nome_arquivo = file.filename
+            origem = file.stream
         
-        if file.filename == '':
+        if nome_arquivo == '':
             return jsonify({'erro': 'Nome de arquivo vazio'}), 400
         
         # Validar tipo
-        allowed = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
-        ext = os.path.splitext(file.filename)[1].lower()
-        if ext not in allowed:
+        if not upload_lote.extensao_permitida(nome_arquivo):
             return jsonify({'erro': 'Tipo de arquivo não permitido'}), 400
         
-        logger.info(f"Processando upload: {file.filename}")
-        
-        # Ler arquivo em memória
-        imagem_bytes = file.read()
-        
-        # Processar com Vision API
-        resultados = _processar_imagem(imagem_bytes)
-        
-        # Guardar no Firestore
-        doc_id = _guardar_firestore(file.filename, resultados, imagem_bytes)
-        
-        # Publicar notificação
-        _publicar_notificacao(file.filename, doc_id, resultados)
+        # Guardar em disco (a fila só guarda o caminho)
+        try:
+            ficheiro = ingestao.receber(origem, nome_arquivo)
+        except ValueError as e:
+            return jsonify({'erro': str(e)}), 413
         
-        logger.info(f"Imagem processada com sucesso: {doc_id}")
+        try:
+            tarefa = registo_uploads.criar('upload', _processar_upload, ficheiro)
+        except tarefas.FilaCheia:
+            ficheiro.apagar()
+            raise
+        logger.info(f"Upload recebido: {nome_arquivo} (tarefa {tarefa.id})")
         
         return jsonify({
             'sucesso': True,
-            'mensagem': 'Imagem processada com sucesso',
-            'documento_id': doc_id
-        }), 200
+            'mensagem': 'Imagem recebida, processamento agendado',
+            'job_id': tarefa.id
+        }), 202, {'Location': url_for('api_job', job_id=tarefa.id)}
         
+    except tarefas.FilaCheia as e:
+        logger.warning(f"Upload rejeitado: {e}")
+        return jsonify({'erro': 'Servidor ocupado, tente novamente'}), 503, {'Retry-After': '5'}
     except Exception as e:
         logger.error(f"Erro ao processar: {str(e)}")
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Upload de várias imagens num só pedido: campo 'files' repetido, um .zip
+    entre os ficheiros, ou um zip no corpo do pedido (Content-Type: application/zip)
+    Retorna NDJSON: uma linha por imagem à medida que termina e uma linha final com o resumo
+
+    Exemplo com curl:
+    curl -X POST -F "files=@a.jpg" -F "files=@b.png" http://localhost:5000/upload/batch
+    curl -X POST -H "Content-Type: application/zip" --data-binary @fotos.zip http://localhost:5000/upload/batch
+    """
+    def gerar():
+        total = erros = 0
+        try:
+            resultados = upload_lote.processar_em_paralelo(
+                executor_lote, upload_lote.ler_imagens(request), _processar_lote
+            )
+            for resultado in resultados:
+                total += 1
+                erros += not resultado['sucesso']
+                yield json.dumps(resultado, ensure_ascii=False) + '\n'
+        except Exception as e:
+            logger.error(f"Erro no upload em lote: {str(e)}")
+            yield json.dumps({'erro': str(e)}, ensure_ascii=False) + '\n'
+        
+        logger.info(f"Upload em lote: {total - erros}/{total} imagens processadas")
+        yield json.dumps({'resumo': {'total': total, 'sucesso': total - erros, 'erros': erros}}) + '\n'
+    
+    return Response(stream_with_context(gerar()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """
+    Server-Sent Events com as análises novas, alteradas e removidas (ver feed_resultados.py)
+    Ao religar, o navegador envia Last-Event-ID e recebe os eventos que perdeu
+    """
+    return Response(
+        stream_with_context(feed.stream(request.headers.get('Last-Event-ID'))),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/resultados', methods=['GET'])
 def api_resultados():
-    """Obter todos os resultados"""
+    """
+    Obter todos os resultados (listagem leve, só campos de resumo)
+    Parâmetros opcionais:
+    - fields: campos extra separados por vírgula (ex: fields=resultados), ou * para o documento completo
+    - limit: número de resultados (padrão: 50, máximo: 100)
+    - cursor: valor do cabeçalho X-Proximo-Cursor da página anterior
+    """
     try:
-        docs = db.collection('analises_imagens').order_by(
-            'data_processamento', 
-            direction=firestore.Query.DESCENDING
-        ).limit(50).stream()
+        campos = _campos_listagem()
+        limit = min(int(request.args.get('limit', 50)), 100)
+        docs, proximo_cursor = paginacao.pagina_firestore(
+            db.collection('analises_imagens'), limit, request.args.get('cursor'), campos
+        )
         
         resultados = []
         for doc in docs:
@@ -1039,36 +1318,100 @@ def api_resultados():
             resultado['data_processamento'] = resultado['data_processamento'].isoformat()
             resultados.append(resultado)
         
-        return jsonify(resultados), 200
+        return jsonify(resultados), 200, {paginacao.CABECALHO_CURSOR: proximo_cursor or ''}
         
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
     except Exception as e:
         logger.error(f"Erro ao listar: {str(e)}")
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/api/resultados/<doc_id>', methods=['GET'])
+def api_resultado(doc_id):
+    """Obter a análise completa de uma imagem (sem a imagem)"""
+    try:
+        resultado = cache_documentos.obter(doc_id, _ler_detalhe)
+        if resultado is None:
+            return jsonify({'erro': 'Análise não encontrada'}), 404
+        
+        resultado['id'] = doc_id
+        resultado['data_processamento'] = resultado['data_processamento'].isoformat()
+        
+        return jsonify(resultado), 200
+        
+    except Exception as e:
+        logger.error(f"Erro ao obter análise: {str(e)}")
+        return jsonify({'erro': str(e)}), 500
+
+
 @app.route('/api/imagem/<doc_id>', methods=['GET'])
 def api_imagem(doc_id):
-    """Obter a imagem em base64"""
+    """
+    Obter a imagem (lida do Cloud Storage)
+    Com ?formato=base64 retorna JSON {'imagem_base64': ...} como antes
+    """
     try:
-        doc = db.collection('analises_imagens').document(doc_id).get()
+        doc = db.collection('analises_imagens').document(doc_id).get(
+            ['imagem_blob', 'imagem_content_type', 'imagem_base64']
+        )
         if not doc.exists:
             return jsonify({'erro': 'Imagem não encontrada'}), 404
         
         dados = doc.to_dict()
-        imagem_base64 = dados.get('imagem_base64', '')
+        if dados.get('imagem_blob'):
+            imagem_bytes = armazenamento_imagens.ler_imagem(bucket, dados['imagem_blob'])
+        else:
+            # Documentos antigos ainda não migrados
+            imagem_bytes = base64.b64decode(dados.get('imagem_base64', ''))
         
-        return jsonify({'imagem_base64': imagem_base64}), 200
+        if request.args.get('formato') == 'base64':
+            return jsonify({'imagem_base64': base64.b64encode(imagem_bytes).decode('utf-8')}), 200
+        
+        return send_file(
+            BytesIO(imagem_bytes),
+            mimetype=dados.get('imagem_content_type', 'image/jpeg'),
+            max_age=86400
+        )
         
     except Exception as e:
         logger.error(f"Erro ao obter imagem: {str(e)}")
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/api/imagem/<doc_id>/miniatura/<tamanho>', methods=['GET'])
+def api_miniatura(doc_id, tamanho):
+    """Obter uma miniatura da imagem (pequena ou media); sem miniatura redireciona para o original"""
+    try:
+        if tamanho not in miniaturas.TAMANHOS:
+            return jsonify({'erro': f'Tamanho inválido. Use: {list(miniaturas.TAMANHOS)}'}), 400
+        
+        doc = db.collection('analises_imagens').document(doc_id).get(['miniaturas'])
+        if not doc.exists:
+            return jsonify({'erro': 'Imagem não encontrada'}), 404
+        
+        caminho = (doc.to_dict().get('miniaturas') or {}).get(tamanho)
+        if not caminho:
+            return redirect(url_for('api_imagem', doc_id=doc_id))
+        
+        return send_file(
+            BytesIO(armazenamento_imagens.ler_imagem(bucket, caminho)),
+            mimetype=miniaturas.tipo_conteudo(caminho),
+            max_age=86400
+        )
+        
+    except Exception as e:
+        logger.error(f"Erro ao obter miniatura: {str(e)}")
+        return jsonify({'erro': str(e)}), 500
+
+
 @app.route('/api/imagem/<doc_id>', methods=['DELETE'])
 def deletar_imagem(doc_id):
     """Eliminar uma imagem e seus dados"""
     try:
         db.collection('analises_imagens').document(doc_id).delete()
+        cache_documentos.invalidar(doc_id)
+        armazenamento_imagens.apagar_imagens(bucket, doc_id)
         logger.info(f"Imagem eliminada: {doc_id}")
         return jsonify({'sucesso': True, 'mensagem': 'Imagem eliminada'}), 200
         
@@ -1079,97 +1422,139 @@ def deletar_imagem(doc_id):
 
 @app.route('/api/limpar-tudo', methods=['POST'])
 def limpar_tudo():
-    """Eliminar TODAS as imagens e dados da base de dados"""
+    """
+    Eliminar TODAS as imagens e dados da base de dados
+    Corre em segundo plano; o progresso é consultado em /api/jobs/<job_id>
+    """
     try:
-        # Obter todas as imagens
-        docs = db.collection('analises_imagens').stream()
-        
-        contador = 0
-        for doc in docs:
-            doc.reference.delete()
-            contador += 1
-        
-        logger.info(f"Base de dados limpa: {contador} imagens eliminadas")
-        return jsonify({'sucesso': True, 'mensagem': f'{contador} imagens eliminadas', 'total': contador}), 200
+        tarefa = registo_tarefas.criar('limpar_tudo', _apagar_analises)
+        return jsonify({'sucesso': True, 'mensagem': 'Limpeza iniciada', 'job_id': tarefa.id}), 202
         
     except Exception as e:
         logger.error(f"Erro ao limpar base de dados: {str(e)}")
         return jsonify({'erro': str(e)}), 500
 
 
+def _apagar_analises(tarefa):
+    """Tarefa de limpeza: a cache de documentos não é usada enquanto corre e é limpa no fim"""
+    with cache_documentos.suspensa():
+        return limpeza.apagar_analises(tarefa, db, bucket)
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    """Estado e progresso de uma tarefa em segundo plano"""
+    tarefa = registo_uploads.obter(job_id) or registo_tarefas.obter(job_id)
+    if tarefa is None:
+        return jsonify({'erro': 'Tarefa não encontrada'}), 404
+    return jsonify(tarefa), 200
+
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs():
+    """Ocupação do pool de uploads e das tarefas em segundo plano"""
+    return jsonify({
+        'uploads': registo_uploads.estatisticas(),
+        'tarefas': registo_tarefas.estatisticas()
+    }), 200
+
+
+@app.route('/api/cache/estatisticas', methods=['GET'])
+def estatisticas_cache():
+    """Acertos/falhas da cache de resultados Vision e da cache de documentos"""
+    estatisticas = cache_vision.estatisticas()
+    estatisticas['documentos'] = cache_documentos.estatisticas()
+    return jsonify(estatisticas), 200
+
+
+@app.route('/api/vision/estatisticas', methods=['GET'])
+def estatisticas_vision():
+    """Lotes enviados à Vision API e bytes poupados pela normalização das imagens"""
+    return jsonify({
+        'lotes': agrupador_vision.estatisticas(),
+        'normalizacao': normalizacao.estatisticas()
+    }), 200
+
+
+@app.route('/api/pubsub/estatisticas', methods=['GET'])
+def estatisticas_pubsub():
+    """Notificações publicadas, falhadas, em curso e à espera de reenvio"""
+    return jsonify(publicador.estatisticas()), 200
+
+
 # ============================================================================
 # FUNÇÕES AUXILIARES
 # ============================================================================
 
-def _processar_imagem(imagem_bytes):
-    """Processar imagem com Vision API"""
-    logger.info("Iniciando análise com Vision API...")
+def _processar_upload(tarefa, ficheiro):
+    """Processar uma imagem recebida em /upload (corre no pool de uploads)"""
+    try:
+        return _processar_ficheiro(ficheiro, lambda etapa: tarefa.atualizar(etapa=etapa))
+    finally:
+        ficheiro.apagar()
+
+
+def _processar_lote(nome_arquivo, ficheiro):
+    """Processar uma imagem de /upload/batch (corre no pool do lote)"""
+    try:
+        return _processar_ficheiro(ficheiro)
+    finally:
+        ficheiro.apagar()
+
+
+def _processar_ficheiro(ficheiro, etapa=lambda etapa: None):
+    """
+    Duplicados, Vision, Firestore/Storage e notificação de uma imagem recebida em disco
+    'etapa' é chamada com o nome de cada etapa (progresso)
+    Retorna {'documento_id', 'duplicado_de'}
+    """
+    nome_arquivo = ficheiro.nome
+    logger.info(f"Processando upload: {nome_arquivo}")
+    
+    # Procurar imagem quase duplicada já analisada
+    etapa('duplicados')
+    phash = hash_perceptual.calcular_dhash(ficheiro.caminho)
+    duplicado = _procurar_duplicado(phash)
+    
+    # Processar com Vision API (ou reutilizar a análise do duplicado)
+    etapa('vision')
+    if duplicado and hash_perceptual.REUTILIZAR_DUPLICADOS:
+        resultados = duplicado[1]['resultados']
+    else:
+        resultados = _processar_imagem(ficheiro)
+    duplicado_de = duplicado[0] if duplicado else None
+    
+    # Guardar no Firestore
+    etapa('guardar')
+    doc_id = _guardar_firestore(nome_arquivo, resultados, ficheiro, phash, duplicado_de)
+    
+    # Publicar notificação
+    etapa('notificar')
+    _publicar_notificacao(nome_arquivo, doc_id, resultados)
+    
+    logger.info(f"Imagem processada com sucesso: {doc_id}")
+    
+    return {
+        'documento_id': doc_id,
+        'duplicado_de': duplicado_de
+    }
+
+
+def _processar_imagem(ficheiro):
+    """Processar imagem com Vision API (agrupada com outros uploads concorrentes)"""
+    chave = chave_cache_sha256(ficheiro.sha256, FEATURES_PADRAO)
+    resultados = cache_vision.obter(chave)
+    if resultados is not None:
+        logger.info("Resultados obtidos da cache (imagem já analisada)")
+        return resultados
     
-    image = vision.Image(content=imagem_bytes)
-    resultados = {}
+    logger.info("Iniciando análise com Vision API...")
     
     try:
-        # 1. Labels
-        logger.info("Label Detection...")
-        response = vision_client.label_detection(image=image)
-        resultados['labels'] = [
-            {'descricao': label.description, 'score': float(label.score)}
-            for label in response.label_annotations
-        ]
-        
-        # 2. Text Detection
-        logger.info("Text Detection...")
-        response = vision_client.text_detection(image=image)
-        if response.text_annotations:
-            resultados['texto_completo'] = response.text_annotations[0].description if response.text_annotations else ""
-            resultados['textos'] = []
-        else:
-            resultados['texto_completo'] = ""
-            resultados['textos'] = []
-        
-        # 3. Face Detection
-        logger.info("Face Detection...")
-        response = vision_client.face_detection(image=image)
-        resultados['rostos'] = [
-            {
-                'confianca': float(face.detection_confidence),
-                'alegria': int(face.joy_likelihood),
-                'surpresa': int(face.surprise_likelihood)
-            }
-            for face in response.face_annotations
-        ]
-        
-        # 4. Safe Search
-        logger.info("Safe Search Detection...")
-        response = vision_client.safe_search_detection(image=image)
-        resultados['safe_search'] = {
-            'adulto': str(response.safe_search_annotation.adult),
-            'violencia': str(response.safe_search_annotation.violence),
-            'spoof': str(response.safe_search_annotation.spoof),
-            'medical': str(response.safe_search_annotation.medical),
-            'racy': str(response.safe_search_annotation.racy)
-        }
-        
-        # 5. Colors
-        logger.info("Image Properties...")
-        try:
-            response = vision_client.image_properties(image=image)
-            resultados['cores_dominantes'] = [
-                {
-                    'cor_rgb': {
-                        'red': int(color.color.red),
-                        'green': int(color.color.green),
-                        'blue': int(color.color.blue)
-                    },
-                    'score': float(color.score),
-                    'pixel_fraction': float(color.pixel_fraction)
-                }
-                for color in response.dominant_colors.colors
-            ]
-        except Exception as e:
-            logger.warning(f"Erro ao processar cores: {e}")
-            resultados['cores_dominantes'] = []
-        
+        # Versões reduzidas da imagem (só estas são lidas para memória)
+        variantes = normalizacao.preparar_variantes(ficheiro.caminho, FEATURES_PADRAO)
+        resultados, _ = agrupador_vision.analisar_variantes(variantes)
+        cache_vision.guardar(chave, resultados)
         logger.info("Análise concluída com sucesso")
         return resultados
         
@@ -1178,13 +1563,42 @@ def _processar_imagem(imagem_bytes):
         raise
 
 
-def _guardar_firestore(nome_arquivo, resultados, imagem_bytes):
-    """Guardar resultados no Firestore"""
+def _ler_detalhe(doc_id):
+    """Ler os campos de detalhe de uma análise do Firestore (None se não existir)"""
+    doc = db.collection('analises_imagens').document(doc_id).get(CAMPOS_DETALHE)
+    return doc.to_dict() if doc.exists else None
+
+
+def _campos_listagem():
+    """Campos a projetar na listagem: resumo + ?fields= (None = documento completo)"""
+    fields = request.args.get('fields', '')
+    if fields.strip() == '*':
+        return None
+    
+    extra = [campo.strip() for campo in fields.split(',') if campo.strip()]
+    return CAMPOS_RESUMO + [campo for campo in extra if campo not in CAMPOS_RESUMO]
+
+
+def _procurar_duplicado(phash):
+    """Procurar análise de uma imagem quase idêntica; retorna (doc_id, dados) ou None"""
+    if phash is None:
+        return None
+    
+    try:
+        return hash_perceptual.procurar_firestore(db, phash)
+    except Exception as e:
+        logger.warning(f"Erro ao procurar duplicados: {e}")
+        return None
+
+
+def _guardar_firestore(nome_arquivo, resultados, ficheiro, phash=None, duplicado_de=None):
+    """Guardar resultados no Firestore (a imagem vai para o Cloud Storage a partir do disco)"""
     logger.info("Guardando no Firestore...")
     
-    # Converter imagem para base64
-    import base64
-    imagem_base64 = base64.b64encode(imagem_bytes).decode('utf-8')
+    # Gerar o ID antes para guardar a imagem em imagens/<doc_id>/
+    doc_ref = db.collection('analises_imagens').document()
+    metadados_imagem = armazenamento_imagens.guardar_ficheiro(bucket, doc_ref.id, nome_arquivo, ficheiro.caminho)
+    metadados_imagem['miniaturas'] = miniaturas.guardar_miniaturas(bucket, doc_ref.id, ficheiro.caminho)
     
     dados = {
         'nome_arquivo': nome_arquivo,
@@ -1194,32 +1608,35 @@ def _guardar_firestore(nome_arquivo, resultados, imagem_bytes):
         'total_textos': len(resultados.get('textos', [])),
         'total_rostos': len(resultados.get('rostos', [])),
         'resultados': resultados,
-        'imagem_base64': imagem_base64
+        **metadados_imagem
     }
     
-    _, doc_ref = db.collection('analises_imagens').add(dados)
+    if phash:
+        dados['phash'] = phash
+        dados['phash_bandas'] = hash_perceptual.bandas(phash)
+    if duplicado_de:
+        dados['duplicado_de'] = duplicado_de
+    
+    try:
+        doc_ref.set(dados)
+    except Exception:
+        armazenamento_imagens.apagar_imagens(bucket, doc_ref.id)
+        raise
+    
     logger.info(f"Documento criado: {doc_ref.id}")
     return doc_ref.id
 
 
 def _publicar_notificacao(nome_arquivo, doc_id, resultados):
-    """Publicar em Pub/Sub"""
-    try:
-        logger.info("Publicando notificação...")
-        topic_path = publisher_client.topic_path(PROJECT_ID, PUBSUB_TOPIC)
-        
-        mensagem = {
-            'arquivo': nome_arquivo,
-            'documento': doc_id,
-            'timestamp': datetime.now().isoformat(),
-            'labels': len(resultados.get('labels', []))
-        }
-        
-        publisher_client.publish(topic_path, json.dumps(mensagem).encode('utf-8'))
-        logger.info("Notificação publicada")
-        
-    except Exception as e:
-        logger.warning(f"Erro ao publicar: {str(e)}")
+    """Publicar em Pub/Sub (não bloqueia: o envio e as falhas são tratados pelo publicador)"""
+    mensagem = {
+        'arquivo': nome_arquivo,
+        'documento': doc_id,
+        'timestamp': datetime.now().isoformat(),
+        'labels': len(resultados.get('labels', []))
+    }
+    
+    publicador.publicar(mensagem)
 
 
 # ============================================================================
@@ -4,13 +4,26 @@ Funciona com ou sem Firestore
 Armazena dados localmente em JSON se Firestore não disponível
 """
 
-from flask import Flask, render_template_string, request, jsonify
-from google.cloud import vision
-import json
+from flask import Flask, render_template_string, request, jsonify, send_file, redirect, url_for, Response, stream_with_context
 import os
 from datetime import datetime
 import logging
 from pathlib import Path
+from io import BytesIO
+import base64
+
+from analise_vision import analisar_variantes, FEATURES_PADRAO
+from cache_vision import CacheVision, CacheFirestore, CacheSQLite, chave_cache
+import hash_perceptual
+import armazenamento_imagens
+import miniaturas
+import paginacao
+import tarefas
+import limpeza
+import normalizacao
+import armazenamento_local
+import feed_resultados
+import clientes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -27,11 +40,52 @@ except Exception as e:
     firestore_disponivel = False
     logger.warning(f"⚠️  Firestore não disponível, usando arquivo local: {e}")
 
-# Inicializar Vision API
-vision_client = vision.ImageAnnotatorClient()
+# Tentar usar Cloud Storage para as imagens, senão guardar base64 no documento
+BUCKET_NAME = "meu-bucket-imagens"
+try:
+    from google.cloud import storage
+    bucket = storage.Client().bucket(BUCKET_NAME)
+    storage_disponivel = True
+    logger.info("✅ Cloud Storage disponível")
+except Exception as e:
+    storage_disponivel = False
+    logger.warning(f"⚠️  Cloud Storage não disponível, imagens ficam no documento: {e}")
+
+# Cliente da Vision API (criado no primeiro upload, ver clientes.py)
+vision_client = clientes.cliente('vision')
+
+# Armazenamento local dos dados (ARMAZENAMENTO_LOCAL=log|sqlite; o antigo JSON é importado na primeira execução)
+armazenamento = armazenamento_local.abrir_armazenamento(json_antigo="analises_imagens.json")
+DADOS_LOCAL = armazenamento.caminho
+
+# Cache de resultados Vision (Firestore se disponível, senão SQLite local)
+cache_vision = CacheVision(CacheFirestore(db) if firestore_disponivel else CacheSQLite())
 
-# Arquivo local para dados
-DADOS_LOCAL = "analises_imagens.json"
+# Índice de hashes perceptuais do arquivo local (construído na primeira utilização)
+indice_perceptual = None
+
+# Tarefas em segundo plano (limpeza, ...)
+registo_tarefas = tarefas.RegistoTarefas()
+
+# Campos devolvidos pela listagem leve da galeria (/api/resultados)
+CAMPOS_RESUMO = [
+    'nome_arquivo', 'data_processamento', 'status',
+    'total_labels', 'total_textos', 'total_rostos', 'imagem_blob', 'miniaturas'
+]
+
+# Campos do detalhe de uma análise (tudo exceto a imagem)
+CAMPOS_DETALHE = CAMPOS_RESUMO + ['resultados', 'phash', 'duplicado_de']
+
+
+def _iniciar_feed(feed):
+    """Fontes do feed de /api/stream: o registo de alterações local e, se disponível, o Firestore"""
+    armazenamento.observar(feed_resultados.observador_local(feed))
+    if firestore_disponivel:
+        feed_resultados.ouvir_firestore(feed, db.collection('analises_imagens'))
+
+
+# Alterações das análises para /api/stream (fontes ligadas no primeiro cliente)
+feed = feed_resultados.FeedAlteracoes(campos=CAMPOS_RESUMO, fonte=_iniciar_feed)
 
 PROJECT_ID = "projectcloud-484416"
 
@@ -200,6 +254,15 @@ FRONTEND_HTML = """
             transform: scale(1.02);
         }
         
+        .resultado-card .miniatura {
+            width: 100%;
+            height: 140px;
+            object-fit: cover;
+            border-radius: 5px;
+            margin-bottom: 10px;
+            background: #e0e0e0;
+        }
+        
         .resultado-card h3 {
             color: #667eea;
             word-break: break-word;
@@ -695,21 +758,6 @@ FRONTEND_HTML = """
             'cyan': 'Ciano',
             'magenta': 'Magenta'
         };
-            'green': 'Verde',
-            'yellow': 'Amarelo',
-            'orange': 'Laranja',
-            'pink': 'Rosa',
-            'purple': 'Roxo',
-            'black': 'Preto',
-            'white': 'Branco',
-            'gray': 'Cinzento',
-            'grey': 'Cinzento',
-            'brown': 'Castanho',
-            'gold': 'Ouro',
-            'silver': 'Prata',
-            'cyan': 'Ciano',
-            'magenta': 'Magenta'
-        };
         
         // Função para traduzir labels
         function traduzirLabel(label) {
@@ -763,7 +811,7 @@ FRONTEND_HTML = """
                 if (response.ok) {
                     mostrarStatus(statusDiv, '✅ Processamento concluído!', 'success');
                     fileInput.value = '';
-                    setTimeout(() => carregarResultados(), 1000);
+                    atualizarGaleria();
                 } else {
                     mostrarStatus(statusDiv, '❌ Erro: ' + dados.erro, 'error');
                 }
@@ -774,62 +822,145 @@ FRONTEND_HTML = """
             }
         }
         
-        async function carregarResultados() {
-            try {
-                const response = await fetch('/api/resultados');
-                const resultados = await response.json();
-                
-                const contador = document.getElementById('contadorResultados');
-                contador.textContent = `Total: ${resultados.length} análise(s)`;
-                
-                let html = '';
-                
-                resultados.forEach(resultado => {
-                    const data = new Date(resultado.data_processamento);
-                    const dataFormatada = data.toLocaleDateString('pt-PT') + ' ' + 
-                                         data.toLocaleTimeString('pt-PT', {hour: '2-digit', minute:'2-digit'});
+        // Galeria: id -> resumo da análise, atualizada pela listagem completa ou pelos eventos de /api/stream
+        const galeria = new Map();
+        const SEM_RESULTADOS = '<p style="text-align: center; color: #999;">Nenhuma análise realizada ainda.</p>';
+        let carregamento = null;
+        let feedLigado = false;
+        
+        function carregarResultados() {
+            carregamento = (async () => {
+                try {
+                    const response = await fetch('/api/resultados');
+                    const resultados = await response.json();
                     
-                    html += `
-                        <div class="resultado-card">
-                            <div class="card-actions">
-                                <button class="btn-icon" onclick="abrirImagemModal('${resultado.id}', '${resultado.nome_arquivo}'); event.stopPropagation();" title="Visualizar imagem">
-                                    👁️
-                                </button>
+                    galeria.clear();
+                    resultados.forEach(resultado => galeria.set(resultado.id, resultado));
+                    desenharGaleria();
+                } catch (erro) {
+                    console.error('Erro:', erro);
+                }
+            })();
+            return carregamento;
+        }
+        
+        // Com o feed ligado as alterações chegam sozinhas; sem ele, voltar a pedir a listagem
+        function atualizarGaleria() {
+            if (!feedLigado) {
+                carregarResultados();
+            }
+        }
+        
+        function desenharGaleria() {
+            const ordenados = [...galeria.values()].sort(compararResultados);
+            document.getElementById('resultados').innerHTML = ordenados.map(cartaoResultado).join('') || SEM_RESULTADOS;
+            atualizarContador();
+        }
+        
+        // Aplicar um evento do feed só ao cartão afetado
+        function aplicarAlteracao(tipo, dados) {
+            const contentor = document.getElementById('resultados');
+            const cartaoAtual = document.getElementById('card-' + dados.id);
+            
+            if (tipo === 'removida') {
+                galeria.delete(dados.id);
+                if (cartaoAtual) cartaoAtual.remove();
+                if (!galeria.size) contentor.innerHTML = SEM_RESULTADOS;
+            } else {
+                if (!galeria.size) contentor.innerHTML = '';
+                galeria.set(dados.id, dados);
+                if (cartaoAtual) cartaoAtual.remove();
+                
+                const modelo = document.createElement('template');
+                modelo.innerHTML = cartaoResultado(dados).trim();
+                // Manter a ordem da listagem: antes do primeiro cartão mais antigo
+                const seguinte = [...contentor.children].find(cartao =>
+                    galeria.has(cartao.dataset.id) && compararResultados(dados, galeria.get(cartao.dataset.id)) < 0);
+                contentor.insertBefore(modelo.content.firstChild, seguinte || null);
+            }
+            atualizarContador();
+        }
+        
+        function compararResultados(a, b) {
+            return (b.data_processamento || '').localeCompare(a.data_processamento || '') || b.id.localeCompare(a.id);
+        }
+        
+        function atualizarContador() {
+            document.getElementById('contadorResultados').textContent = `Total: ${galeria.size} análise(s)`;
+        }
+        
+        function cartaoResultado(resultado) {
+            const data = new Date(resultado.data_processamento);
+            const dataFormatada = data.toLocaleDateString('pt-PT') + ' ' + 
+                                 data.toLocaleTimeString('pt-PT', {hour: '2-digit', minute:'2-digit'});
+            
+            return `
+                <div class="resultado-card" id="card-${resultado.id}" data-id="${resultado.id}">
+                    <div class="card-actions">
+                        <button class="btn-icon" onclick="abrirImagemModal('${resultado.id}', '${resultado.nome_arquivo}'); event.stopPropagation();" title="Visualizar imagem">
+                            👁️
+                        </button>
+                    </div>
+                    <div onclick="abrirDetalhes('${resultado.id}')">
+                        <img class="miniatura" loading="lazy" decoding="async" alt=""
+                             src="/api/imagem/${resultado.id}/miniatura/pequena">
+                        <h3>${resultado.nome_arquivo}</h3>
+                        <div class="data">📅 ${dataFormatada}</div>
+                        <div class="stats">
+                            <div class="stat">
+                                <div class="stat-number">${resultado.total_labels}</div>
+                                <div class="stat-label">Objetos</div>
                             </div>
-                            <div onclick="abrirDetalhes(${JSON.stringify(resultado).replace(/"/g, '&quot;')})">
-                                <h3>${resultado.nome_arquivo}</h3>
-                                <div class="data">📅 ${dataFormatada}</div>
-                                <div class="stats">
-                                    <div class="stat">
-                                        <div class="stat-number">${resultado.total_labels}</div>
-                                        <div class="stat-label">Objetos</div>
-                                    </div>
-                                    <div class="stat">
-                                        <div class="stat-number">${resultado.total_textos}</div>
-                                        <div class="stat-label">Textos</div>
-                                    </div>
-                                    <div class="stat">
-                                        <div class="stat-number">${resultado.total_rostos}</div>
-                                        <div class="stat-label">Rostos</div>
-                                    </div>
-                                </div>
+                            <div class="stat">
+                                <div class="stat-number">${resultado.total_textos}</div>
+                                <div class="stat-label">Textos</div>
                             </div>
-                        </div>
-                    `;
+                            <div class="stat">
+                                <div class="stat-number">${resultado.total_rostos}</div>
+                                <div class="stat-label">Rostos</div>
                             </div>
                         </div>
-                    `;
-                });
-                
-                document.getElementById('resultados').innerHTML = html || '<p style="text-align: center; color: #999;">Nenhuma análise realizada ainda.</p>';
-                
-            } catch (erro) {
-                console.error('Erro:', erro);
-            }
+                    </div>
+                </div>
+            `;
         }
         
-        function abrirDetalhes(resultado) {
+        // Feed de alterações (Server-Sent Events); o navegador volta a ligar sozinho com Last-Event-ID
+        function ligarFeed() {
+            if (!window.EventSource) {
+                carregarResultados();
+                return;
+            }
+            
+            const fonte = new EventSource('/api/stream');
+            // A listagem só é pedida com o feed ligado, para não perder alterações entre os dois
+            fonte.addEventListener('pronto', () => {
+                feedLigado = true;
+                if (!carregamento) carregarResultados();
+            });
+            fonte.addEventListener('reiniciar', () => carregarResultados());
+            // 'saiu_janela' (análise que deixou de ser das mais recentes) é ignorado: o cartão fica
+            ['analise', 'removida'].forEach(tipo => fonte.addEventListener(tipo, evento => {
+                const dados = JSON.parse(evento.data);
+                // Eventos recebidos durante um carregamento são aplicados depois dele
+                carregamento.then(() => aplicarAlteracao(tipo, dados));
+            }));
+            fonte.onerror = () => {
+                feedLigado = false;
+                if (!carregamento) carregarResultados();
+            };
+        }
+        
+        async function abrirDetalhes(docId) {
             const modal = document.getElementById('detailModal');
+            
+            const response = await fetch(`/api/resultados/${docId}`);
+            const resultado = await response.json();
+            if (!response.ok) {
+                alert('Erro ao carregar detalhes: ' + resultado.erro);
+                return;
+            }
+            
             document.getElementById('modalTitle').textContent = resultado.nome_arquivo;
             
             // Labels
@@ -912,17 +1043,12 @@ FRONTEND_HTML = """
         
         async function abrirImagemModal(docId, nomeArquivo) {
             try {
-                const response = await fetch(`/api/imagem/${docId}`);
-                const data = await response.json();
-                
-                if (response.ok && data.imagem_base64) {
-                    document.getElementById('imageTitle').textContent = nomeArquivo;
-                    document.getElementById('imagePreview').src = 'data:image/jpeg;base64,' + data.imagem_base64;
-                    document.getElementById('imageModal').classList.add('show');
-                    currentImageId = docId;
-                } else {
-                    alert('Erro ao carregar imagem.');
-                }
+                const preview = document.getElementById('imagePreview');
+                preview.onerror = () => alert('Erro ao carregar imagem.');
+                preview.src = `/api/imagem/${docId}/miniatura/media`;
+                document.getElementById('imageTitle').textContent = nomeArquivo;
+                document.getElementById('imageModal').classList.add('show');
+                currentImageId = docId;
             } catch (erro) {
                 alert('Erro: ' + erro.message);
             }
@@ -941,7 +1067,7 @@ FRONTEND_HTML = """
                 if (response.ok) {
                     alert('✅ Imagem eliminada com sucesso.');
                     fecharImageModal();
-                    carregarResultados();
+                    atualizarGaleria();
                 } else {
                     alert('❌ Erro ao eliminar imagem.');
                 }
@@ -976,7 +1102,7 @@ FRONTEND_HTML = """
             }
         }
         
-        carregarResultados();
+        ligarFeed();
     </script>
 </body>
 </html>
@@ -988,74 +1114,19 @@ FRONTEND_HTML = """
 # ============================================================================
 
 def _processar_imagem(imagem_bytes):
-    """Processar imagem com Vision API"""
-    logger.info("Iniciando análise com Vision API...")
+    """Processar imagem com Vision API (um único pedido com todas as features)"""
+    chave = chave_cache(imagem_bytes, FEATURES_PADRAO)
+    resultados = cache_vision.obter(chave)
+    if resultados is not None:
+        logger.info("Resultados obtidos da cache (imagem já analisada)")
+        return resultados
     
-    image = vision.Image(content=imagem_bytes)
-    resultados = {}
+    logger.info("Iniciando análise com Vision API...")
     
     try:
-        # 1. Labels
-        logger.info("Label Detection...")
-        response = vision_client.label_detection(image=image)
-        resultados['labels'] = [
-            {'descricao': label.description, 'score': float(label.score)}
-            for label in response.label_annotations
-        ]
-        
-        # 2. Text Detection
-        logger.info("Text Detection...")
-        response = vision_client.text_detection(image=image)
-        if response.text_annotations:
-            resultados['texto_completo'] = response.text_annotations[0].description if response.text_annotations else ""
-            resultados['textos'] = []
-        else:
-            resultados['texto_completo'] = ""
-            resultados['textos'] = []
-        
-        # 3. Face Detection
-        logger.info("Face Detection...")
-        response = vision_client.face_detection(image=image)
-        resultados['rostos'] = [
-            {
-                'confianca': float(face.detection_confidence),
-                'alegria': int(face.joy_likelihood),
-                'surpresa': int(face.surprise_likelihood)
-            }
-            for face in response.face_annotations
-        ]
-        
-        # 4. Safe Search
-        logger.info("Safe Search Detection...")
-        response = vision_client.safe_search_detection(image=image)
-        resultados['safe_search'] = {
-            'adulto': str(response.safe_search_annotation.adult),
-            'violencia': str(response.safe_search_annotation.violence),
-            'spoof': str(response.safe_search_annotation.spoof),
-            'medical': str(response.safe_search_annotation.medical),
-            'racy': str(response.safe_search_annotation.racy)
-        }
-        
-        # 5. Colors
-        logger.info("Image Properties...")
-        try:
-            response = vision_client.image_properties(image=image)
-            resultados['cores_dominantes'] = [
-                {
-                    'cor_rgb': {
-                        'red': int(color.color.red),
-                        'green': int(color.color.green),
-                        'blue': int(color.color.blue)
-                    },
-                    'score': float(color.score),
-                    'pixel_fraction': float(color.pixel_fraction)
-                }
-                for color in response.dominant_colors.colors
-            ]
-        except Exception as e:
-            logger.warning(f"Erro ao processar cores: {e}")
-            resultados['cores_dominantes'] = []
-        
+        variantes = normalizacao.preparar_variantes(imagem_bytes, FEATURES_PADRAO)
+        resultados, _ = analisar_variantes(vision_client, variantes)
+        cache_vision.guardar(chave, resultados)
         logger.info("Análise concluída com sucesso")
         return resultados
         
@@ -1064,17 +1135,103 @@ def _processar_imagem(imagem_bytes):
         raise
 
 
-def _guardar_resultado(nome_arquivo, resultados, imagem_bytes):
+def _indice_local():
+    """
+    Índice perceptual do log local, construído a partir do índice do armazenamento
+    None no SQLite: a base de dados é partilhada pelos workers do gunicorn e um índice
+    em memória não veria as escritas dos outros, por isso a procura é feita nela
+    """
+    global indice_perceptual
+    if isinstance(armazenamento, armazenamento_local.ArmazenamentoSQLite):
+        return None
+    if indice_perceptual is None:
+        indice_perceptual = hash_perceptual.IndicePerceptual()
+        for doc_id, phash in armazenamento.valores('phash'):
+            indice_perceptual.adicionar(doc_id, phash)
+    return indice_perceptual
+
+
+def _campos_listagem():
+    """Campos a projetar na listagem: resumo + ?fields= (None = documento completo)"""
+    fields = request.args.get('fields', '')
+    if fields.strip() == '*':
+        return None
+    
+    extra = [campo.strip() for campo in fields.split(',') if campo.strip()]
+    return CAMPOS_RESUMO + [campo for campo in extra if campo not in CAMPOS_RESUMO]
+
+
+def _projetar(resultado, campos):
+    """Manter só os campos pedidos de um registo local (e o id)"""
+    projetado = {campo: resultado[campo] for campo in campos if campo in resultado}
+    projetado['id'] = resultado.get('id')
+    return projetado
+
+
+def _procurar_duplicado(phash):
+    """Procurar análise de uma imagem quase idêntica; retorna (doc_id, dados) ou None"""
+    if phash is None:
+        return None
+    
+    try:
+        if firestore_disponivel:
+            return hash_perceptual.procurar_firestore(db, phash)
+        
+        indice = _indice_local()
+        if indice is None:
+            doc_id = hash_perceptual.mais_proximo(phash, armazenamento.candidatos_phash(phash))
+        else:
+            doc_id = indice.procurar(phash)
+        if doc_id is None:
+            return None
+        resultado = armazenamento.obter(doc_id)
+        if resultado is not None:
+            logger.info(f"Duplicado encontrado localmente: {doc_id}")
+            return doc_id, resultado
+    except Exception as e:
+        logger.warning(f"Erro ao procurar duplicados: {e}")
+    
+    return None
+
+
+def _miniaturas_base64(imagem_bytes):
+    """Miniaturas em base64 para guardar no próprio registo (sem Cloud Storage)"""
+    return {
+        nome: base64.b64encode(dados).decode('utf-8')
+        for nome, dados in miniaturas.gerar_miniaturas(imagem_bytes).items()
+    }
+
+
+def _guardar_resultado(nome_arquivo, resultados, imagem_bytes, phash=None, duplicado_de=None):
     """Guardar resultado em Firestore ou arquivo local"""
+    global firestore_disponivel
     doc_id = None
     
-    # Converter imagem para base64
-    import base64
+    # Campos de deteção de duplicados
+    extra = {}
+    if phash:
+        extra['phash'] = phash
+        extra['phash_bandas'] = hash_perceptual.bandas(phash)
+    if duplicado_de:
+        extra['duplicado_de'] = duplicado_de
+    
+    # Converter imagem para base64 (usado quando não há Cloud Storage)
     imagem_base64 = base64.b64encode(imagem_bytes).decode('utf-8')
     
     # Tentar Firestore primeiro
     if firestore_disponivel:
         try:
+            # Imagem no Cloud Storage, documento só com a referência
+            doc_ref = db.collection('analises_imagens').document()
+            if storage_disponivel:
+                imagem = armazenamento_imagens.guardar_imagem(bucket, doc_ref.id, nome_arquivo, imagem_bytes)
+                imagem['miniaturas'] = miniaturas.guardar_miniaturas(bucket, doc_ref.id, imagem_bytes)
+            else:
+                imagem = {
+                    'imagem_base64': imagem_base64,
+                    'miniaturas_base64': _miniaturas_base64(imagem_bytes)
+                }
+            
             dados = {
                 'nome_arquivo': nome_arquivo,
                 'data_processamento': datetime.now(),
@@ -1083,9 +1240,10 @@ def _guardar_resultado(nome_arquivo, resultados, imagem_bytes):
                 'total_textos': len(resultados.get('textos', [])),
                 'total_rostos': len(resultados.get('rostos', [])),
                 'resultados': resultados,
-                'imagem_base64': imagem_base64
+                **imagem,
+                **extra
             }
-            _, doc_ref = db.collection('analises_imagens').add(dados)
+            doc_ref.set(dados)
             doc_id = doc_ref.id
             logger.info(f"Guardado no Firestore: {doc_id}")
         except Exception as e:
@@ -1095,12 +1253,6 @@ def _guardar_resultado(nome_arquivo, resultados, imagem_bytes):
     # Fallback: arquivo local
     if not firestore_disponivel:
         try:
-            # Ler dados existentes
-            dados_list = []
-            if os.path.exists(DADOS_LOCAL):
-                with open(DADOS_LOCAL, 'r', encoding='utf-8') as f:
-                    dados_list = json.load(f)
-            
             # Adicionar novo
             import uuid
             doc_id = str(uuid.uuid4())
@@ -1113,13 +1265,15 @@ def _guardar_resultado(nome_arquivo, resultados, imagem_bytes):
                 'total_textos': len(resultados.get('textos', [])),
                 'total_rostos': len(resultados.get('rostos', [])),
                 'resultados': resultados,
-                'imagem_base64': imagem_base64
+                'imagem_base64': imagem_base64,
+                'miniaturas_base64': _miniaturas_base64(imagem_bytes),
+                **extra
             }
-            dados_list.insert(0, novo_dado)
+            armazenamento.inserir(novo_dado)
             
-            # Guardar
-            with open(DADOS_LOCAL, 'w', encoding='utf-8') as f:
-                json.dump(dados_list, f, indent=2, ensure_ascii=False)
+            indice = _indice_local()
+            if phash and indice is not None:
+                indice.adicionar(doc_id, phash)
             
             logger.info(f"Guardado localmente: {doc_id}")
         except Exception as e:
@@ -1161,18 +1315,27 @@ def upload_imagem():
         # Ler arquivo em memória
         imagem_bytes = file.read()
         
-        # Processar com Vision API
-        resultados = _processar_imagem(imagem_bytes)
+        # Procurar imagem quase duplicada já analisada
+        phash = hash_perceptual.calcular_dhash(imagem_bytes)
+        duplicado = _procurar_duplicado(phash)
+        
+        # Processar com Vision API (ou reutilizar a análise do duplicado)
+        if duplicado and hash_perceptual.REUTILIZAR_DUPLICADOS:
+            resultados = duplicado[1]['resultados']
+        else:
+            resultados = _processar_imagem(imagem_bytes)
+        duplicado_de = duplicado[0] if duplicado else None
         
         # Guardar resultado
-        doc_id = _guardar_resultado(file.filename, resultados, imagem_bytes)
+        doc_id = _guardar_resultado(file.filename, resultados, imagem_bytes, phash, duplicado_de)
         
         logger.info(f"Imagem processada com sucesso: {doc_id}")
         
         return jsonify({
             'sucesso': True,
             'mensagem': 'Imagem processada com sucesso',
-            'documento_id': doc_id
+            'documento_id': doc_id,
+            'duplicado_de': duplicado_de
         }), 200
         
     except Exception as e:
@@ -1180,17 +1343,41 @@ def upload_imagem():
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/api/stream', methods=['GET'])
+def api_stream():
+    """
+    Server-Sent Events com as análises novas, alteradas e removidas (ver feed_resultados.py)
+    Ao religar, o navegador envia Last-Event-ID e recebe os eventos que perdeu
+    """
+    return Response(
+        stream_with_context(feed.stream(request.headers.get('Last-Event-ID'))),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/api/resultados', methods=['GET'])
 def api_resultados():
-    """Obter todos os resultados"""
+    """
+    Obter todos os resultados (listagem leve, só campos de resumo)
+    Parâmetros opcionais:
+    - fields: campos extra separados por vírgula (ex: fields=resultados), ou * para o documento completo
+    - limit: número de resultados (padrão: 50, máximo: 100)
+    - cursor: valor do cabeçalho X-Proximo-Cursor da página anterior
+    """
     try:
+        campos = _campos_listagem()
+        limit = min(int(request.args.get('limit', 50)), 100)
+        cursor = request.args.get('cursor')
+        if cursor:
+            paginacao.decodificar_cursor(cursor)  # Validar antes de consultar
+        
         if firestore_disponivel:
             # Tentar Firestore
             try:
-                docs = db.collection('analises_imagens').order_by(
-                    'data_processamento', 
-                    direction=firestore.Query.DESCENDING
-                ).limit(50).stream()
+                docs, proximo_cursor = paginacao.pagina_firestore(
+                    db.collection('analises_imagens'), limit, cursor, campos
+                )
                 
                 resultados = []
                 for doc in docs:
@@ -1199,47 +1386,82 @@ def api_resultados():
                     resultado['data_processamento'] = resultado['data_processamento'].isoformat()
                     resultados.append(resultado)
                 
-                return jsonify(resultados), 200
+                return jsonify(resultados), 200, {paginacao.CABECALHO_CURSOR: proximo_cursor or ''}
             except Exception as e:
                 logger.warning(f"Firestore falhou: {e}, usando arquivo local")
         
         # Fallback: arquivo local
-        if os.path.exists(DADOS_LOCAL):
-            with open(DADOS_LOCAL, 'r', encoding='utf-8') as f:
-                resultados = json.load(f)
-            return jsonify(resultados), 200
-        else:
-            return jsonify([]), 200
+        resultados, proximo_cursor = armazenamento.listar(limit, cursor)
+        if campos is not None:
+            resultados = [_projetar(resultado, campos) for resultado in resultados]
+        return jsonify(resultados), 200, {paginacao.CABECALHO_CURSOR: proximo_cursor or ''}
         
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
     except Exception as e:
         logger.error(f"Erro ao listar: {str(e)}")
         return jsonify([]), 200
 
 
+@app.route('/api/resultados/<doc_id>', methods=['GET'])
+def api_resultado(doc_id):
+    """Obter a análise completa de uma imagem (sem a imagem)"""
+    try:
+        if firestore_disponivel:
+            try:
+                doc = db.collection('analises_imagens').document(doc_id).get(CAMPOS_DETALHE)
+                if not doc.exists:
+                    return jsonify({'erro': 'Análise não encontrada'}), 404
+                
+                resultado = doc.to_dict()
+                resultado['id'] = doc.id
+                resultado['data_processamento'] = resultado['data_processamento'].isoformat()
+                return jsonify(resultado), 200
+            except Exception as e:
+                logger.warning(f"Firestore falhou: {e}, usando arquivo local")
+        
+        # Fallback: arquivo local
+        resultado = armazenamento.obter(doc_id)
+        if resultado is not None:
+            return jsonify(_projetar(resultado, CAMPOS_DETALHE)), 200
+        
+        return jsonify({'erro': 'Análise não encontrada'}), 404
+        
+    except Exception as e:
+        logger.error(f"Erro ao obter análise: {str(e)}")
+        return jsonify({'erro': str(e)}), 500
+
+
 @app.route('/api/imagem/<doc_id>', methods=['GET'])
 def api_imagem(doc_id):
-    """Obter a imagem em base64"""
+    """
+    Obter a imagem (Cloud Storage, documento ou arquivo local)
+    Com ?formato=base64 retorna JSON {'imagem_base64': ...} como antes
+    """
     try:
         if firestore_disponivel:
             try:
-                doc = db.collection('analises_imagens').document(doc_id).get()
+                doc = db.collection('analises_imagens').document(doc_id).get(
+                    ['imagem_blob', 'imagem_content_type', 'imagem_base64']
+                )
                 if not doc.exists:
                     return jsonify({'erro': 'Imagem não encontrada'}), 404
                 
                 dados = doc.to_dict()
-                imagem_base64 = dados.get('imagem_base64', '')
-                return jsonify({'imagem_base64': imagem_base64}), 200
+                if dados.get('imagem_blob') and storage_disponivel:
+                    imagem_bytes = armazenamento_imagens.ler_imagem(bucket, dados['imagem_blob'])
+                else:
+                    imagem_bytes = base64.b64decode(dados.get('imagem_base64', ''))
+                return _responder_imagem(imagem_bytes, dados.get('imagem_content_type'))
             except Exception as e:
                 logger.warning(f"Firestore falhou: {e}, usando arquivo local")
         
         # Fallback: arquivo local
-        if os.path.exists(DADOS_LOCAL):
-            with open(DADOS_LOCAL, 'r', encoding='utf-8') as f:
-                resultados = json.load(f)
-            for resultado in resultados:
-                if resultado.get('id') == doc_id:
-                    imagem_base64 = resultado.get('imagem_base64', '')
-                    return jsonify({'imagem_base64': imagem_base64}), 200
+        resultado = armazenamento.obter(doc_id)
+        if resultado is not None:
+            imagem_bytes = armazenamento.imagem(doc_id) or b''
+            content_type = armazenamento_imagens.tipo_conteudo(resultado.get('nome_arquivo', ''))
+            return _responder_imagem(imagem_bytes, content_type)
         
         return jsonify({'erro': 'Imagem não encontrada'}), 404
         
@@ -1248,6 +1470,62 @@ def api_imagem(doc_id):
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/api/imagem/<doc_id>/miniatura/<tamanho>', methods=['GET'])
+def api_miniatura(doc_id, tamanho):
+    """Obter uma miniatura da imagem (pequena ou media); sem miniatura redireciona para o original"""
+    try:
+        if tamanho not in miniaturas.TAMANHOS:
+            return jsonify({'erro': f'Tamanho inválido. Use: {list(miniaturas.TAMANHOS)}'}), 400
+        
+        dados = None
+        if firestore_disponivel:
+            try:
+                doc = db.collection('analises_imagens').document(doc_id).get(['miniaturas', 'miniaturas_base64'])
+                dados = doc.to_dict() if doc.exists else None
+            except Exception as e:
+                logger.warning(f"Firestore falhou: {e}, usando arquivo local")
+        
+        # Fallback: arquivo local
+        miniatura_bytes = None
+        if dados is None:
+            dados = armazenamento.obter(doc_id)
+            if dados is not None:
+                miniatura_bytes = armazenamento.imagem(doc_id, tamanho)
+        
+        if dados is None:
+            return jsonify({'erro': 'Imagem não encontrada'}), 404
+        
+        caminho = (dados.get('miniaturas') or {}).get(tamanho)
+        if caminho and storage_disponivel:
+            imagem_bytes = armazenamento_imagens.ler_imagem(bucket, caminho)
+            return send_file(BytesIO(imagem_bytes), mimetype=miniaturas.tipo_conteudo(caminho), max_age=86400)
+        
+        miniatura_base64 = (dados.get('miniaturas_base64') or {}).get(tamanho)
+        if miniatura_base64:
+            miniatura_bytes = base64.b64decode(miniatura_base64)
+        
+        if miniatura_bytes:
+            return send_file(
+                BytesIO(miniatura_bytes),
+                mimetype=miniaturas.tipo_conteudo('.' + miniaturas.FORMATO.lower()),
+                max_age=86400
+            )
+        
+        return redirect(url_for('api_imagem', doc_id=doc_id))
+        
+    except Exception as e:
+        logger.error(f"Erro ao obter miniatura: {str(e)}")
+        return jsonify({'erro': str(e)}), 500
+
+
+def _responder_imagem(imagem_bytes, content_type):
+    """Enviar os bytes da imagem (ou JSON base64 com ?formato=base64)"""
+    if request.args.get('formato') == 'base64':
+        return jsonify({'imagem_base64': base64.b64encode(imagem_bytes).decode('utf-8')}), 200
+    
+    return send_file(BytesIO(imagem_bytes), mimetype=content_type or 'image/jpeg', max_age=86400)
+
+
 @app.route('/api/imagem/<doc_id>', methods=['DELETE'])
 def deletar_imagem(doc_id):
     """Eliminar uma imagem e seus dados"""
@@ -1255,20 +1533,18 @@ def deletar_imagem(doc_id):
         if firestore_disponivel:
             try:
                 db.collection('analises_imagens').document(doc_id).delete()
+                if storage_disponivel:
+                    armazenamento_imagens.apagar_imagens(bucket, doc_id)
                 logger.info(f"Imagem eliminada: {doc_id}")
                 return jsonify({'sucesso': True, 'mensagem': 'Imagem eliminada'}), 200
             except Exception as e:
                 logger.warning(f"Firestore falhou: {e}, usando arquivo local")
         
         # Fallback: arquivo local
-        if os.path.exists(DADOS_LOCAL):
-            with open(DADOS_LOCAL, 'r', encoding='utf-8') as f:
-                resultados = json.load(f)
-            
-            resultados = [r for r in resultados if r.get('id') != doc_id]
-            
-            with open(DADOS_LOCAL, 'w', encoding='utf-8') as f:
-                json.dump(resultados, f, indent=2, ensure_ascii=False)
+        if armazenamento.apagar(doc_id):
+            indice = _indice_local()
+            if indice is not None:
+                indice.remover(doc_id)
             
             logger.info(f"Imagem eliminada localmente: {doc_id}")
             return jsonify({'sucesso': True, 'mensagem': 'Imagem eliminada'}), 200
@@ -1282,43 +1558,55 @@ def deletar_imagem(doc_id):
 
 @app.route('/api/limpar-tudo', methods=['POST'])
 def limpar_tudo():
-    """Eliminar TODAS as imagens e dados da base de dados"""
+    """
+    Eliminar TODAS as imagens e dados da base de dados
+    Com Firestore corre em segundo plano; o progresso é consultado em /api/jobs/<job_id>
+    """
     try:
         if firestore_disponivel:
             try:
-                # Tentar apagar do Firestore
-                docs = db.collection('analises_imagens').stream()
-                contador = 0
-                for doc in docs:
-                    doc.reference.delete()
-                    contador += 1
-                
-                logger.info(f"Base de dados Firestore limpa: {contador} imagens eliminadas")
-                return jsonify({'sucesso': True, 'mensagem': f'{contador} imagens eliminadas', 'total': contador}), 200
+                tarefa = registo_tarefas.criar(
+                    'limpar_tudo', limpeza.apagar_analises, db, bucket if storage_disponivel else None
+                )
+                return jsonify({'sucesso': True, 'mensagem': 'Limpeza iniciada', 'job_id': tarefa.id}), 202
             except Exception as e:
                 logger.warning(f"Firestore falhou: {e}, usando arquivo local")
         
         # Fallback: arquivo local
-        if os.path.exists(DADOS_LOCAL):
-            contador = 0
-            with open(DADOS_LOCAL, 'r', encoding='utf-8') as f:
-                resultados = json.load(f)
-                contador = len(resultados)
-            
-            # Limpar arquivo
-            with open(DADOS_LOCAL, 'w', encoding='utf-8') as f:
-                json.dump([], f, indent=2, ensure_ascii=False)
-            
-            logger.info(f"Base de dados local limpa: {contador} imagens eliminadas")
-            return jsonify({'sucesso': True, 'mensagem': f'{contador} imagens eliminadas', 'total': contador}), 200
+        contador = armazenamento.limpar()
+        indice = _indice_local()
+        if indice is not None:
+            indice.limpar()
         
-        return jsonify({'sucesso': True, 'mensagem': '0 imagens eliminadas', 'total': 0}), 200
+        logger.info(f"Base de dados local limpa: {contador} imagens eliminadas")
+        return jsonify({'sucesso': True, 'mensagem': f'{contador} imagens eliminadas', 'total': contador}), 200
         
     except Exception as e:
         logger.error(f"Erro ao limpar base de dados: {str(e)}")
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    """Estado e progresso de uma tarefa em segundo plano"""
+    tarefa = registo_tarefas.obter(job_id)
+    if tarefa is None:
+        return jsonify({'erro': 'Tarefa não encontrada'}), 404
+    return jsonify(tarefa), 200
+
+
+@app.route('/api/cache/estatisticas', methods=['GET'])
+def estatisticas_cache():
+    """Acertos/falhas da cache de resultados Vision"""
+    return jsonify(cache_vision.estatisticas()), 200
+
+
+@app.route('/api/vision/estatisticas', methods=['GET'])
+def estatisticas_vision():
+    """Bytes poupados pela normalização das imagens antes da Vision API"""
+    return jsonify({'normalizacao': normalizacao.estatisticas()}), 200
+
+
 # ============================================================================
 # EXECUTAR APP
 # ============================================================================
@@ -0,0 +1,125 @@
+"""
+Armazenamento das Imagens Analisadas no Cloud Storage
+Cada análise guarda a imagem uma única vez em imagens/<doc_id>/ no bucket;
+o documento Firestore fica só com a referência do blob e metadados
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import mimetypes
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Pasta do bucket com as imagens das análises (ignorada pela Cloud Function)
+PASTA_IMAGENS = "imagens/"
+
+# Máximo de operações por pedido batch do Cloud Storage
+TAMANHO_LOTE_STORAGE = 100
+
+# Blocos dos uploads resumíveis a partir de ficheiros (múltiplo de 256 KB)
+TAMANHO_BLOCO_UPLOAD = 8 * 1024 * 1024
+
+
+def pasta_analise(doc_id):
+    """Prefixo dos blobs de uma análise"""
+    return f"{PASTA_IMAGENS}{doc_id}/"
+
+
+def tipo_conteudo(nome_arquivo):
+    """Content-Type a partir da extensão do arquivo"""
+    return mimetypes.guess_type(nome_arquivo)[0] or 'application/octet-stream'
+
+
+def guardar_imagem(bucket, doc_id, nome_arquivo, imagem_bytes):
+    """
+    Enviar a imagem original para o bucket
+    Retorna os campos a guardar no documento Firestore
+    """
+    ext = os.path.splitext(nome_arquivo)[1].lower()
+    caminho = f"{pasta_analise(doc_id)}original{ext}"
+    content_type = tipo_conteudo(nome_arquivo)
+
+    blob = bucket.blob(caminho)
+    blob.cache_control = 'private, max-age=86400'
+    blob.upload_from_string(imagem_bytes, content_type=content_type)
+    logger.info(f"Imagem guardada no Storage: {caminho} ({len(imagem_bytes)} bytes)")
+
+    return {
+        'imagem_blob': caminho,
+        'imagem_content_type': content_type,
+        'imagem_tamanho': len(imagem_bytes)
+    }
+
+
+def guardar_ficheiro(bucket, doc_id, nome_arquivo, caminho_local):
+    """
+    Enviar a imagem original a partir de um ficheiro local, em blocos
+    (upload resumível; a imagem não é lida toda para memória)
+    Retorna os mesmos campos que guardar_imagem()
+    """
+    ext = os.path.splitext(nome_arquivo)[1].lower()
+    caminho = f"{pasta_analise(doc_id)}original{ext}"
+    content_type = tipo_conteudo(nome_arquivo)
+    tamanho = os.path.getsize(caminho_local)
+
+    blob = bucket.blob(caminho, chunk_size=TAMANHO_BLOCO_UPLOAD)
+    blob.cache_control = 'private, max-age=86400'
+    blob.upload_from_filename(caminho_local, content_type=content_type)
+    logger.info(f"Imagem guardada no Storage: {caminho} ({tamanho} bytes)")
+
+    return {
+        'imagem_blob': caminho,
+        'imagem_content_type': content_type,
+        'imagem_tamanho': tamanho
+    }
+
+
+def ler_imagem(bucket, caminho):
+    """Ler os bytes de um blob de imagem"""
+    return bucket.blob(caminho).download_as_bytes()
+
+
+def apagar_imagens(bucket, doc_id):
+    """Apagar todos os blobs de uma análise (original e derivados)"""
+    blobs = list(bucket.list_blobs(prefix=pasta_analise(doc_id)))
+    if blobs:
+        bucket.delete_blobs(blobs)
+    return len(blobs)
+
+
+def apagar_todas_imagens(bucket, progresso=None, paralelo=8):
+    """
+    Apagar todos os blobs da pasta de imagens
+    Os blobs são apagados em pedidos batch de 100 operações, vários em paralelo;
+    progresso(total) é chamado à medida que cada lote termina
+    """
+    total = 0
+    lock = threading.Lock()
+
+    def apagar_lote(blobs):
+        nonlocal total
+        try:
+            with bucket.client.batch():
+                for blob in blobs:
+                    blob.delete()
+        except Exception as e:
+            # Algum blob já não existia: apagar o lote um a um
+            logger.warning(f"Lote de remoção falhou ({e}), a apagar individualmente")
+            bucket.delete_blobs(blobs, on_error=lambda blob: None)
+        with lock:
+            total += len(blobs)
+            if progresso:
+                progresso(total)
+
+    with ThreadPoolExecutor(max_workers=paralelo) as executor:
+        lote = []
+        for blob in bucket.list_blobs(prefix=PASTA_IMAGENS):
+            lote.append(blob)
+            if len(lote) == TAMANHO_LOTE_STORAGE:
+                executor.submit(apagar_lote, lote)
+                lote = []
+        if lote:
+            executor.submit(apagar_lote, lote)
+
+    return total
@@ -0,0 +1,506 @@
+"""
+Armazenamento Local das Análises (modo sem Firestore)
+Dois backends com a mesma interface, escolhidos com ARMAZENAMENTO_LOCAL:
+
+'log' (predefinido) - log de registos só de acréscimo: cada escrita acrescenta uma
+linha ao ficheiro e um índice em memória (id -> posição no ficheiro) dá acesso
+direto a cada registo. As remoções escrevem uma marca (tombstone) e a compactação
+em segundo plano reescreve o ficheiro só com os registos vivos quando há
+demasiado espaço morto. Formato de cada linha:
+    put<TAB>id<TAB>meta-json<TAB>registo-json
+    del<TAB>id
+'meta' tem só os campos usados em listagens/índices, para que a abertura do
+ficheiro não tenha de ler os registos completos (com as imagens)
+
+'sqlite' - base de dados SQLite em modo WAL com colunas indexadas (id,
+data_processamento, phash) e as imagens numa tabela separada; pode ser partilhada
+por vários processos (ex: workers do gunicorn)
+"""
+from collections import OrderedDict
+import base64
+import bisect
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import paginacao
+
+logger = logging.getLogger(__name__)
+
+# Campos do registo mantidos no índice em memória
+CAMPOS_INDICE = ('data_processamento', 'phash')
+
+# Backend e ficheiros
+ARMAZENAMENTO_LOCAL = os.environ.get('ARMAZENAMENTO_LOCAL', 'log')
+CAMINHOS = {
+    'log': 'analises_imagens.log',
+    'sqlite': 'analises_imagens.db',
+}
+
+# Campos do registo com as imagens em base64 (tabela 'imagens' no SQLite)
+CAMPO_IMAGEM = 'imagem_base64'
+CAMPO_MINIATURAS = 'miniaturas_base64'
+ORIGINAL = 'original'
+
+# Partes do phash (hexadecimal, 16 caracteres) indexadas no SQLite: as 4 bandas de 16 bits
+# de hash_perceptual.bandas(), para procurar quase duplicados na própria base de dados
+BANDAS_PHASH = (1, 5, 9, 13)
+
+# Compactar quando o espaço morto ultrapassa esta fração do ficheiro (e o mínimo em bytes)
+LIMIAR_COMPACTACAO = 0.5
+MIN_BYTES_COMPACTACAO = 1024 * 1024
+
+
+class _Observavel:
+    """
+    Funções chamadas depois de cada alteração feita por este processo:
+    funcao(tipo, doc_id, registo) com tipo 'inserido', 'apagado' ou 'limpo'
+    """
+
+    def observar(self, funcao):
+        self.__dict__.setdefault('_observadores', []).append(funcao)
+
+    def _notificar(self, tipo, doc_id=None, registo=None):
+        for funcao in self.__dict__.get('_observadores', ()):
+            try:
+                funcao(tipo, doc_id, registo)
+            except Exception as e:
+                logger.warning(f"Erro num observador do armazenamento local: {e}")
+
+
+class ArmazenamentoLog(_Observavel):
+    """Registos de análises num log local com índice em memória por id"""
+
+    def __init__(self, caminho, json_antigo=None):
+        self.caminho = caminho
+        self._indice = OrderedDict()  # id -> (posição, tamanho, meta)
+        self._chaves = []  # (data_processamento, id) em ordem crescente, para a paginação
+        self._bytes_mortos = 0
+        self._fim = 0
+        self._compactando = False
+        self._geracao = 0  # incrementada por limpar(): invalida uma compactação em curso
+        self._lock = threading.RLock()
+
+        self._carregar()
+        self._escritor = open(self.caminho, 'ab')
+        self._leitor = open(self.caminho, 'rb')
+
+        # Importar o antigo ficheiro JSON (lista com o mais recente primeiro)
+        if json_antigo and not self._indice and os.path.exists(json_antigo):
+            with open(json_antigo, 'r', encoding='utf-8') as f:
+                registos = json.load(f)
+            for registo in reversed(registos):
+                self.inserir(registo)
+            logger.info(f"Importados {len(registos)} registos de {json_antigo}")
+
+    # ------------------------------------------------------------------------
+    # Operações
+    # ------------------------------------------------------------------------
+
+    def inserir(self, registo):
+        """Acrescentar um registo (tem de ter 'id'); O(1)"""
+        doc_id = registo['id']
+        meta = {campo: registo[campo] for campo in CAMPOS_INDICE if campo in registo}
+        linha = b'\t'.join([
+            b'put',
+            doc_id.encode('utf-8'),
+            json.dumps(meta, ensure_ascii=False).encode('utf-8'),
+            json.dumps(registo, ensure_ascii=False).encode('utf-8')
+        ]) + b'\n'
+
+        with self._lock:
+            anterior = self._indice.get(doc_id)
+            self._escrever(linha)
+            self._aplicar(self._indice, linha, self._fim - len(linha))
+            if anterior is not None:
+                self._remover_chave(doc_id, anterior[2])
+            bisect.insort(self._chaves, _chave(doc_id, meta))
+        self._notificar('inserido', doc_id, registo)
+
+    def obter(self, doc_id):
+        """Ler um registo pelo id; O(1). None se não existir"""
+        with self._lock:
+            entrada = self._indice.get(doc_id)
+            if entrada is None:
+                return None
+            posicao, tamanho, _ = entrada
+            self._leitor.seek(posicao)
+            linha = self._leitor.read(tamanho)
+
+        return json.loads(linha.split(b'\t', 3)[3])
+
+    def apagar(self, doc_id):
+        """Marcar um registo como apagado; retorna False se não existia"""
+        with self._lock:
+            if doc_id not in self._indice:
+                return False
+            linha = b'del\t' + doc_id.encode('utf-8') + b'\n'
+            self._remover_chave(doc_id, self._indice[doc_id][2])
+            self._escrever(linha)
+            self._bytes_mortos += self._aplicar(self._indice, linha, self._fim - len(linha))
+            self._talvez_compactar()
+        self._notificar('apagado', doc_id)
+        return True
+
+    def limpar(self):
+        """Apagar todos os registos (trunca o ficheiro); retorna quantos existiam"""
+        with self._lock:
+            total = len(self._indice)
+            self._escritor.truncate(0)
+            self._escritor.flush()
+            # O buffer do leitor ainda tem os bytes antigos: reabrir, como na compactação
+            self._leitor.close()
+            self._leitor = open(self.caminho, 'rb')
+            self._indice.clear()
+            self._chaves.clear()
+            self._bytes_mortos = 0
+            self._fim = 0
+            self._geracao += 1
+        self._notificar('limpo')
+        return total
+
+    def listar(self, limit, cursor=None):
+        """
+        Página de registos do mais recente para o mais antigo
+        Retorna (registos, proximo_cursor) com o mesmo cursor de paginacao.py
+        """
+        with self._lock:
+            pagina, proximo_cursor = paginacao.pagina_local(self._chaves, limit, cursor)
+
+        registos = [self.obter(doc_id) for _, doc_id in pagina]
+        return [registo for registo in registos if registo is not None], proximo_cursor
+
+    def valores(self, campo):
+        """Pares (id, valor) de um campo do índice (ver CAMPOS_INDICE)"""
+        with self._lock:
+            return [
+                (doc_id, meta[campo])
+                for doc_id, (_, _, meta) in self._indice.items() if campo in meta
+            ]
+
+    def imagem(self, doc_id, nome=ORIGINAL):
+        """Bytes da imagem original ou de uma miniatura; None se não existir"""
+        registo = self.obter(doc_id)
+        if registo is None:
+            return None
+        return _imagem_registo(registo, nome)
+
+    def __len__(self):
+        return len(self._indice)
+
+    # ------------------------------------------------------------------------
+    # Log e índice
+    # ------------------------------------------------------------------------
+
+    def _remover_chave(self, doc_id, meta):
+        """Retirar um registo da lista ordenada de chaves (chamar com o lock)"""
+        chave = _chave(doc_id, meta)
+        posicao = bisect.bisect_left(self._chaves, chave)
+        if posicao < len(self._chaves) and self._chaves[posicao] == chave:
+            del self._chaves[posicao]
+
+    def _escrever(self, linha):
+        self._escritor.write(linha)
+        self._escritor.flush()
+        self._fim += len(linha)
+
+    @staticmethod
+    def _aplicar(indice, linha, posicao):
+        """Aplicar uma linha do log ao índice; retorna os bytes que deixaram de estar vivos"""
+        partes = linha.rstrip(b'\n').split(b'\t', 3)
+        operacao, doc_id = partes[0], partes[1].decode('utf-8')
+
+        anterior = indice.pop(doc_id, None)
+        mortos = anterior[1] if anterior else 0
+
+        if operacao == b'put':
+            indice[doc_id] = (posicao, len(linha), json.loads(partes[2]))
+        else:
+            mortos += len(linha)
+
+        return mortos
+
+    def _carregar(self):
+        """Reconstruir o índice lendo só o cabeçalho de cada linha"""
+        if not os.path.exists(self.caminho):
+            return
+
+        posicao = 0
+        with open(self.caminho, 'rb') as f:
+            for linha in f:
+                if not linha.endswith(b'\n'):
+                    break  # Escrita interrompida a meio
+                self._bytes_mortos += self._aplicar(self._indice, linha, posicao)
+                posicao += len(linha)
+
+        if posicao != os.path.getsize(self.caminho):
+            logger.warning(f"Linha incompleta no fim de {self.caminho}, a truncar")
+            with open(self.caminho, 'r+b') as f:
+                f.truncate(posicao)
+
+        self._fim = posicao
+        self._chaves = sorted(_chave(doc_id, meta) for doc_id, (_, _, meta) in self._indice.items())
+        logger.info(f"Armazenamento local: {len(self._indice)} registos em {self.caminho}")
+
+    # ------------------------------------------------------------------------
+    # Compactação
+    # ------------------------------------------------------------------------
+
+    def _talvez_compactar(self):
+        if self._compactando or self._fim < MIN_BYTES_COMPACTACAO:
+            return
+        if self._bytes_mortos / self._fim < LIMIAR_COMPACTACAO:
+            return
+
+        self._compactando = True
+        threading.Thread(target=self._compactar, name='compactacao-log', daemon=True).start()
+
+    def _compactar(self):
+        """
+        Copiar os registos vivos para um novo ficheiro sem bloquear as escritas;
+        no fim, com o lock, copiar também o que foi escrito entretanto e trocar os ficheiros
+        Se o log foi limpo durante a cópia (geração diferente) a compactação é abandonada
+        """
+        temporario = self.caminho + '.compactar'
+        try:
+            with self._lock:
+                vivos = list(self._indice.items())
+                fim = self._fim
+                geracao = self._geracao
+
+            novo_indice = OrderedDict()
+            posicao = 0
+            with open(self.caminho, 'rb') as origem, open(temporario, 'wb') as destino:
+                for doc_id, (inicio, tamanho, meta) in vivos:
+                    origem.seek(inicio)
+                    destino.write(origem.read(tamanho))
+                    novo_indice[doc_id] = (posicao, tamanho, meta)
+                    posicao += tamanho
+
+                with self._lock:
+                    if self._geracao != geracao:
+                        logger.info("Log limpo durante a compactação, compactação abandonada")
+                        destino.close()
+                        os.remove(temporario)
+                        return
+
+                    # Escritas feitas durante a cópia
+                    origem.seek(fim)
+                    mortos = 0
+                    for linha in origem.read(self._fim - fim).splitlines(keepends=True):
+                        destino.write(linha)
+                        mortos += self._aplicar(novo_indice, linha, posicao)
+                        posicao += len(linha)
+                    destino.flush()
+                    os.fsync(destino.fileno())
+
+                    self._escritor.close()
+                    self._leitor.close()
+                    origem.close()
+                    destino.close()
+                    os.replace(temporario, self.caminho)
+                    self._escritor = open(self.caminho, 'ab')
+                    self._leitor = open(self.caminho, 'rb')
+
+                    antes = self._fim
+                    self._indice = novo_indice
+                    self._fim = posicao
+                    self._bytes_mortos = mortos
+
+            logger.info(f"Log compactado: {antes} -> {posicao} bytes")
+
+        except Exception as e:
+            logger.error(f"Erro na compactação do log: {e}")
+            if os.path.exists(temporario):
+                os.remove(temporario)
+        finally:
+            self._compactando = False
+
+
+class ArmazenamentoSQLite(_Observavel):
+    """Registos de análises em SQLite (WAL), com a mesma interface de ArmazenamentoLog"""
+
+    def __init__(self, caminho, json_antigo=None):
+        self.caminho = caminho
+        self._local = threading.local()
+
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS analises ('
+                'id TEXT PRIMARY KEY, data_processamento TEXT NOT NULL, phash TEXT, dados TEXT NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_analises_data ON analises (data_processamento, id)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_analises_phash ON analises (phash)')
+            for inicio in BANDAS_PHASH:
+                conn.execute(
+                    f'CREATE INDEX IF NOT EXISTS idx_analises_phash_{inicio} ON analises (substr(phash, {inicio}, 4))'
+                )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS imagens ('
+                'analise_id TEXT NOT NULL, nome TEXT NOT NULL, dados BLOB NOT NULL, '
+                'PRIMARY KEY (analise_id, nome))'
+            )
+
+        # Importar o antigo ficheiro JSON (lista com o mais recente primeiro)
+        if json_antigo and not len(self) and os.path.exists(json_antigo):
+            with open(json_antigo, 'r', encoding='utf-8') as f:
+                registos = json.load(f)
+            with conn:
+                for registo in registos:
+                    self._inserir(conn, registo)
+            logger.info(f"Importados {len(registos)} registos de {json_antigo}")
+
+        logger.info(f"Armazenamento local: {len(self)} registos em {self.caminho}")
+
+    def _conn(self):
+        """Uma ligação por thread (em WAL as leituras não bloqueiam a escrita)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.caminho, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------------
+    # Operações
+    # ------------------------------------------------------------------------
+
+    def inserir(self, registo):
+        """Inserir (ou substituir) um registo; as imagens vão para a tabela 'imagens'"""
+        conn = self._conn()
+        with conn:
+            self._inserir(conn, registo)
+        self._notificar('inserido', registo['id'], registo)
+
+    def obter(self, doc_id):
+        """Registo sem as imagens; None se não existir"""
+        linha = self._conn().execute(
+            'SELECT dados FROM analises WHERE id = ?', (doc_id,)
+        ).fetchone()
+        return json.loads(linha[0]) if linha else None
+
+    def apagar(self, doc_id):
+        """Apagar um registo e as suas imagens; retorna False se não existia"""
+        conn = self._conn()
+        with conn:
+            apagados = conn.execute('DELETE FROM analises WHERE id = ?', (doc_id,)).rowcount
+            conn.execute('DELETE FROM imagens WHERE analise_id = ?', (doc_id,))
+        if apagados:
+            self._notificar('apagado', doc_id)
+        return apagados > 0
+
+    def limpar(self):
+        """Apagar todos os registos; retorna quantos existiam"""
+        conn = self._conn()
+        with conn:
+            total = conn.execute('DELETE FROM analises').rowcount
+            conn.execute('DELETE FROM imagens')
+        self._notificar('limpo')
+        return total
+
+    def listar(self, limit, cursor=None):
+        """
+        Página de registos do mais recente para o mais antigo (pelo índice de data)
+        Retorna (registos, proximo_cursor) com o mesmo cursor de paginacao.py
+        """
+        if cursor:
+            data_processamento, doc_id = paginacao.decodificar_cursor(cursor)
+            linhas = self._conn().execute(
+                'SELECT dados FROM analises WHERE (data_processamento, id) < (?, ?) '
+                'ORDER BY data_processamento DESC, id DESC LIMIT ?',
+                (data_processamento, doc_id, limit + 1)
+            ).fetchall()
+        else:
+            linhas = self._conn().execute(
+                'SELECT dados FROM analises ORDER BY data_processamento DESC, id DESC LIMIT ?',
+                (limit + 1,)
+            ).fetchall()
+
+        registos = [json.loads(linha[0]) for linha in linhas[:limit]]
+
+        proximo_cursor = None
+        if len(linhas) > limit:
+            ultimo = registos[-1]
+            proximo_cursor = paginacao.codificar_cursor(ultimo['data_processamento'], ultimo['id'])
+
+        return registos, proximo_cursor
+
+    def valores(self, campo):
+        """Pares (id, valor) de um campo indexado (ver CAMPOS_INDICE)"""
+        if campo not in CAMPOS_INDICE:
+            raise ValueError(f'Campo não indexado: {campo}')
+        return self._conn().execute(
+            f'SELECT id, {campo} FROM analises WHERE {campo} IS NOT NULL'
+        ).fetchall()
+
+    def candidatos_phash(self, phash):
+        """
+        Pares (id, phash) dos registos que partilham pelo menos uma banda com 'phash'
+        (um índice por banda); lidos da base de dados, por isso veem as escritas de outros processos
+        """
+        condicoes = ' OR '.join(f'substr(phash, {inicio}, 4) = ?' for inicio in BANDAS_PHASH)
+        return self._conn().execute(
+            f'SELECT id, phash FROM analises WHERE {condicoes}',
+            [phash[inicio - 1:inicio + 3] for inicio in BANDAS_PHASH]
+        ).fetchall()
+
+    def imagem(self, doc_id, nome=ORIGINAL):
+        """Bytes da imagem original ou de uma miniatura; None se não existir"""
+        linha = self._conn().execute(
+            'SELECT dados FROM imagens WHERE analise_id = ? AND nome = ?', (doc_id, nome)
+        ).fetchone()
+        return linha[0] if linha else None
+
+    def __len__(self):
+        return self._conn().execute('SELECT COUNT(*) FROM analises').fetchone()[0]
+
+    @staticmethod
+    def _inserir(conn, registo):
+        registo = dict(registo)
+        imagens = {
+            nome: base64.b64decode(dados)
+            for nome, dados in (registo.pop(CAMPO_MINIATURAS, None) or {}).items()
+        }
+        if registo.get(CAMPO_IMAGEM):
+            imagens[ORIGINAL] = base64.b64decode(registo[CAMPO_IMAGEM])
+        registo.pop(CAMPO_IMAGEM, None)
+
+        conn.execute(
+            'INSERT OR REPLACE INTO analises (id, data_processamento, phash, dados) VALUES (?, ?, ?, ?)',
+            (registo['id'], registo.get('data_processamento', ''), registo.get('phash'),
+             json.dumps(registo, ensure_ascii=False))
+        )
+        conn.execute('DELETE FROM imagens WHERE analise_id = ?', (registo['id'],))
+        conn.executemany(
+            'INSERT INTO imagens (analise_id, nome, dados) VALUES (?, ?, ?)',
+            [(registo['id'], nome, dados) for nome, dados in imagens.items()]
+        )
+
+
+def _chave(doc_id, meta):
+    """Chave de ordenação das listagens (a mesma do cursor de paginacao.py)"""
+    return (meta.get('data_processamento', ''), doc_id)
+
+
+def _imagem_registo(registo, nome):
+    """Bytes de uma imagem guardada em base64 dentro do registo"""
+    if nome == ORIGINAL:
+        dados = registo.get(CAMPO_IMAGEM)
+    else:
+        dados = (registo.get(CAMPO_MINIATURAS) or {}).get(nome)
+    return base64.b64decode(dados) if dados else None
+
+
+def abrir_armazenamento(tipo=ARMAZENAMENTO_LOCAL, json_antigo=None):
+    """Criar o backend local configurado ('log' ou 'sqlite')"""
+    if tipo == 'sqlite':
+        return ArmazenamentoSQLite(CAMINHOS['sqlite'], json_antigo=json_antigo)
+    if tipo != 'log':
+        raise ValueError(f'ARMAZENAMENTO_LOCAL inválido: {tipo}. Use: {list(CAMINHOS)}')
+    return ArmazenamentoLog(CAMINHOS['log'], json_antigo=json_antigo)
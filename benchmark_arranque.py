@@ -0,0 +1,102 @@
+"""
+Benchmark de Arranque a Frio
+Mede, num processo Python novo para cada repetição, o tempo desde o início do
+import do módulo até à primeira resposta (um pedido que não precisa de clientes
+Google Cloud, ou um evento ignorado na Cloud Function) e os clientes criados
+
+Uso:
+    python benchmark_arranque.py                      # todos os módulos, 5 repetições
+    python benchmark_arranque.py app upload_api -n 10
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# Código executado no processo novo: importar o módulo e obter a primeira resposta
+ALVOS = {
+    'cloud_function_main': (
+        "import types\n"
+        "import cloud_function_main as m\n"
+        "FIM_IMPORT = time.perf_counter()\n"
+        "m.processar_imagem(types.SimpleNamespace(data={'bucket': 'bucket', 'name': 'leia-me.txt'}))\n"
+    ),
+    'app': (
+        "import app as m\n"
+        "FIM_IMPORT = time.perf_counter()\n"
+        "m.app.test_client().get('/api/jobs')\n"
+    ),
+    'api_resultados': (
+        "import api_resultados as m\n"
+        "FIM_IMPORT = time.perf_counter()\n"
+        "m.app.test_client().get('/health')\n"
+    ),
+    'upload_api': (
+        "import upload_api as m\n"
+        "FIM_IMPORT = time.perf_counter()\n"
+        "m.app.test_client().get('/health')\n"
+    ),
+    'notificacoes': (
+        "import notificacoes as m\n"
+        "FIM_IMPORT = time.perf_counter()\n"
+    ),
+}
+
+_MEDICAO = (
+    "import time, json, logging\n"
+    "logging.disable(logging.CRITICAL)\n"
+    "INICIO = time.perf_counter()\n"
+    "{codigo}"
+    "FIM = time.perf_counter()\n"
+    "import clientes\n"
+    "print(json.dumps({{'importar_ms': (FIM_IMPORT - INICIO) * 1000, "
+    "'primeira_resposta_ms': (FIM - INICIO) * 1000, 'clientes': clientes.criados()}}))\n"
+)
+
+
+def medir(alvo):
+    """Uma medição num processo novo; retorna o dict impresso pelo processo (+ tempo total)"""
+    inicio = time.perf_counter()
+    processo = subprocess.run(
+        [sys.executable, '-c', _MEDICAO.format(codigo=ALVOS[alvo])],
+        capture_output=True, text=True
+    )
+    total = (time.perf_counter() - inicio) * 1000
+
+    if processo.returncode != 0:
+        raise RuntimeError(processo.stderr.strip().splitlines()[-1] if processo.stderr else 'erro')
+
+    resultado = json.loads(processo.stdout.strip().splitlines()[-1])
+    resultado['processo_ms'] = total
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tempo de arranque a frio até à primeira resposta')
+    parser.add_argument('alvos', nargs='*', help=f"módulos a medir (por omissão todos: {', '.join(ALVOS)})")
+    parser.add_argument('-n', '--repeticoes', type=int, default=5)
+    args = parser.parse_args()
+
+    desconhecidos = set(args.alvos) - set(ALVOS)
+    if desconhecidos:
+        parser.error(f"módulos desconhecidos: {', '.join(sorted(desconhecidos))}")
+
+    print(f"{'módulo':<22}{'import':>10}{'1ª resposta':>14}{'processo':>12}  clientes criados")
+    for alvo in args.alvos or ALVOS:
+        try:
+            medicoes = [medir(alvo) for _ in range(args.repeticoes)]
+        except RuntimeError as e:
+            print(f"{alvo:<22}  erro: {e}")
+            continue
+
+        mediana = lambda campo: statistics.median(m[campo] for m in medicoes)
+        print(
+            f"{alvo:<22}{mediana('importar_ms'):>8.0f}ms{mediana('primeira_resposta_ms'):>12.0f}ms"
+            f"{mediana('processo_ms'):>10.0f}ms  {', '.join(medicoes[-1]['clientes']) or '-'}"
+        )
+
+
+if __name__ == '__main__':
+    main()
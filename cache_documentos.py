@@ -0,0 +1,134 @@
+"""
+Cache de Documentos de Análise (read-through)
+LRU em memória com TTL à frente das leituras de 'analises_imagens/<doc_id>'
+As análises não mudam depois de processadas, por isso as entradas só
+precisam de ser invalidadas quando o documento é apagado (ou, durante uma
+limpeza geral, a cache é posta de lado com suspensa())
+A cache é por processo: invalidar() só chega à cache do processo que apagou.
+Um documento apagado por outro processo (app.py e api_resultados.py, ou outro
+worker do gunicorn) continua a ser servido até a entrada expirar, por isso o
+TTL por omissão é curto (CACHE_DOCS_TTL, em segundos)
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Configuração
+CACHE_DOCS_MAX_ENTRADAS = int(os.environ.get('CACHE_DOCS_MAX_ENTRADAS', 1000))
+CACHE_DOCS_MAX_BYTES = int(os.environ.get('CACHE_DOCS_MAX_MB', 64)) * 1024 * 1024
+CACHE_DOCS_TTL = int(os.environ.get('CACHE_DOCS_TTL', 30))
+
+
+def _tamanho(dados):
+    """Tamanho aproximado de um documento em bytes (serializado em JSON)"""
+    return len(json.dumps(dados, default=str, ensure_ascii=False).encode('utf-8'))
+
+
+class CacheDocumentos:
+    """
+    obter(doc_id, carregar) devolve o documento da cache ou chama carregar(doc_id)
+    (que retorna o dict do documento, ou None se não existir) e guarda o resultado
+    Limitada em número de entradas e em bytes; cada chamada recebe uma cópia
+    """
+
+    def __init__(self, max_entradas=CACHE_DOCS_MAX_ENTRADAS, max_bytes=CACHE_DOCS_MAX_BYTES,
+                 ttl=CACHE_DOCS_TTL):
+        self.max_entradas = max_entradas
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.acertos = 0
+        self.falhas = 0
+        self.bytes = 0
+
+        self._entradas = OrderedDict()
+        self._suspensa = 0
+        self._geracao = 0  # incrementada por limpar(): descarta leituras feitas antes
+        self._lock = threading.Lock()
+
+    def obter(self, doc_id, carregar):
+        agora = time.time()
+
+        with self._lock:
+            entrada = self._entradas.get(doc_id)
+            if entrada is not None:
+                dados, tamanho, expira_em = entrada
+                if expira_em > agora:
+                    self._entradas.move_to_end(doc_id)
+                    self.acertos += 1
+                    return copy.deepcopy(dados)
+                self._remover(doc_id)
+            self.falhas += 1
+            geracao = self._geracao if not self._suspensa else None
+
+        dados = carregar(doc_id)
+        if dados is None:
+            return None
+        if geracao is None:
+            return dados
+
+        tamanho = _tamanho(dados)
+        if tamanho <= self.max_bytes:
+            with self._lock:
+                if geracao != self._geracao or self._suspensa:
+                    return copy.deepcopy(dados)
+                self._remover(doc_id)
+                self._entradas[doc_id] = (dados, tamanho, agora + self.ttl)
+                self.bytes += tamanho
+                while len(self._entradas) > self.max_entradas or self.bytes > self.max_bytes:
+                    antigo, _ = next(iter(self._entradas.items()))
+                    self._remover(antigo)
+
+        return copy.deepcopy(dados)
+
+    def invalidar(self, doc_id):
+        """Remover um documento da cache (ex: quando é apagado)"""
+        with self._lock:
+            self._remover(doc_id)
+
+    def limpar(self):
+        with self._lock:
+            self._entradas.clear()
+            self.bytes = 0
+            self._geracao += 1
+
+    @contextmanager
+    def suspensa(self):
+        """
+        Ler sempre da origem enquanto o bloco corre (ex: limpeza de todos os documentos),
+        sem guardar nada; à saída a cache é limpa
+        """
+        with self._lock:
+            self._suspensa += 1
+        self.limpar()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._suspensa -= 1
+            self.limpar()
+
+    def estatisticas(self):
+        """Taxa de acerto e memória ocupada"""
+        with self._lock:
+            total = self.acertos + self.falhas
+            return {
+                'acertos': self.acertos,
+                'falhas': self.falhas,
+                'taxa_acerto': self.acertos / total if total else 0,
+                'entradas': len(self._entradas),
+                'max_entradas': self.max_entradas,
+                'memoria_bytes': self.bytes,
+                'max_bytes': self.max_bytes
+            }
+
+    def _remover(self, doc_id):
+        entrada = self._entradas.pop(doc_id, None)
+        if entrada is not None:
+            self.bytes -= entrada[1]
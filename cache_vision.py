@@ -0,0 +1,211 @@
+"""
+Cache de Resultados da Vision API
+Chave = SHA-256 dos bytes da imagem + conjunto de features pedidas
+Dois níveis: LRU em memória (por processo) e um nível persistente
+(coleção Firestore 'vision_cache' ou ficheiro SQLite local)
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import base64
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Configuração
+CACHE_LOCAL_MAX = int(os.environ.get('VISION_CACHE_LOCAL_MAX', 1000))
+CACHE_TTL = int(os.environ.get('VISION_CACHE_TTL_DIAS', 30)) * 24 * 3600
+CACHE_SQLITE_MAX = int(os.environ.get('VISION_CACHE_SQLITE_MAX', 100000))
+COLECAO_CACHE = 'vision_cache'
+
+
+def chave_cache(imagem_bytes, features, completo=False):
+    """Chave determinística para os bytes da imagem e o conjunto de features"""
+    return chave_cache_sha256(hashlib.sha256(imagem_bytes).hexdigest(), features, completo)
+
+
+def chave_cache_sha256(digest, features, completo=False):
+    """Mesma chave a partir do SHA-256 já calculado (ex: durante a receção do upload)"""
+    sufixo = '-'.join(sorted(features))
+    if completo:
+        sufixo += '-completo'
+    return f"{digest}_{sufixo}"
+
+
+def chave_cache_objeto(md5_base64, features, completo=False):
+    """
+    Chave a partir do MD5 de um objeto do Cloud Storage (campo md5Hash do evento),
+    para usar a cache sem descarregar a imagem
+    """
+    digest = base64.b64decode(md5_base64).hex()
+    return chave_cache_sha256(f"md5-{digest}", features, completo)
+
+
+class CacheVision:
+    """
+    Cache de dois níveis para resultados da Vision API
+    obter() procura primeiro na memória e depois no nível persistente;
+    um acerto persistente é promovido para a memória
+    """
+
+    def __init__(self, persistente=None, local_max=CACHE_LOCAL_MAX, ttl=CACHE_TTL):
+        self.persistente = persistente
+        self.local_max = local_max
+        self.ttl = ttl
+        self.acertos_local = 0
+        self.acertos_persistente = 0
+        self.falhas = 0
+
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obter(self, chave):
+        """Retorna uma cópia dos resultados guardados ou None"""
+        agora = time.time()
+
+        with self._lock:
+            entrada = self._local.get(chave)
+            if entrada is not None:
+                resultados, expira_em = entrada
+                if expira_em > agora:
+                    self._local.move_to_end(chave)
+                    self.acertos_local += 1
+                    return copy.deepcopy(resultados)
+                del self._local[chave]
+
+        if self.persistente is not None:
+            try:
+                resultados = self.persistente.obter(chave)
+            except Exception as e:
+                logger.warning(f"Cache persistente indisponível: {e}")
+                resultados = None
+
+            if resultados is not None:
+                self._guardar_local(chave, resultados, agora + self.ttl)
+                with self._lock:
+                    self.acertos_persistente += 1
+                return copy.deepcopy(resultados)
+
+        with self._lock:
+            self.falhas += 1
+        return None
+
+    def guardar(self, chave, resultados):
+        """Guardar resultados nos dois níveis"""
+        resultados = copy.deepcopy(resultados)
+        self._guardar_local(chave, resultados, time.time() + self.ttl)
+
+        if self.persistente is not None:
+            try:
+                self.persistente.guardar(chave, resultados, self.ttl)
+            except Exception as e:
+                logger.warning(f"Não foi possível guardar na cache persistente: {e}")
+
+    def estatisticas(self):
+        """Contadores de acertos/falhas e taxa de acerto"""
+        with self._lock:
+            total = self.acertos_local + self.acertos_persistente + self.falhas
+            return {
+                'acertos_local': self.acertos_local,
+                'acertos_persistente': self.acertos_persistente,
+                'falhas': self.falhas,
+                'taxa_acerto': (self.acertos_local + self.acertos_persistente) / total if total else 0,
+                'entradas_local': len(self._local),
+                'local_max': self.local_max
+            }
+
+    def _guardar_local(self, chave, resultados, expira_em):
+        """Inserir no LRU em memória e remover as entradas mais antigas"""
+        with self._lock:
+            self._local[chave] = (resultados, expira_em)
+            self._local.move_to_end(chave)
+            while len(self._local) > self.local_max:
+                self._local.popitem(last=False)
+
+
+# ============================================================================
+# NÍVEIS PERSISTENTES
+# ============================================================================
+
+class CacheFirestore:
+    """
+    Nível persistente na coleção 'vision_cache'
+    O campo 'expira_em' pode ser usado numa política TTL do Firestore
+    para remover automaticamente as entradas expiradas
+    """
+
+    def __init__(self, db, colecao=COLECAO_CACHE):
+        self.db = db
+        self.colecao = colecao
+
+    def obter(self, chave):
+        doc = self.db.collection(self.colecao).document(chave).get()
+        if not doc.exists:
+            return None
+
+        dados = doc.to_dict()
+        if dados['expira_em'] <= datetime.now(timezone.utc):
+            return None
+        return dados['resultados']
+
+    def guardar(self, chave, resultados, ttl):
+        agora = datetime.now(timezone.utc)
+        self.db.collection(self.colecao).document(chave).set({
+            'resultados': resultados,
+            'criado_em': agora,
+            'expira_em': agora + timedelta(seconds=ttl)
+        })
+
+
+class CacheSQLite:
+    """
+    Nível persistente num ficheiro SQLite local
+    Entradas expiradas e as mais antigas acima de 'maximo' são removidas
+    periodicamente durante as escritas
+    """
+
+    def __init__(self, caminho='vision_cache.db', maximo=CACHE_SQLITE_MAX):
+        self.maximo = maximo
+        self._escritas = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS vision_cache ('
+            'chave TEXT PRIMARY KEY, resultados TEXT NOT NULL, expira_em REAL NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_vision_cache_expira ON vision_cache (expira_em)')
+        self._conn.commit()
+
+    def obter(self, chave):
+        with self._lock:
+            linha = self._conn.execute(
+                'SELECT resultados FROM vision_cache WHERE chave = ? AND expira_em > ?',
+                (chave, time.time())
+            ).fetchone()
+        return json.loads(linha[0]) if linha else None
+
+    def guardar(self, chave, resultados, ttl):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO vision_cache (chave, resultados, expira_em) VALUES (?, ?, ?)',
+                (chave, json.dumps(resultados, ensure_ascii=False), time.time() + ttl)
+            )
+            self._escritas += 1
+            if self._escritas % 100 == 0:
+                self._remover_antigas()
+            self._conn.commit()
+
+    def _remover_antigas(self):
+        """Remover entradas expiradas e manter no máximo 'maximo' entradas"""
+        self._conn.execute('DELETE FROM vision_cache WHERE expira_em <= ?', (time.time(),))
+        self._conn.execute(
+            'DELETE FROM vision_cache WHERE chave IN ('
+            'SELECT chave FROM vision_cache ORDER BY expira_em DESC LIMIT -1 OFFSET ?)',
+            (self.maximo,)
+        )
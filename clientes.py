@@ -0,0 +1,107 @@
+"""
+Clientes Google Cloud Partilhados
+Cada cliente (e o módulo google.cloud correspondente) só é criado na primeira
+utilização, uma única vez por processo, mesmo com várias threads. Os módulos
+guardam um ClientePreguicoso no lugar do cliente e usam-no como o original,
+por isso um arranque que só precisa do Firestore não paga Vision, Storage e Pub/Sub
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ClientePreguicoso:
+    """Cria o objeto com fabrica() no primeiro acesso a um atributo e delega-lhe todos os acessos"""
+
+    def __init__(self, fabrica, nome=None):
+        self._fabrica = fabrica
+        self._nome = nome or getattr(fabrica, '__name__', 'cliente')
+        self._objeto = None
+        self._lock = threading.Lock()
+
+    def obter(self):
+        """O objeto real (criado agora se ainda não existir)"""
+        if self._objeto is None:
+            with self._lock:
+                if self._objeto is None:
+                    inicio = time.perf_counter()
+                    self._objeto = self._fabrica()
+                    logger.info(f"Cliente {self._nome} criado ({(time.perf_counter() - inicio) * 1000:.0f} ms)")
+        return self._objeto
+
+    @property
+    def criado(self):
+        return self._objeto is not None
+
+    def __getattr__(self, atributo):
+        return getattr(self.obter(), atributo)
+
+
+def _storage(**kwargs):
+    from google.cloud import storage
+    return storage.Client(**kwargs)
+
+
+def _vision(**kwargs):
+    from google.cloud import vision
+    return vision.ImageAnnotatorClient(**kwargs)
+
+
+def _firestore(**kwargs):
+    from google.cloud import firestore
+    return firestore.Client(**kwargs)
+
+
+def _publisher(max_messages=None, max_bytes=None, max_latency=None, **kwargs):
+    """Os limites do lote (BatchSettings) são passados como argumentos simples"""
+    from google.cloud import pubsub_v1
+    lote = {chave: valor for chave, valor in
+            (('max_messages', max_messages), ('max_bytes', max_bytes), ('max_latency', max_latency))
+            if valor is not None}
+    if lote:
+        kwargs['batch_settings'] = pubsub_v1.types.BatchSettings(**lote)
+    return pubsub_v1.PublisherClient(**kwargs)
+
+
+def _subscriber(**kwargs):
+    from google.cloud import pubsub_v1
+    return pubsub_v1.SubscriberClient(**kwargs)
+
+
+FABRICAS = {
+    'storage': _storage,
+    'vision': _vision,
+    'firestore': _firestore,
+    'publisher': _publisher,
+    'subscriber': _subscriber,
+}
+
+# Um cliente por (tipo, argumentos) em todo o processo
+_registo = {}
+_lock = threading.Lock()
+
+
+def cliente(tipo, **kwargs):
+    """
+    Cliente partilhado do tipo pedido ('storage', 'vision', 'firestore', 'publisher', 'subscriber')
+    Retorna um ClientePreguicoso: nada é importado nem criado até ser usado
+    """
+    chave = (tipo, tuple(sorted(kwargs.items())))
+    with _lock:
+        if chave not in _registo:
+            fabrica = FABRICAS[tipo]
+            _registo[chave] = ClientePreguicoso(lambda: fabrica(**kwargs), nome=tipo)
+        return _registo[chave]
+
+
+def preguicoso(fabrica, nome=None):
+    """Objeto derivado de um cliente (ex: bucket) criado só no primeiro acesso"""
+    return ClientePreguicoso(fabrica, nome)
+
+
+def criados():
+    """Tipos de cliente já criados neste processo"""
+    with _lock:
+        return sorted({tipo for (tipo, _), cliente in _registo.items() if cliente.criado})
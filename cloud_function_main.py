@@ -1,25 +1,33 @@
 """
 Cloud Function para Processar Imagens com Vision API
 Deploy: gcloud functions deploy processar_imagem --runtime python39 --trigger-resource meu-bucket-imagens --trigger-event google.storage.object.finalize --entry-point processar_imagem
+Os módulos analise_vision.py, cache_vision.py, armazenamento_imagens.py, miniaturas.py, normalizacao.py, clientes.py e publicacao.py devem ser incluídos no mesmo diretório do deploy
 """
 import functions_framework
-from google.cloud import storage
-from google.cloud import vision
-from google.cloud import firestore
-from google.cloud import pubsub_v1
-import json
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import hashlib
 import logging
+import os
+
+from armazenamento_imagens import PASTA_IMAGENS
+import miniaturas
+from analise_vision import analisar_imagem, analisar_variantes, FEATURES_PADRAO
+import normalizacao
+from cache_vision import CacheVision, CacheFirestore, chave_cache, chave_cache_objeto
+import clientes
+import publicacao
 
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Inicializar clientes
-storage_client = storage.Client()
-vision_client = vision.ImageAnnotatorClient()
-db = firestore.Client()
-publisher_client = pubsub_v1.PublisherClient()
+# Clientes (criados na primeira utilização; eventos ignorados não criam nenhum)
+storage_client = clientes.cliente('storage')
+vision_client = clientes.cliente('vision')
+db = clientes.cliente('firestore')
+
+# Cache de resultados (a memória mantém-se entre invocações da mesma instância)
+cache_vision = CacheVision(CacheFirestore(db))
 
 # Configurações
 BUCKET_NAME = "meu-bucket-imagens"
@@ -27,6 +35,25 @@ OUTPUT_BUCKET = "meu-bucket-resultados"
 PROJECT_ID = "projectcloud-484416"
 TOPIC_ID = "imagem-processada"
 
+# Notificações Pub/Sub (a função espera pela confirmação; as que falham ficam em /tmp)
+publicador = publicacao.Publicador(PROJECT_ID, TOPIC_ID)
+
+# A Vision API lê a imagem diretamente do bucket (gs://); os bytes só são
+# descarregados se a leitura por URI falhar ou com VISION_USAR_URI=0
+VISION_USAR_URI = os.environ.get('VISION_USAR_URI', '1') == '1'
+
+# Tamanho dos blocos lidos do Storage para gerar as miniaturas
+TAMANHO_BLOCO_LEITURA = 1024 * 1024
+
+# Estados do documento durante o processamento de um evento
+EM_PROCESSAMENTO = 'em_processamento'
+PROCESSADO = 'processado'
+ERRO = 'erro'
+
+# Um processamento em curso há mais do que isto é considerado abandonado
+# (instância terminada a meio) e pode ser retomado por uma nova entrega do evento
+PRAZO_PROCESSAMENTO = timedelta(seconds=int(os.environ.get('PRAZO_PROCESSAMENTO_S', 600)))
+
 
 @functions_framework.cloud_event
 def processar_imagem(cloud_event):
@@ -39,23 +66,36 @@ def processar_imagem(cloud_event):
         bucket_name = cloud_event.data["bucket"]
         file_name = cloud_event.data["name"]
         
-        # Ignorar arquivos que não são imagens ou que estão na pasta output
-        if not _eh_imagem(file_name) or file_name.startswith("output/"):
+        # Ignorar arquivos que não são imagens ou que estão nas pastas output/ e imagens/
+        if not _eh_imagem(file_name) or file_name.startswith(("output/", PASTA_IMAGENS)):
             logger.info(f"Arquivo ignorado: {file_name}")
             return {"status": "ignorado"}
         
-        logger.info(f"Iniciando processamento: {file_name}")
-        
-        # PASSO 1: Ler a imagem do Storage
-        imagem_bytes = _ler_imagem_storage(bucket_name, file_name)
+        # Os eventos do Storage podem ser entregues mais do que uma vez: o documento
+        # tem um ID fixo para esta versão do objeto e é reclamado antes do trabalho
+        geracao = str(cloud_event.data.get("generation", ""))
+        doc_ref = db.collection('analises_imagens').document(_id_documento(bucket_name, file_name, geracao))
+        estado = _reclamar_evento(doc_ref, file_name, geracao)
+        if estado is not None:
+            logger.info(f"Evento repetido ignorado ({estado}): {file_name}")
+            return {"status": "duplicado", "documento": doc_ref.id, "estado": estado}
         
-        # PASSO 2: Chamar Vision API
-        resultados = _analisar_com_vision_api(imagem_bytes)
+        logger.info(f"Iniciando processamento: {file_name}")
         
-        # PASSO 3: Guardar resultados no Firestore
-        doc_id = _guardar_resultado_firestore(file_name, resultados)
+        try:
+            # PASSO 1 e 2: Chamar Vision API (a imagem é lida do Storage pela própria Vision API)
+            resultados = _analisar_com_vision_api(bucket_name, file_name, cloud_event.data.get("md5Hash"))
+            
+            # PASSO 3: Gerar miniaturas em imagens/<doc_id>/
+            caminhos_miniaturas = _gerar_miniaturas(bucket_name, doc_ref.id, file_name)
+            
+            # PASSO 4: Guardar resultados no Firestore
+            doc_id = _guardar_resultado_firestore(doc_ref, file_name, resultados, caminhos_miniaturas)
+        except Exception:
+            _libertar_evento(doc_ref)
+            raise
         
-        # PASSO 4: Publicar em Pub/Sub (opcional)
+        # PASSO 5: Publicar em Pub/Sub (opcional)
         _publicar_notificacao(file_name, doc_id, resultados)
         
         logger.info(f"Processamento concluído para: {file_name}")
@@ -72,6 +112,59 @@ def _eh_imagem(file_name):
     return any(file_name.lower().endswith(ext) for ext in extensoes)
 
 
+def _id_documento(bucket_name, file_name, geracao):
+    """ID determinístico do documento para uma versão (generation) de um objeto"""
+    return hashlib.sha256(f"{bucket_name}/{file_name}#{geracao}".encode('utf-8')).hexdigest()[:40]
+
+
+def _reclamar_evento(doc_ref, file_name, geracao):
+    """
+    Reclamar o processamento do evento criando o documento só se ainda não existir
+    Retorna None se esta invocação deve processar a imagem, ou o estado do
+    documento existente (processado / em processamento) se o trabalho já foi feito
+    """
+    from google.api_core import exceptions
+    
+    agora = datetime.now(timezone.utc)
+    reclamacao = {
+        'nome_arquivo': file_name,
+        'generation': geracao,
+        'status': EM_PROCESSAMENTO,
+        'reclamado_em': agora
+    }
+    
+    try:
+        doc_ref.create(reclamacao)
+        return None
+    except exceptions.Conflict:
+        pass
+    
+    # Já existe: uma leitura decide se há trabalho a fazer
+    snapshot = doc_ref.get()
+    dados = snapshot.to_dict() or {}
+    status = dados.get('status')
+    if status == PROCESSADO:
+        return PROCESSADO
+    if status == EM_PROCESSAMENTO and dados.get('reclamado_em') and agora - dados['reclamado_em'] < PRAZO_PROCESSAMENTO:
+        return EM_PROCESSAMENTO
+    
+    # Tentativa anterior falhou ou foi abandonada: retomar, desde que ninguém o tenha feito entretanto
+    try:
+        doc_ref.update(reclamacao, option=db.write_option(last_update_time=snapshot.update_time))
+        logger.info(f"Processamento retomado (estado anterior: {status}): {file_name}")
+        return None
+    except (exceptions.FailedPrecondition, exceptions.NotFound):
+        return EM_PROCESSAMENTO
+
+
+def _libertar_evento(doc_ref):
+    """Marcar a reclamação como falhada para que uma nova entrega do evento possa repetir"""
+    try:
+        doc_ref.update({'status': ERRO})
+    except Exception as e:
+        logger.warning(f"Não foi possível marcar o erro no documento {doc_ref.id}: {str(e)}")
+
+
 def _ler_imagem_storage(bucket_name, file_name):
     """Lê a imagem do Google Cloud Storage"""
     logger.info(f"Lendo imagem do Storage: {bucket_name}/{file_name}")
@@ -82,92 +175,47 @@ def _ler_imagem_storage(bucket_name, file_name):
     return imagem_bytes
 
 
-def _analisar_com_vision_api(imagem_bytes):
-    """Chama Google Cloud Vision API para análise"""
-    logger.info("Iniciando análise com Vision API...")
+def _analisar_com_vision_api(bucket_name, file_name, md5_hash=None):
+    """
+    Chama Google Cloud Vision API para análise (um único pedido com todas as features)
+    Por omissão a imagem é indicada por URI gs://; se falhar, descarrega os bytes
+    """
+    imagem_bytes = None
+    if md5_hash:
+        chave = chave_cache_objeto(md5_hash, FEATURES_PADRAO, completo=True)
+    else:
+        # Objetos compostos não têm MD5: a chave vem dos bytes
+        imagem_bytes = _ler_imagem_storage(bucket_name, file_name)
+        chave = chave_cache(imagem_bytes, FEATURES_PADRAO, completo=True)
+    
+    resultados = cache_vision.obter(chave)
+    if resultados is not None:
+        logger.info(f"Resultados obtidos da cache - {cache_vision.estatisticas()}")
+        return resultados
     
-    image = vision.Image(content=imagem_bytes)
-    resultados = {}
+    logger.info("Iniciando análise com Vision API...")
     
     try:
-        # 1. Label Detection (Detecção de Objetos/Rótulos)
-        logger.info("Executando Label Detection...")
-        response = vision_client.label_detection(image=image)
-        resultados['labels'] = [
-            {
-                'descricao': label.description,
-                'score': float(label.score),
-                'mid': label.mid
-            }
-            for label in response.label_annotations
-        ]
-        logger.info(f"Labels encontrados: {len(resultados['labels'])}")
+        resultados = tempos = None
+        if VISION_USAR_URI and imagem_bytes is None:
+            try:
+                from google.cloud import vision
+                imagem = vision.Image(source=vision.ImageSource(gcs_image_uri=f"gs://{bucket_name}/{file_name}"))
+                resultados, tempos = analisar_imagem(vision_client, imagem, completo=True)
+            except Exception as e:
+                logger.warning(f"Análise por URI falhou ({str(e)}), a enviar os bytes da imagem")
         
-        # 2. Text Detection (Detecção de Texto - OCR)
-        logger.info("Executando Text Detection...")
-        response = vision_client.text_detection(image=image)
-        if response.text_annotations:
-            # Primeiro elemento é o texto completo
-            resultados['texto_completo'] = response.text_annotations[0].description if response.text_annotations else ""
-            resultados['textos'] = [
-                {
-                    'texto': text.description,
-                    'confianca': float(text.confidence) if text.confidence else 0
-                }
-                for text in response.text_annotations[1:] if text.description.strip()  # Skip primeiro (texto completo)
-            ]
-        else:
-            resultados['texto_completo'] = ""
-            resultados['textos'] = []
-        logger.info(f"Textos encontrados: {len(resultados['textos'])}")
+        if resultados is None:
+            if imagem_bytes is None:
+                imagem_bytes = _ler_imagem_storage(bucket_name, file_name)
+            variantes = normalizacao.preparar_variantes(imagem_bytes, FEATURES_PADRAO)
+            resultados, tempos = analisar_variantes(vision_client, variantes, completo=True)
         
-        # 3. Face Detection (Detecção de Rostos)
-        logger.info("Executando Face Detection...")
-        response = vision_client.face_detection(image=image)
-        resultados['rostos'] = [
-            {
-                'confianca': float(face.detection_confidence),
-                'alegria': int(face.joy_likelihood),
-                'surpresa': int(face.surprise_likelihood),
-                'raiva': int(face.anger_likelihood),
-                'tristeza': int(face.sorrow_likelihood)
-            }
-            for face in response.face_annotations
-        ]
+        cache_vision.guardar(chave, resultados)
+        logger.info(f"Labels encontrados: {len(resultados['labels'])}")
+        logger.info(f"Textos encontrados: {len(resultados['textos'])}")
         logger.info(f"Rostos detectados: {len(resultados['rostos'])}")
-        
-        # 4. Safe Search Detection (Classificação de conteúdo seguro)
-        logger.info("Executando Safe Search Detection...")
-        response = vision_client.safe_search_detection(image=image)
-        resultados['safe_search'] = {
-            'adulto': str(response.safe_search_annotation.adult),
-            'violencia': str(response.safe_search_annotation.violence),
-            'spoof': str(response.safe_search_annotation.spoof),
-            'medical': str(response.safe_search_annotation.medical),
-            'racy': str(response.safe_search_annotation.racy)
-        }
-        
-        # 5. Image Properties (Propriedades da imagem - cores dominantes)
-        logger.info("Executando Image Properties...")
-        try:
-            response = vision_client.image_properties(image=image)
-            resultados['cores_dominantes'] = [
-                {
-                    'cor_rgb': {
-                        'red': int(color.color.red),
-                        'green': int(color.color.green),
-                        'blue': int(color.color.blue)
-                    },
-                    'score': float(color.score),
-                    'pixel_fraction': float(color.pixel_fraction)
-                }
-                for color in response.dominant_colors.colors
-            ]
-        except Exception as e:
-            logger.warning(f"Erro ao processar cores: {e}")
-            resultados['cores_dominantes'] = []
-        
-        logger.info("Análise com Vision API concluída com sucesso")
+        logger.info(f"Análise com Vision API concluída com sucesso ({tempos['pedido']:.0f} ms)")
         return resultados
         
     except Exception as e:
@@ -175,7 +223,21 @@ def _analisar_com_vision_api(imagem_bytes):
         raise
 
 
-def _guardar_resultado_firestore(nome_arquivo, resultados):
+def _gerar_miniaturas(bucket_name, doc_id, file_name):
+    """
+    Gera as miniaturas da imagem (não falha o processamento se der erro)
+    A imagem é lida do Storage em blocos, sem a descarregar toda para memória
+    """
+    try:
+        bucket = storage_client.bucket(bucket_name)
+        with bucket.blob(file_name).open('rb', chunk_size=TAMANHO_BLOCO_LEITURA) as imagem:
+            return miniaturas.guardar_miniaturas(bucket, doc_id, imagem)
+    except Exception as e:
+        logger.warning(f"Não foi possível gerar miniaturas: {str(e)}")
+        return {}
+
+
+def _guardar_resultado_firestore(doc_ref, nome_arquivo, resultados, caminhos_miniaturas=None):
     """Guarda os resultados de análise no Firestore"""
     logger.info("Guardando resultados no Firestore...")
     
@@ -183,15 +245,17 @@ def _guardar_resultado_firestore(nome_arquivo, resultados):
         'nome_arquivo': nome_arquivo,
         'data_processamento': datetime.now(),
         'resultados': resultados,
-        'status': 'processado',
+        'status': PROCESSADO,
         'total_labels': len(resultados.get('labels', [])),
         'total_textos': len(resultados.get('textos', [])),
         'total_rostos': len(resultados.get('rostos', []))
     }
+    if caminhos_miniaturas:
+        dados['miniaturas'] = caminhos_miniaturas
     
     try:
-        # Adicionar documento à coleção 'analises_imagens'
-        _, doc_ref = db.collection('analises_imagens').add(dados)
+        # Criar documento na coleção 'analises_imagens'
+        doc_ref.set(dados)
         logger.info(f"Documento criado no Firestore: {doc_ref.id}")
         return doc_ref.id
         
@@ -201,30 +265,23 @@ def _guardar_resultado_firestore(nome_arquivo, resultados):
 
 
 def _publicar_notificacao(nome_arquivo, doc_id, resultados):
-    """Publica mensagem em Pub/Sub para notificar outros serviços"""
-    try:
-        logger.info("Publicando notificação em Pub/Sub...")
-        topic_path = publisher_client.topic_path(PROJECT_ID, TOPIC_ID)
-        
-        mensagem = {
-            'nome_arquivo': nome_arquivo,
-            'documento_firestore': doc_id,
-            'tempo_processamento': datetime.now().isoformat(),
-            'total_labels': len(resultados.get('labels', [])),
-            'total_textos': len(resultados.get('textos', [])),
-            'total_rostos': len(resultados.get('rostos', [])),
-            'status': 'processado_sucesso'
-        }
-        
-        # Publicar mensagem
-        future = publisher_client.publish(
-            topic_path, 
-            json.dumps(mensagem).encode('utf-8')
-        )
-        
-        message_id = future.result()
-        logger.info(f"Notificação publicada com ID: {message_id}")
-        
-    except Exception as e:
-        logger.warning(f"Não foi possível publicar notificação: {str(e)}")
-        # Não falhar o processamento se Pub/Sub falhar
+    """
+    Publica mensagem em Pub/Sub para notificar outros serviços
+    Espera pela confirmação antes de a função retornar: depois disso o CPU da instância
+    é limitado e a instância pode terminar, levando o lote por enviar e a fila em /tmp.
+    As notificações que ficaram na fila em disco de invocações anteriores são reenviadas agora
+    """
+    mensagem = {
+        'nome_arquivo': nome_arquivo,
+        'documento_firestore': doc_id,
+        'tempo_processamento': datetime.now().isoformat(),
+        'total_labels': len(resultados.get('labels', [])),
+        'total_textos': len(resultados.get('textos', [])),
+        'total_rostos': len(resultados.get('rostos', [])),
+        'status': 'processado_sucesso'
+    }
+    
+    if not publicador.publicar_e_aguardar(mensagem):
+        logger.warning("Notificação guardada em /tmp para reenvio na próxima invocação")
+    elif publicador.pendentes():
+        publicador.reenviar_pendentes()
@@ -0,0 +1,201 @@
+"""
+Feed de Alterações das Análises (Server-Sent Events)
+Os clientes de /api/stream recebem só as análises novas, alteradas ou removidas,
+em vez de voltarem a pedir a listagem completa. As alterações chegam de um listener
+on_snapshot do Firestore (um por processo, não um por cliente) ou das notificações
+do armazenamento local, e ficam num histórico curto numerado: um cliente que volte
+a ligar com Last-Event-ID recebe o que perdeu, ou 'reiniciar' se já não estiver no histórico
+Os IDs dos eventos são '<época>-<número>': a época identifica o histórico deste processo,
+por isso um ID de outro worker (ou de antes de um reinício) também leva a 'reiniciar'
+Cada cliente ligado ocupa uma thread do servidor (ex: gunicorn --threads)
+"""
+from collections import deque
+from datetime import datetime
+import json
+import logging
+import os
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Tipos de evento enviados aos clientes
+ANALISE = 'analise'        # análise nova ou alterada (resumo, como em /api/resultados)
+REMOVIDA = 'removida'      # {'id': ...} análise apagada
+SAIU_JANELA = 'saiu_janela'  # {'id': ...} análise que deixou de estar entre as mais recentes (não foi apagada)
+REINICIAR = 'reiniciar'    # o cliente deve voltar a pedir a listagem completa
+PRONTO = 'pronto'          # primeiro evento de cada ligação
+
+HISTORICO = int(os.environ.get('FEED_HISTORICO', 1000))
+INTERVALO_PING = 15  # segundos sem eventos até enviar um comentário (mantém a ligação aberta)
+
+
+class FeedAlteracoes:
+    """Histórico numerado das alterações, partilhado por todos os clientes SSE do processo"""
+
+    def __init__(self, campos=None, fonte=None, historico=HISTORICO):
+        """
+        campos: campos do resumo enviado em cada evento ANALISE (None = documento completo)
+        fonte: fonte(feed) chamada uma vez, quando liga o primeiro cliente
+        """
+        self.campos = campos
+        self._fonte = fonte
+        self._eventos = deque(maxlen=historico)  # (seq, tipo, dados)
+        self._seq = 0
+        self.epoca = uuid.uuid4().hex[:8]
+        self._condicao = threading.Condition()
+        self._clientes = 0
+
+    # ------------------------------------------------------------------------
+    # Alterações (chamadas pelas fontes)
+    # ------------------------------------------------------------------------
+
+    def analise(self, doc_id, dados):
+        resumo = dict(dados) if self.campos is None else {
+            campo: dados[campo] for campo in self.campos if campo in dados
+        }
+        resumo['id'] = doc_id
+        if isinstance(resumo.get('data_processamento'), datetime):
+            resumo['data_processamento'] = resumo['data_processamento'].isoformat()
+        self._publicar(ANALISE, resumo)
+
+    def removida(self, doc_id):
+        self._publicar(REMOVIDA, {'id': doc_id})
+
+    def saiu_janela(self, doc_id):
+        self._publicar(SAIU_JANELA, {'id': doc_id})
+
+    def reiniciar(self):
+        self._publicar(REINICIAR, {})
+
+    def _publicar(self, tipo, dados):
+        evento = json.dumps(dados, ensure_ascii=False, default=str)
+        with self._condicao:
+            self._seq += 1
+            self._eventos.append((self._seq, tipo, evento))
+            self._condicao.notify_all()
+
+    # ------------------------------------------------------------------------
+    # Clientes
+    # ------------------------------------------------------------------------
+
+    def stream(self, ultimo_id=None):
+        """
+        Gerador do texto SSE para um cliente
+        ultimo_id: cabeçalho Last-Event-ID de uma religação (None numa ligação nova)
+        """
+        self._iniciar_fonte()
+        with self._condicao:
+            self._clientes += 1
+            atual = self._seq
+        try:
+            ultimo = _numero(ultimo_id, self.epoca, atual)
+            yield f"retry: 3000\nid: {self._id(atual if ultimo is None else ultimo)}\nevent: {PRONTO}\ndata: {{}}\n\n"
+            if ultimo is None:
+                # ID de outra época: não se sabe o que o cliente perdeu
+                ultimo = atual
+                yield f"id: {self._id(ultimo)}\nevent: {REINICIAR}\ndata: {{}}\n\n"
+
+            while True:
+                with self._condicao:
+                    eventos = self._desde(ultimo)
+                    if eventos == []:
+                        self._condicao.wait(INTERVALO_PING)
+                        eventos = self._desde(ultimo)
+                    atual = self._seq
+
+                if eventos is None:
+                    # O cliente perdeu eventos que já saíram do histórico
+                    ultimo = atual
+                    yield f"id: {self._id(ultimo)}\nevent: {REINICIAR}\ndata: {{}}\n\n"
+                elif not eventos:
+                    yield ": ping\n\n"
+                else:
+                    for seq, tipo, evento in eventos:
+                        yield f"id: {self._id(seq)}\nevent: {tipo}\ndata: {evento}\n\n"
+                    ultimo = eventos[-1][0]
+        finally:
+            with self._condicao:
+                self._clientes -= 1
+
+    def estatisticas(self):
+        with self._condicao:
+            return {
+                'epoca': self.epoca, 'clientes': self._clientes,
+                'eventos': self._seq, 'historico': len(self._eventos)
+            }
+
+    def _id(self, seq):
+        return f"{self.epoca}-{seq}"
+
+    def _desde(self, ultimo):
+        """Eventos depois de 'ultimo'; None se algum já saiu do histórico (chamar com o lock)"""
+        if ultimo >= self._seq:
+            return []
+        if not self._eventos or self._eventos[0][0] > ultimo + 1:
+            return None
+        return [evento for evento in self._eventos if evento[0] > ultimo]
+
+    def _iniciar_fonte(self):
+        with self._condicao:
+            fonte, self._fonte = self._fonte, None
+        if fonte is not None:
+            try:
+                fonte(self)
+            except Exception as e:
+                logger.error(f"Não foi possível iniciar a fonte de alterações: {e}")
+
+
+def _numero(ultimo_id, epoca, atual):
+    """
+    Número do Last-Event-ID; o evento atual numa ligação nova
+    None se o ID for de outra época (outro processo ou antes de um reinício) ou inválido
+    """
+    if not ultimo_id:
+        return atual
+    epoca_id, _, numero = ultimo_id.rpartition('-')
+    try:
+        ultimo = int(numero)
+    except ValueError:
+        return None
+    return ultimo if epoca_id == epoca and 0 <= ultimo <= atual else None
+
+
+def ouvir_firestore(feed, colecao, limite=50):
+    """
+    Listener on_snapshot das 'limite' análises mais recentes (a janela da galeria)
+    O primeiro snapshot é ignorado: os clientes já têm a listagem de /api/resultados
+    Uma análise que sai da janela também chega como REMOVED: só é REMOVIDA se o
+    documento já não existir, senão é SAIU_JANELA (a galeria mantém o cartão)
+    """
+    query = colecao.order_by('data_processamento', direction='DESCENDING').limit(limite)
+    inicial = [True]
+
+    def ao_alterar(documentos, alteracoes, hora_leitura):
+        if inicial[0]:
+            inicial[0] = False
+            return
+        for alteracao in alteracoes:
+            if alteracao.type.name == 'REMOVED':
+                referencia = alteracao.document.reference
+                if referencia.get(['data_processamento']).exists:
+                    feed.saiu_janela(referencia.id)
+                else:
+                    feed.removida(referencia.id)
+            else:
+                feed.analise(alteracao.document.id, alteracao.document.to_dict())
+
+    logger.info("Feed de alterações: listener do Firestore iniciado")
+    return query.on_snapshot(ao_alterar)
+
+
+def observador_local(feed):
+    """Função para armazenamento_local.observar() que passa as alterações ao feed"""
+    def ao_alterar(tipo, doc_id, registo):
+        if tipo == 'inserido':
+            feed.analise(doc_id, registo)
+        elif tipo == 'apagado':
+            feed.removida(doc_id)
+        else:
+            feed.reiniciar()
+    return ao_alterar
@@ -0,0 +1,171 @@
+"""
+Deteção de Imagens Quase Duplicadas (hash perceptual)
+Calcula um dHash de 64 bits por imagem e procura vizinhos por distância de Hamming
+O hash é dividido em 4 bandas de 16 bits (multi-index hashing): duas imagens a
+distância <= 3 partilham pelo menos uma banda exata, por isso a procura só
+compara os candidatos dessas bandas em vez de percorrer todas as análises
+"""
+from io import BytesIO
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Pillow é opcional: sem ele a deteção de duplicados fica desativada
+try:
+    from PIL import Image
+    pil_disponivel = True
+except ImportError:
+    pil_disponivel = False
+    logger.warning("⚠️  Pillow não disponível, deteção de duplicados desativada")
+
+NUM_BANDAS = 4
+BITS_BANDA = 64 // NUM_BANDAS
+
+# Distância máxima para considerar duplicado (tem de ser < NUM_BANDAS)
+DISTANCIA_MAX = min(int(os.environ.get('PHASH_DISTANCIA_MAX', 3)), NUM_BANDAS - 1)
+
+# Reutilizar os resultados do duplicado em vez de chamar a Vision API (opcional:
+# um quase duplicado pode ter texto ou rostos diferentes; por omissão só é registado)
+REUTILIZAR_DUPLICADOS = os.environ.get('PHASH_REUTILIZAR', '0') == '1'
+
+# Candidatos lidos por página em cada banda na procura no Firestore
+PAGINA_CANDIDATOS = 200
+
+
+def calcular_dhash(imagem):
+    """
+    Calcular o dHash (64 bits) da imagem (bytes ou caminho de um ficheiro) como string hexadecimal
+    Retorna None se o Pillow não estiver disponível ou a imagem não puder ser lida
+    """
+    if not pil_disponivel:
+        return None
+
+    try:
+        img = Image.open(imagem if isinstance(imagem, str) else BytesIO(imagem))
+        img.draft('L', (64, 64))  # Descodificação reduzida para JPEG
+        img = img.convert('L').resize((9, 8), Image.LANCZOS)
+        pixels = list(img.getdata())
+
+        valor = 0
+        for linha in range(8):
+            for coluna in range(8):
+                esquerda = pixels[linha * 9 + coluna]
+                direita = pixels[linha * 9 + coluna + 1]
+                valor = (valor << 1) | (1 if esquerda > direita else 0)
+
+        return f"{valor:016x}"
+
+    except Exception as e:
+        logger.warning(f"Não foi possível calcular o hash perceptual: {e}")
+        return None
+
+
+def bandas(phash):
+    """Bandas do hash no formato '<indice>:<valor>' (usadas como chaves de procura)"""
+    valor = int(phash, 16)
+    mascara = (1 << BITS_BANDA) - 1
+    return [
+        f"{i}:{(valor >> (i * BITS_BANDA)) & mascara:04x}"
+        for i in range(NUM_BANDAS)
+    ]
+
+
+def distancia_hamming(phash_a, phash_b):
+    """Número de bits diferentes entre dois hashes"""
+    return bin(int(phash_a, 16) ^ int(phash_b, 16)).count('1')
+
+
+def mais_proximo(phash, candidatos, distancia_max=DISTANCIA_MAX):
+    """doc_id do par (doc_id, phash) mais próximo dentro de distancia_max, ou None"""
+    melhor = None
+    for doc_id, candidato in candidatos:
+        distancia = distancia_hamming(phash, candidato)
+        if distancia <= distancia_max and (melhor is None or distancia < melhor[0]):
+            melhor = (distancia, doc_id)
+    return melhor[1] if melhor else None
+
+
+def procurar_firestore(db, phash, distancia_max=DISTANCIA_MAX):
+    """
+    Procurar em 'analises_imagens' a análise mais próxima do hash
+    Cada banda é consultada à parte (array_contains no campo 'phash_bandas') e os
+    candidatos são lidos em páginas até se esgotarem, projetando só os campos
+    necessários, sem trazer a imagem. Retorna (doc_id, dados) ou None
+    """
+    colecao = db.collection('analises_imagens')
+    vistos = set()
+    melhor = None
+
+    for banda in bandas(phash):
+        query = colecao.where('phash_bandas', 'array_contains', banda).select(['phash', 'resultados'])
+        ultimo = None
+        while True:
+            pagina = query if ultimo is None else query.start_after(ultimo)
+            docs = list(pagina.limit(PAGINA_CANDIDATOS).stream())
+            for doc in docs:
+                if doc.id in vistos:
+                    continue
+                vistos.add(doc.id)
+                dados = doc.to_dict()
+                distancia = distancia_hamming(phash, dados['phash'])
+                if distancia <= distancia_max and (melhor is None or distancia < melhor[0]):
+                    melhor = (distancia, doc.id, dados)
+            if len(docs) < PAGINA_CANDIDATOS or (melhor and melhor[0] == 0):
+                break
+            ultimo = docs[-1]
+
+        if melhor and melhor[0] == 0:
+            break  # Cópia exata: não há candidato mais próximo
+
+    if melhor is None:
+        return None
+
+    logger.info(f"Duplicado encontrado: {melhor[1]} (distância {melhor[0]})")
+    return melhor[1], melhor[2]
+
+
+class IndicePerceptual:
+    """Índice em memória por bandas para o armazenamento local"""
+
+    def __init__(self):
+        self._hashes = {}
+        self._bandas = {}
+        self._lock = threading.Lock()
+
+    def adicionar(self, doc_id, phash):
+        with self._lock:
+            self._hashes[doc_id] = phash
+            for banda in bandas(phash):
+                self._bandas.setdefault(banda, set()).add(doc_id)
+
+    def remover(self, doc_id):
+        with self._lock:
+            phash = self._hashes.pop(doc_id, None)
+            if phash is None:
+                return
+            for banda in bandas(phash):
+                ids = self._bandas.get(banda)
+                if ids is not None:
+                    ids.discard(doc_id)
+                    if not ids:
+                        del self._bandas[banda]
+
+    def limpar(self):
+        with self._lock:
+            self._hashes.clear()
+            self._bandas.clear()
+
+    def procurar(self, phash, distancia_max=DISTANCIA_MAX):
+        """Retorna o doc_id mais próximo dentro de distancia_max, ou None"""
+        with self._lock:
+            candidatos = set()
+            for banda in bandas(phash):
+                candidatos |= self._bandas.get(banda, set())
+            candidatos = [(doc_id, self._hashes[doc_id]) for doc_id in candidatos]
+
+        return mais_proximo(phash, candidatos, distancia_max)
+
+    def __len__(self):
+        return len(self._hashes)
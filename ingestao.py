@@ -0,0 +1,67 @@
+"""
+Receção de Imagens em Disco
+Os uploads são copiados em blocos de tamanho fixo para um ficheiro temporário,
+calculando o SHA-256 ao mesmo tempo, em vez de ficarem em memória enquanto
+esperam na fila; só os bytes enviados à Vision API são lidos para memória
+"""
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Configuração
+TAMANHO_BLOCO = int(os.environ.get('INGESTAO_BLOCO_KB', 1024)) * 1024
+TAMANHO_MAX = int(os.environ.get('UPLOAD_MAX_MB', 20)) * 1024 * 1024
+PASTA_TEMPORARIA = os.environ.get('INGESTAO_PASTA') or None  # None = pasta temporária do sistema
+
+
+class FicheiroRecebido:
+    """Imagem recebida num ficheiro temporário (apagar com apagar() no fim do processamento)"""
+
+    def __init__(self, nome, caminho, tamanho, sha256):
+        self.nome = nome
+        self.caminho = caminho
+        self.tamanho = tamanho
+        self.sha256 = sha256
+
+    def ler(self):
+        """Bytes da imagem (só quando são mesmo precisos, ex: pedido à Vision API)"""
+        with open(self.caminho, 'rb') as f:
+            return f.read()
+
+    def apagar(self):
+        try:
+            os.remove(self.caminho)
+        except FileNotFoundError:
+            pass
+
+
+def receber(origem, nome, tamanho_max=TAMANHO_MAX):
+    """
+    Copiar o stream 'origem' para um ficheiro temporário, bloco a bloco
+    Retorna FicheiroRecebido; ValueError se exceder tamanho_max
+    """
+    sha256 = hashlib.sha256()
+    tamanho = 0
+    sufixo = os.path.splitext(nome)[1].lower()
+    descritor, caminho = tempfile.mkstemp(suffix=sufixo, prefix='upload_', dir=PASTA_TEMPORARIA)
+
+    try:
+        with os.fdopen(descritor, 'wb') as destino:
+            while True:
+                bloco = origem.read(TAMANHO_BLOCO)
+                if not bloco:
+                    break
+                tamanho += len(bloco)
+                if tamanho > tamanho_max:
+                    raise ValueError(f'Ficheiro demasiado grande (máximo {tamanho_max // (1024 * 1024)} MB)')
+                sha256.update(bloco)
+                destino.write(bloco)
+    except Exception:
+        os.remove(caminho)
+        raise
+
+    logger.info(f"Upload recebido em disco: {nome} ({tamanho} bytes)")
+    return FicheiroRecebido(nome, caminho, tamanho, sha256.hexdigest())
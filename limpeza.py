@@ -0,0 +1,74 @@
+"""
+Remoção em Massa das Análises
+Apaga os documentos de 'analises_imagens' com o BulkWriter do Firestore
+(escritas agrupadas e enviadas em paralelo) e as imagens no Cloud Storage
+Pensado para correr como tarefa em segundo plano (ver tarefas.py)
+"""
+import logging
+import threading
+
+import armazenamento_imagens
+
+logger = logging.getLogger(__name__)
+
+# Documentos lidos por página (só o ID, sem os campos)
+TAMANHO_PAGINA = 500
+
+
+def contar_analises(colecao):
+    """Número de documentos da coleção (agregação count); None se não suportado"""
+    try:
+        return colecao.count().get()[0][0].value
+    except Exception as e:
+        logger.warning(f"Não foi possível contar documentos: {e}")
+        return None
+
+
+def apagar_analises(tarefa, db, bucket=None):
+    """
+    Apagar todos os documentos de 'analises_imagens' e, se houver bucket, as imagens
+    O progresso é publicado em tarefa.progresso; retorna os totais apagados
+    """
+    colecao = db.collection('analises_imagens')
+    tarefa.atualizar(documentos_total=contar_analises(colecao), documentos_apagados=0, imagens_apagadas=0)
+
+    apagados = 0
+    lock = threading.Lock()
+
+    def escrita_concluida(referencia, resultado, bulk_writer):
+        nonlocal apagados
+        with lock:
+            apagados += 1
+            if apagados % 100 == 0:
+                tarefa.atualizar(documentos_apagados=apagados)
+
+    bulk_writer = db.bulk_writer()
+    bulk_writer.on_write_result(escrita_concluida)
+
+    # Ler os IDs por páginas (cursor no último documento) enquanto o BulkWriter apaga
+    ultimo = None
+    while True:
+        query = colecao.order_by('__name__').select(['__name__']).limit(TAMANHO_PAGINA)
+        if ultimo is not None:
+            query = query.start_after(ultimo)
+
+        docs = list(query.stream())
+        if not docs:
+            break
+        ultimo = docs[-1]
+
+        for doc in docs:
+            bulk_writer.delete(doc.reference)
+
+    bulk_writer.close()
+    tarefa.atualizar(documentos_apagados=apagados)
+    logger.info(f"Documentos apagados: {apagados}")
+
+    imagens = 0
+    if bucket is not None:
+        imagens = armazenamento_imagens.apagar_todas_imagens(
+            bucket, progresso=lambda total: tarefa.atualizar(imagens_apagadas=total)
+        )
+        logger.info(f"Imagens apagadas do Storage: {imagens}")
+
+    return {'total': apagados, 'imagens_apagadas': imagens}
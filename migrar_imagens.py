@@ -0,0 +1,121 @@
+"""
+Migração das Imagens do Firestore para o Cloud Storage
+Move o campo 'imagem_base64' de cada documento de 'analises_imagens'
+para um blob em imagens/<doc_id>/ e deixa no documento só a referência
+
+Uso:
+    python migrar_imagens.py [--lote 50] [--paralelo 16] [--simular]
+"""
+from google.cloud import storage
+from google.cloud import firestore
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import base64
+import logging
+
+import armazenamento_imagens
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROJECT_ID = "projectcloud-484416"
+BUCKET_NAME = "meu-bucket-imagens"
+
+# Documentos por página: cada um traz a imagem em base64 (até ~1 MB), por isso a
+# página inteira fica em memória; 50 mantém isso em dezenas de MB
+TAMANHO_LOTE = 50
+
+
+def migrar_documento(bucket, doc_id, dados):
+    """Enviar a imagem de um documento para o bucket; retorna os campos a atualizar"""
+    imagem_bytes = base64.b64decode(dados['imagem_base64'])
+    campos = armazenamento_imagens.guardar_imagem(
+        bucket, doc_id, dados.get('nome_arquivo', 'imagem.jpg'), imagem_bytes
+    )
+    campos['imagem_base64'] = firestore.DELETE_FIELD
+    return campos
+
+
+def migrar(db, bucket, tamanho_lote=TAMANHO_LOTE, paralelo=16, simular=False):
+    """
+    Percorrer a coleção por páginas (ordenadas por ID) e migrar cada página:
+    uploads em paralelo e uma escrita em lote com as atualizações
+    Retorna (lidos, migrados, falhados); ao simular 'migrados' conta os que têm imagem por migrar.
+    Os falhados mantêm a imagem no documento e são migrados numa nova execução
+    """
+    colecao = db.collection('analises_imagens')
+    ultimo = None
+    total_lidos = 0
+    total_migrados = 0
+    total_falhados = 0
+
+    with ThreadPoolExecutor(max_workers=paralelo) as executor:
+        while True:
+            query = colecao.order_by('__name__').select(['nome_arquivo', 'imagem_base64']).limit(tamanho_lote)
+            if ultimo is not None:
+                query = query.start_after(ultimo)
+
+            docs = list(query.stream())
+            if not docs:
+                break
+            ultimo = docs[-1]
+            total_lidos += len(docs)
+
+            pendentes = [(doc, doc.to_dict()) for doc in docs]
+            pendentes = [(doc, dados) for doc, dados in pendentes if dados.get('imagem_base64')]
+
+            if simular:
+                total_migrados += len(pendentes)
+            elif pendentes:
+                futuros = [
+                    (doc, executor.submit(migrar_documento, bucket, doc.id, dados))
+                    for doc, dados in pendentes
+                ]
+
+                batch = db.batch()
+                atualizados = 0
+                for doc, futuro in futuros:
+                    try:
+                        batch.update(doc.reference, futuro.result())
+                        atualizados += 1
+                    except Exception as e:
+                        logger.error(f"Erro ao migrar {doc.id}: {e}")
+
+                if atualizados:
+                    try:
+                        batch.commit()
+                    except Exception as e:
+                        logger.error(f"Erro ao atualizar {atualizados} documentos: {e}")
+                        atualizados = 0
+                total_migrados += atualizados
+                total_falhados += len(pendentes) - atualizados
+
+            logger.info(
+                f"Documentos lidos: {total_lidos} - {'por migrar' if simular else 'migrados'}: {total_migrados}"
+                f" - falhados: {total_falhados}"
+            )
+
+    return total_lidos, total_migrados, total_falhados
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrar imagens do Firestore para o Cloud Storage')
+    parser.add_argument('--lote', type=int, default=TAMANHO_LOTE, help='Documentos por página (máximo 500)')
+    parser.add_argument('--paralelo', type=int, default=16, help='Uploads em paralelo')
+    parser.add_argument('--simular', action='store_true', help='Só contar, sem alterar nada')
+    args = parser.parse_args()
+
+    print("\n" + "=" * 60)
+    print("📦 Migração de imagens para o Cloud Storage")
+    print("=" * 60)
+    print(f"Projeto: {PROJECT_ID}")
+    print(f"Bucket:  {BUCKET_NAME}\n")
+
+    db = firestore.Client(project=PROJECT_ID)
+    bucket = storage.Client(project=PROJECT_ID).bucket(BUCKET_NAME)
+
+    lidos, migrados, falhados = migrar(db, bucket, min(args.lote, 500), args.paralelo, args.simular)
+
+    print(f"\n✅ {lidos} documentos lidos, {migrados} com imagem {'por migrar' if args.simular else 'migrada'}")
+    if falhados:
+        print(f"❌ {falhados} documentos não migrados (ver erros acima); volte a executar para os repetir")
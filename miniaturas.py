@@ -0,0 +1,88 @@
+"""
+Geração de Miniaturas das Imagens Analisadas
+Produz as versões reduzidas uma única vez, na receção da imagem,
+e guarda-as junto do original em imagens/<doc_id>/ no bucket
+"""
+from io import BytesIO
+import logging
+import os
+
+import armazenamento_imagens
+
+logger = logging.getLogger(__name__)
+
+# Pillow é opcional: sem ele não são geradas miniaturas
+try:
+    from PIL import Image, ImageOps
+    pil_disponivel = True
+except ImportError:
+    pil_disponivel = False
+    logger.warning("⚠️  Pillow não disponível, miniaturas desativadas")
+
+# Tamanhos disponíveis (nome -> maior lado em píxeis)
+TAMANHOS = {
+    'pequena': 200,
+    'media': 800,
+}
+
+# Formato das miniaturas: JPEG ou WEBP
+FORMATO = os.environ.get('MINIATURA_FORMATO', 'JPEG').upper()
+QUALIDADE = int(os.environ.get('MINIATURA_QUALIDADE', 80))
+
+_EXTENSOES = {'JPEG': '.jpg', 'WEBP': '.webp'}
+_CONTENT_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp'}
+
+
+def gerar_miniaturas(imagem, tamanhos=TAMANHOS):
+    """
+    Gerar as miniaturas da imagem (bytes, caminho de um ficheiro ou ficheiro aberto)
+    Retorna {nome: bytes}; vazio se o Pillow não estiver disponível ou a imagem não puder ser lida
+    """
+    if not pil_disponivel:
+        return {}
+
+    try:
+        original = Image.open(BytesIO(imagem) if isinstance(imagem, bytes) else imagem)
+        # Descodificação reduzida para JPEG (não é preciso o tamanho completo)
+        original.draft('RGB', (max(tamanhos.values()),) * 2)
+        original = ImageOps.exif_transpose(original).convert('RGB')
+
+        miniaturas = {}
+        # Do maior para o menor, reaproveitando a redução anterior
+        img = original
+        for nome, lado in sorted(tamanhos.items(), key=lambda item: -item[1]):
+            img = img.copy()
+            img.thumbnail((lado, lado), Image.LANCZOS)
+
+            saida = BytesIO()
+            img.save(saida, format=FORMATO, quality=QUALIDADE, optimize=True)
+            miniaturas[nome] = saida.getvalue()
+
+        return miniaturas
+
+    except Exception as e:
+        logger.warning(f"Não foi possível gerar miniaturas: {e}")
+        return {}
+
+
+def guardar_miniaturas(bucket, doc_id, imagem):
+    """
+    Gerar e enviar as miniaturas para imagens/<doc_id>/<tamanho>.<ext>
+    Retorna {nome: caminho do blob} para guardar no campo 'miniaturas' do documento
+    """
+    caminhos = {}
+    for nome, dados in gerar_miniaturas(imagem).items():
+        caminho = f"{armazenamento_imagens.pasta_analise(doc_id)}{nome}{_EXTENSOES[FORMATO]}"
+        blob = bucket.blob(caminho)
+        blob.cache_control = 'private, max-age=86400'
+        blob.upload_from_string(dados, content_type=_CONTENT_TYPES[FORMATO])
+        caminhos[nome] = caminho
+
+    if caminhos:
+        logger.info(f"Miniaturas guardadas: {', '.join(caminhos)}")
+    return caminhos
+
+
+def tipo_conteudo(caminho):
+    """Content-Type de uma miniatura a partir do caminho"""
+    return 'image/webp' if caminho.endswith('.webp') else 'image/jpeg'
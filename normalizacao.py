@@ -0,0 +1,126 @@
+"""
+Normalização das Imagens antes da Vision API
+Reduz a imagem ao maior lado configurado para cada feature, corrige a orientação
+EXIF, remove metadados e recomprime em JPEG. Labels, rostos, safe search e cores
+dão resultados equivalentes numa imagem pequena; o OCR recebe uma versão com
+mais resolução. As features com o mesmo tamanho partilham a mesma variante
+"""
+from io import BytesIO
+import logging
+import os
+import threading
+
+from analise_vision import FEATURES_PADRAO
+
+logger = logging.getLogger(__name__)
+
+# Pillow é opcional: sem ele a imagem é enviada sem alterações
+try:
+    from PIL import Image, ImageOps
+    pil_disponivel = True
+except ImportError:
+    pil_disponivel = False
+    logger.warning("⚠️  Pillow não disponível, normalização das imagens desativada")
+
+# Configuração
+NORMALIZAR = os.environ.get('VISION_NORMALIZAR', '1') == '1'
+LADO_MAX_PADRAO = int(os.environ.get('VISION_LADO_MAX', 1024))
+QUALIDADE = int(os.environ.get('VISION_QUALIDADE', 85))
+
+# Maior lado por feature (as que não estão aqui usam LADO_MAX_PADRAO)
+LADO_MAX = {
+    'texto': int(os.environ.get('VISION_LADO_MAX_TEXTO', 2048)),
+    'cores': int(os.environ.get('VISION_LADO_MAX_CORES', 512)),
+}
+
+# Totais desde o arranque do processo
+_totais = {'imagens': 0, 'bytes_originais': 0, 'bytes_enviados': 0}
+_lock = threading.Lock()
+
+
+def preparar_variantes(imagem, features=FEATURES_PADRAO):
+    """
+    Preparar as versões da imagem (bytes ou caminho de um ficheiro) a enviar à Vision API
+    Retorna [(bytes, [features])], uma entrada por tamanho; sem Pillow, com a
+    normalização desativada ou se a imagem não puder ser lida, a imagem original
+    """
+    if not (NORMALIZAR and pil_disponivel):
+        return [(_bytes(imagem), list(features))]
+
+    grupos = {}
+    for nome in features:
+        grupos.setdefault(LADO_MAX.get(nome, LADO_MAX_PADRAO), []).append(nome)
+
+    try:
+        img = Image.open(imagem if isinstance(imagem, str) else BytesIO(imagem))
+        tamanho_original = os.path.getsize(imagem) if isinstance(imagem, str) else len(imagem)
+        dimensoes = img.size
+        # Descodificação reduzida para JPEG (não é preciso o tamanho completo)
+        img.draft('RGB', (max(grupos),) * 2)
+        img = _rgb(ImageOps.exif_transpose(img))
+
+        variantes = []
+        # Do maior para o menor, reaproveitando a redução anterior
+        for lado, nomes in sorted(grupos.items(), reverse=True):
+            img = img.copy()
+            img.thumbnail((lado, lado), Image.LANCZOS)
+
+            saida = BytesIO()
+            img.save(saida, format='JPEG', quality=QUALIDADE, optimize=True)
+            dados = saida.getvalue()
+
+            # Imagem já pequena e mais leve que a recompressão: enviar o original
+            if len(dados) >= tamanho_original and img.size == dimensoes:
+                dados = _bytes(imagem)
+            variantes.append((dados, nomes))
+
+    except Exception as e:
+        logger.warning(f"Não foi possível normalizar a imagem: {e}")
+        return [(_bytes(imagem), list(features))]
+
+    # Várias variantes que juntas pesam mais que a imagem original: um só pedido com o original
+    if len(variantes) > 1 and sum(len(dados) for dados, _ in variantes) > tamanho_original:
+        variantes = [(_bytes(imagem), list(features))]
+
+    _registar(tamanho_original, sum(len(dados) for dados, _ in variantes), variantes)
+    return variantes
+
+
+def estatisticas():
+    """Bytes originais, enviados e poupados desde o arranque"""
+    with _lock:
+        return {
+            **_totais,
+            'bytes_poupados': _totais['bytes_originais'] - _totais['bytes_enviados']
+        }
+
+
+def _bytes(imagem):
+    """Bytes da imagem original (lidos do disco se 'imagem' for um caminho)"""
+    if not isinstance(imagem, str):
+        return imagem
+    with open(imagem, 'rb') as f:
+        return f.read()
+
+
+def _rgb(img):
+    """Converter para RGB, com as zonas transparentes em branco"""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        fundo = Image.new('RGB', img.size, (255, 255, 255))
+        fundo.paste(img, mask=img.getchannel('A'))
+        return fundo
+    return img.convert('RGB')
+
+
+def _registar(bytes_originais, bytes_enviados, variantes):
+    with _lock:
+        _totais['imagens'] += 1
+        _totais['bytes_originais'] += bytes_originais
+        _totais['bytes_enviados'] += bytes_enviados
+
+    logger.info(
+        f"Normalização: {bytes_originais} -> {bytes_enviados} bytes "
+        f"({bytes_originais - bytes_enviados} poupados) - " +
+        ", ".join(f"{'/'.join(nomes)}: {len(dados)} bytes" for dados, nomes in variantes)
+    )
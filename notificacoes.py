@@ -1,13 +1,27 @@
 """
 Subscriber de Pub/Sub para Notificações
 Escuta por mensagens quando imagens são processadas
+As notificações são guardadas no Firestore em lotes (WriteBatch) e cada mensagem
+só é reconhecida (ack) depois do commit do lote em que foi escrita
+
+Uso:
+    python notificacoes.py                                 # configuração por variáveis de ambiente
+    python notificacoes.py --processos 4 --threads 16 --max-mensagens 800
 """
-from google.cloud import pubsub_v1
-from google.cloud import firestore
+import argparse
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
 from datetime import datetime
 
+import clientes
+
 # Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,63 +29,238 @@ logger = logging.getLogger(__name__)
 PROJECT_ID = "projectcloud-484416"
 SUBSCRIPTION_ID = "imagem-processada-sub"
 
-# Inicializar cliente
-db = firestore.Client()
+# Cliente Firestore (criado na primeira notificação, ver clientes.py)
+db = clientes.cliente('firestore')
+
+# Lotes de escrita: o lote é gravado quando tem LOTE_NOTIFICACOES mensagens ou
+# quando a mais antiga espera há LOTE_ESPERA segundos (máximo do Firestore: 500)
+LOTE_NOTIFICACOES = min(int(os.environ.get('NOTIFICACOES_LOTE', 200)), 500)
+LOTE_ESPERA = int(os.environ.get('NOTIFICACOES_LOTE_MS', 500)) / 1000
+
+# Subscriber: threads do scheduler que executam subscriber_callback, limites do
+# controlo de fluxo (mensagens/bytes em mão por processo) e processos nesta máquina
+SUBSCRIBER_THREADS = int(os.environ.get('SUBSCRIBER_THREADS', 10))
+SUBSCRIBER_MAX_MENSAGENS = int(os.environ.get('SUBSCRIBER_MAX_MENSAGENS', 2 * LOTE_NOTIFICACOES))
+SUBSCRIBER_MAX_BYTES = int(os.environ.get('SUBSCRIBER_MAX_MB', 100)) * 1024 * 1024
+SUBSCRIBER_PROCESSOS = int(os.environ.get('SUBSCRIBER_PROCESSOS', 1))
+INTERVALO_ESTATISTICAS = int(os.environ.get('SUBSCRIBER_ESTATISTICAS_S', 30))
+
+# Webhooks chamados a cada notificação (URLs separados por vírgulas)
+WEBHOOKS = [url.strip() for url in os.environ.get('NOTIFICACOES_WEBHOOKS', '').split(',') if url.strip()]
+
+
+class EstatisticasSubscriber:
+    """
+    Contadores do subscriber neste processo: mensagens em curso (recebidas e ainda
+    sem ack/nack), latência receção -> ack, reentregas e débito
+    As reentregas vêm de delivery_attempt (só com dead letter policy) ou, sem ela,
+    dos IDs de mensagem já vistos por este processo
+    """
+
+    MAX_IDS = 100000
+
+    def __init__(self, janela_latencias=1000):
+        self._lock = threading.Lock()
+        self._totais = {'recebidas': 0, 'ack': 0, 'nack': 0, 'reentregas': 0}
+        self._latencias = deque(maxlen=janela_latencias)
+        self._vistas = OrderedDict()
+        self._janela = (time.monotonic(), 0)  # início da janela do débito e acks nela
+
+    def recebida(self, message):
+        """Registar a receção; retorna o instante usado para medir a latência do ack"""
+        tentativa = getattr(message, 'delivery_attempt', None)
+        with self._lock:
+            self._totais['recebidas'] += 1
+            if (tentativa or 0) > 1 or message.message_id in self._vistas:
+                self._totais['reentregas'] += 1
+            self._vistas[message.message_id] = None
+            self._vistas.move_to_end(message.message_id)
+            if len(self._vistas) > self.MAX_IDS:
+                self._vistas.popitem(last=False)
+        return time.monotonic()
+
+    def confirmada(self, recebida, ack=True):
+        """Registar o ack (ou nack) de uma mensagem recebida no instante 'recebida'"""
+        with self._lock:
+            self._totais['ack' if ack else 'nack'] += 1
+            if ack:
+                self._latencias.append(time.monotonic() - recebida)
+                inicio, acks = self._janela
+                self._janela = (inicio, acks + 1)
+
+    def resumo(self, reiniciar_janela=False):
+        """Totais, mensagens em curso, débito (acks/s) e latência do ack (p50/p95, ms)"""
+        agora = time.monotonic()
+        with self._lock:
+            latencias = sorted(self._latencias)
+            inicio, acks = self._janela
+            if reiniciar_janela:
+                self._janela = (agora, 0)
+            return {
+                **self._totais,
+                'em_curso': self._totais['recebidas'] - self._totais['ack'] - self._totais['nack'],
+                'msg_s': acks / max(agora - inicio, 1e-6),
+                'ack_p50_ms': _percentil(latencias, 0.5) * 1000,
+                'ack_p95_ms': _percentil(latencias, 0.95) * 1000,
+            }
+
+
+def _percentil(valores, fracao):
+    return valores[min(int(len(valores) * fracao), len(valores) - 1)] if valores else 0.0
+
+
+def _formatar_resumo(resumo):
+    return (
+        f"{resumo['msg_s']:.1f} msg/s, em curso: {resumo['em_curso']}, "
+        f"ack p50/p95: {resumo['ack_p50_ms']:.0f}/{resumo['ack_p95_ms']:.0f} ms, "
+        f"reentregas: {resumo['reentregas']}, nack: {resumo['nack']}"
+    )
+
+
+# Estatísticas deste processo
+estatisticas = EstatisticasSubscriber()
+
+
+class EscritorLotes:
+    """
+    Acumula (mensagem, notificação) e grava-as no Firestore num só commit
+    As mensagens do lote recebem ack depois do commit, ou nack se falhar
+    O ID do documento é o ID da mensagem, por isso uma reentrega não duplica a notificação
+    """
+
+    def __init__(self, colecao='notificacoes', tamanho=LOTE_NOTIFICACOES, espera=LOTE_ESPERA):
+        self.colecao = colecao
+        self.tamanho = tamanho
+        self.espera = espera
+        self._pendentes = []
+        self._primeira = None
+        self._condicao = threading.Condition()
+        self._fechado = False
+        self._totais = {'mensagens': 0, 'lotes': 0, 'erros': 0}
+        self._thread = threading.Thread(target=self._ciclo, name='notificacoes-lotes', daemon=True)
+        self._thread.start()
+
+    def adicionar(self, message, notificacao, recebida):
+        with self._condicao:
+            if not self._pendentes:
+                self._primeira = time.monotonic()
+            self._pendentes.append((message, notificacao, recebida))
+            if len(self._pendentes) >= self.tamanho:
+                self._condicao.notify()
+
+    def fechar(self):
+        """Gravar o que está pendente e parar a thread"""
+        with self._condicao:
+            self._fechado = True
+            self._condicao.notify()
+        self._thread.join()
+
+    def estatisticas(self):
+        with self._condicao:
+            return dict(self._totais)
+
+    def _ciclo(self):
+        while True:
+            with self._condicao:
+                while not self._fechado and not self._lote_pronto():
+                    espera = None if not self._pendentes else self._primeira + self.espera - time.monotonic()
+                    self._condicao.wait(espera)
+                lote, self._pendentes = self._pendentes[:self.tamanho], self._pendentes[self.tamanho:]
+                self._primeira = time.monotonic() if self._pendentes else None
+                if not lote and self._fechado:
+                    return
+            if lote:
+                self._gravar(lote)
+
+    def _lote_pronto(self):
+        return len(self._pendentes) >= self.tamanho or (
+            self._pendentes and time.monotonic() - self._primeira >= self.espera
+        )
+
+    def _gravar(self, lote):
+        inicio = time.perf_counter()
+        try:
+            batch = db.batch()
+            colecao = db.collection(self.colecao)
+            for message, notificacao, _ in lote:
+                batch.set(colecao.document(message.message_id), notificacao)
+            batch.commit()
+        except Exception as e:
+            logger.error(f"❌ Erro ao guardar lote de {len(lote)} notificações: {e}")
+            for message, _, recebida in lote:
+                message.nack()
+                estatisticas.confirmada(recebida, ack=False)
+            with self._condicao:
+                self._totais['erros'] += 1
+            return
+
+        for message, _, recebida in lote:
+            message.ack()
+            estatisticas.confirmada(recebida)
+        logger.debug(f"💾 {len(lote)} notificações guardadas no Firestore ({(time.perf_counter() - inicio) * 1000:.0f} ms)")
+        with self._condicao:
+            self._totais['mensagens'] += len(lote)
+            self._totais['lotes'] += 1
+
+
+# Criado ao iniciar o subscriber
+escritor = None
+
+# Motor de entrega dos webhooks (criado no primeiro envio, ver webhooks.py)
+_motor_webhooks = None
+_lock_webhooks = threading.Lock()
 
 
 def subscriber_callback(message):
     """Callback executado quando uma mensagem é recebida"""
+    recebida = estatisticas.recebida(message)
     try:
         dados = json.loads(message.data.decode('utf-8'))
         
-        logger.info("=" * 60)
-        logger.info("📬 NOTIFICAÇÃO RECEBIDA")
-        logger.info("=" * 60)
-        logger.info(f"  📄 Arquivo: {dados['nome_arquivo']}")
-        logger.info(f"  🆔 Documento Firestore: {dados['documento_firestore']}")
-        logger.info(f"  🏷️  Labels encontrados: {dados['total_labels']}")
-        logger.info(f"  📝 Textos encontrados: {dados['total_textos']}")
-        logger.info(f"  👤 Rostos detectados: {dados['total_rostos']}")
-        logger.info(f"  ⏰ Tempo: {dados['tempo_processamento']}")
-        logger.info("=" * 60)
+        logger.debug("=" * 60)
+        logger.debug("📬 NOTIFICAÇÃO RECEBIDA")
+        logger.debug("=" * 60)
+        logger.debug(f"  📄 Arquivo: {dados['nome_arquivo']}")
+        logger.debug(f"  🆔 Documento Firestore: {dados['documento_firestore']}")
+        logger.debug(f"  🏷️  Labels encontrados: {dados['total_labels']}")
+        logger.debug(f"  📝 Textos encontrados: {dados['total_textos']}")
+        logger.debug(f"  👤 Rostos detectados: {dados['total_rostos']}")
+        logger.debug(f"  ⏰ Tempo: {dados['tempo_processamento']}")
+        logger.debug("=" * 60)
         
         # Aqui você pode adicionar lógica adicional:
         # - Enviar email ao utilizador
         # - Enviar notificação push
-        # - Fazer webhook para outro serviço
         # - Atualizar base de dados de utilizadores
         
-        # Exemplo: Guardar notificação no Firestore
-        guardar_notificacao(dados)
+        # Webhooks: só ficam na fila do motor, o envio não atrasa o ack
+        for url_webhook in WEBHOOKS:
+            enviar_webhook(url_webhook, dados)
         
-        # Reconhecer a mensagem (remove da fila)
-        message.ack()
-        logger.info("✅ Mensagem processada com sucesso")
+        # Exemplo: Guardar notificação no Firestore
+        # (o ack é feito pelo escritor, depois do commit do lote)
+        guardar_notificacao(dados, message, recebida)
         
     except Exception as e:
         logger.error(f"❌ Erro ao processar notificação: {e}")
         # Não fazer ack para reprocessar a mensagem mais tarde
         message.nack()
+        estatisticas.confirmada(recebida, ack=False)
 
 
-def guardar_notificacao(dados):
-    """Guarda a notificação num histórico no Firestore"""
-    try:
-        notificacao = {
-            'arquivo': dados['nome_arquivo'],
-            'documento_firestore': dados['documento_firestore'],
-            'total_labels': dados['total_labels'],
-            'total_textos': dados['total_textos'],
-            'total_rostos': dados['total_rostos'],
-            'timestamp': datetime.now(),
-            'status': dados.get('status', 'processado_sucesso')
-        }
-        
-        db.collection('notificacoes').add(notificacao)
-        logger.info("💾 Notificação guardada no Firestore")
-        
-    except Exception as e:
-        logger.error(f"Erro ao guardar notificação: {e}")
+def guardar_notificacao(dados, message, recebida):
+    """Junta a notificação ao lote a guardar no histórico do Firestore"""
+    notificacao = {
+        'arquivo': dados['nome_arquivo'],
+        'documento_firestore': dados['documento_firestore'],
+        'total_labels': dados['total_labels'],
+        'total_textos': dados['total_textos'],
+        'total_rostos': dados['total_rostos'],
+        'timestamp': datetime.now(),
+        'status': dados.get('status', 'processado_sucesso')
+    }
+    
+    escritor.adicionar(message, notificacao, recebida)
 
 
 def enviar_email(email_usuario, dados):
@@ -86,28 +275,67 @@ def enviar_email(email_usuario, dados):
 
 def enviar_webhook(url_webhook, dados):
     """
-    Exemplo de função para enviar webhook
+    Agendar o envio de um webhook (gravado numa fila persistente e enviado
+    em segundo plano, com novas tentativas; ver webhooks.py)
     """
-    import requests
-    
-    try:
-        response = requests.post(url_webhook, json=dados, timeout=10)
-        logger.info(f"🌐 Webhook enviado com status: {response.status_code}")
-    except Exception as e:
-        logger.error(f"Erro ao enviar webhook: {e}")
+    motor_webhooks().enviar(url_webhook, dados)
 
 
-def iniciar_subscriber():
-    """Iniciar subscription para ouvir notificações"""
-    subscriber = pubsub_v1.SubscriberClient()
-    subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
-    
+def motor_webhooks():
+    """Motor de webhooks partilhado por este processo"""
+    global _motor_webhooks
+    with _lock_webhooks:
+        if _motor_webhooks is None:
+            import webhooks
+            _motor_webhooks = webhooks.MotorWebhooks()
+        return _motor_webhooks
+
+
+def iniciar_subscriber(processos=SUBSCRIBER_PROCESSOS, threads=SUBSCRIBER_THREADS,
+                       max_mensagens=SUBSCRIBER_MAX_MENSAGENS, max_bytes=SUBSCRIBER_MAX_BYTES):
+    """
+    Iniciar subscription para ouvir notificações
+    Com processos > 1 são lançados vários processos, cada um com o seu streaming pull,
+    threads e limites de fluxo; o Pub/Sub distribui as mensagens entre eles
+    """
     logger.info(f"🔊 Iniciando subscriber...")
     logger.info(f"📌 Projeto: {PROJECT_ID}")
     logger.info(f"📌 Subscription: {SUBSCRIPTION_ID}")
+    logger.info(f"📌 Processos: {processos}, threads: {threads}, "
+                f"fluxo: {max_mensagens} mensagens / {max_bytes // (1024 * 1024)} MB por processo")
     logger.info(f"Pressione Ctrl+C para sair\n")
     
-    # Criar subscription se não existir (opcional)
+    _garantir_subscription()
+    config = {'threads': threads, 'max_mensagens': max_mensagens, 'max_bytes': max_bytes}
+    
+    if processos <= 1:
+        _executar_subscriber(config)
+        return
+    
+    # 'spawn': os clientes gRPC não podem ser herdados por fork
+    contexto = multiprocessing.get_context('spawn')
+    fila_estatisticas = contexto.Queue()
+    filhos = [
+        contexto.Process(target=_executar_subscriber, args=(config, fila_estatisticas), name=f'subscriber-{i}')
+        for i in range(processos)
+    ]
+    for filho in filhos:
+        filho.start()
+    
+    try:
+        _agregar_estatisticas(filhos, fila_estatisticas)
+    except KeyboardInterrupt:
+        # Os processos filhos recebem o mesmo Ctrl+C e terminam por si
+        logger.info("\n⏹️  Parando subscribers...")
+    for filho in filhos:
+        filho.join()
+    logger.info("✅ Subscribers finalizados")
+
+
+def _garantir_subscription():
+    """Criar a subscription se não existir (uma vez, antes de lançar os processos)"""
+    subscriber = clientes.cliente('subscriber')
+    subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
     try:
         subscriber.get_subscription(request={"subscription": subscription_path})
     except:
@@ -116,16 +344,37 @@ def iniciar_subscriber():
         subscriber.create_subscription(
             request={"name": subscription_path, "topic": topic_path}
         )
+
+
+def _executar_subscriber(config, fila_estatisticas=None):
+    """Streaming pull neste processo, com o scheduler e o controlo de fluxo configurados"""
+    from google.cloud import pubsub_v1
+    from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+    global escritor
+    
+    if config['max_mensagens'] < LOTE_NOTIFICACOES:
+        logger.warning(f"max_mensagens ({config['max_mensagens']}) menor que o lote ({LOTE_NOTIFICACOES}): "
+                       f"os lotes só são gravados ao fim de {LOTE_ESPERA * 1000:.0f} ms")
+    
+    escritor = EscritorLotes()
+    subscriber = clientes.cliente('subscriber')
+    subscription_path = subscriber.subscription_path(PROJECT_ID, SUBSCRIPTION_ID)
+    executor = ThreadPoolExecutor(max_workers=config['threads'], thread_name_prefix='subscriber')
     
-    # Configurar streaming pull
     streaming_pull_future = subscriber.subscribe(
         subscription_path,
         callback=subscriber_callback,
-        flow_control=pubsub_v1.types.FlowControl(max_messages=10, max_bytes=1000*1024*1024),
+        flow_control=pubsub_v1.types.FlowControl(
+            max_messages=config['max_mensagens'], max_bytes=config['max_bytes']
+        ),
+        scheduler=ThreadScheduler(executor),
     )
+    threading.Thread(
+        target=_reportar_estatisticas, args=(fila_estatisticas,), name='subscriber-estatisticas', daemon=True
+    ).start()
     
     print("\n" + "=" * 60)
-    print("✅ Subscriber ativo! Aguardando notificações...")
+    print(f"✅ Subscriber ativo (pid {os.getpid()})! Aguardando notificações...")
     print("=" * 60 + "\n")
     
     try:
@@ -133,8 +382,52 @@ def iniciar_subscriber():
     except KeyboardInterrupt:
         logger.info("\n⏹️  Parando subscriber...")
         streaming_pull_future.cancel()
-        logger.info("✅ Subscriber finalizado")
+        escritor.fechar()
+        if _motor_webhooks is not None:
+            _motor_webhooks.fechar()
+        logger.info(f"✅ Subscriber finalizado - {escritor.estatisticas()} - {_formatar_resumo(estatisticas.resumo())}")
+
+
+def _reportar_estatisticas(fila_estatisticas):
+    """Registar as estatísticas deste processo a cada INTERVALO_ESTATISTICAS (e enviá-las ao processo pai)"""
+    while True:
+        time.sleep(INTERVALO_ESTATISTICAS)
+        resumo = estatisticas.resumo(reiniciar_janela=True)
+        logger.info(f"📈 [{os.getpid()}] {_formatar_resumo(resumo)}")
+        if _motor_webhooks is not None:
+            logger.info(f"🌐 [{os.getpid()}] Webhooks: {_motor_webhooks.estatisticas()}")
+        if fila_estatisticas is not None:
+            fila_estatisticas.put((os.getpid(), resumo))
+
+
+def _agregar_estatisticas(filhos, fila_estatisticas):
+    """No processo pai: registar o total de todos os processos enquanto houver algum ativo"""
+    ultimos = {}
+    while any(filho.is_alive() for filho in filhos):
+        try:
+            pid, resumo = fila_estatisticas.get(timeout=1)
+        except queue.Empty:
+            continue
+        ultimos[pid] = resumo
+        if len(ultimos) < sum(filho.is_alive() for filho in filhos):
+            continue
+        
+        total = {campo: sum(r[campo] for r in ultimos.values())
+                 for campo in ('msg_s', 'em_curso', 'reentregas', 'nack')}
+        total['ack_p50_ms'] = max(r['ack_p50_ms'] for r in ultimos.values())
+        total['ack_p95_ms'] = max(r['ack_p95_ms'] for r in ultimos.values())
+        logger.info(f"📊 Total ({len(ultimos)} processos): {_formatar_resumo(total)}")
+        ultimos = {}
 
 
 if __name__ == '__main__':
-    iniciar_subscriber()
+    parser = argparse.ArgumentParser(description='Subscriber das notificações de imagens processadas')
+    parser.add_argument('--processos', type=int, default=SUBSCRIBER_PROCESSOS)
+    parser.add_argument('--threads', type=int, default=SUBSCRIBER_THREADS, help='threads do callback por processo')
+    parser.add_argument('--max-mensagens', type=int, default=SUBSCRIBER_MAX_MENSAGENS,
+                        help='mensagens em mão por processo (controlo de fluxo)')
+    parser.add_argument('--max-mb', type=int, default=SUBSCRIBER_MAX_BYTES // (1024 * 1024),
+                        help='MB em mão por processo (controlo de fluxo)')
+    args = parser.parse_args()
+    
+    iniciar_subscriber(args.processos, args.threads, args.max_mensagens, args.max_mb * 1024 * 1024)
@@ -0,0 +1,78 @@
+"""
+Paginação por Cursor das Análises
+As listagens são ordenadas por data_processamento (desc) e ID do documento;
+o cursor é um token opaco com os valores do último documento da página,
+usado em start_after() para que o custo da página N não dependa de N
+"""
+from datetime import datetime
+import base64
+import bisect
+import json
+
+# Cabeçalho HTTP com o cursor da página seguinte (listagens que retornam uma lista JSON)
+CABECALHO_CURSOR = 'X-Proximo-Cursor'
+
+
+def codificar_cursor(data_processamento, doc_id):
+    """Criar o token do cursor a partir do último documento da página"""
+    if isinstance(data_processamento, datetime):
+        data_processamento = data_processamento.isoformat()
+    dados = json.dumps({'d': data_processamento, 'id': doc_id}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(dados.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decodificar_cursor(token):
+    """Retorna (data_processamento em ISO, doc_id); ValueError se o token for inválido"""
+    try:
+        preenchimento = '=' * (-len(token) % 4)
+        dados = json.loads(base64.urlsafe_b64decode(token + preenchimento))
+        return dados['d'], dados['id']
+    except Exception:
+        raise ValueError('Cursor inválido')
+
+
+def pagina_firestore(colecao, limit, cursor=None, campos=None):
+    """
+    Ler uma página de documentos a partir do cursor
+    Retorna (documentos, proximo_cursor); proximo_cursor é None na última página
+    """
+    query = colecao.order_by('data_processamento', direction='DESCENDING') \
+                   .order_by('__name__', direction='DESCENDING')
+    if campos is not None:
+        query = query.select(campos)
+
+    if cursor:
+        data_processamento, doc_id = decodificar_cursor(cursor)
+        query = query.start_after({
+            'data_processamento': datetime.fromisoformat(data_processamento),
+            '__name__': colecao.document(doc_id)
+        })
+
+    docs = list(query.limit(limit).stream())
+
+    proximo_cursor = None
+    if len(docs) == limit:
+        ultimo = docs[-1]
+        proximo_cursor = codificar_cursor(ultimo.get('data_processamento'), ultimo.id)
+
+    return docs, proximo_cursor
+
+
+def pagina_local(chaves, limit, cursor=None):
+    """
+    Mesma paginação para registos locais: 'chaves' é a lista de (data_processamento, id)
+    em ordem crescente; o cursor é localizado por pesquisa binária, O(log N + limit)
+    Retorna (chaves da página, do mais recente para o mais antigo, proximo_cursor)
+    """
+    fim = len(chaves)
+    if cursor:
+        fim = bisect.bisect_left(chaves, decodificar_cursor(cursor))
+
+    inicio = max(0, fim - limit)
+    pagina = chaves[inicio:fim][::-1]
+
+    proximo_cursor = None
+    if inicio > 0:
+        proximo_cursor = codificar_cursor(*pagina[-1])
+
+    return pagina, proximo_cursor
@@ -0,0 +1,259 @@
+"""
+Publicação de Notificações em Pub/Sub
+Um publicador partilhado por processo: publicar() só entrega a mensagem ao lote
+do cliente (BatchSettings) e regista um callback, sem esperar pela resposta.
+As mensagens que falham são guardadas numa fila em disco (uma mensagem JSON
+por linha) e reenviadas em lotes por uma thread em segundo plano.
+No fim do processo os lotes pendentes são enviados (atexit)
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import clientes
+
+logger = logging.getLogger(__name__)
+
+# Lotes do cliente Pub/Sub: o lote parte quando atinge qualquer um dos limites
+LOTE_MENSAGENS = int(os.environ.get('PUBSUB_LOTE_MENSAGENS', 100))
+LOTE_BYTES = int(os.environ.get('PUBSUB_LOTE_BYTES', 1024 * 1024))
+LOTE_LATENCIA = int(os.environ.get('PUBSUB_LOTE_LATENCIA_MS', 50)) / 1000
+
+# Fila em disco das mensagens que não foi possível publicar
+FILA_PENDENTES = os.environ.get(
+    'PUBSUB_FILA_PENDENTES', os.path.join(tempfile.gettempdir(), 'notificacoes_pendentes.jsonl')
+)
+REENVIO_INTERVALO = int(os.environ.get('PUBSUB_REENVIO_S', 30))
+REENVIO_LOTE = int(os.environ.get('PUBSUB_REENVIO_LOTE', 100))
+REENVIO_TIMEOUT = 60
+
+
+class Publicador:
+    """Publicador não bloqueante para um tópico, com fila em disco para as falhas"""
+
+    def __init__(self, projeto, topico, fila_pendentes=FILA_PENDENTES):
+        self.fila_pendentes = fila_pendentes
+        self._projeto = projeto
+        self._topico = topico
+        self._cliente = clientes.cliente(
+            'publisher', max_messages=LOTE_MENSAGENS, max_bytes=LOTE_BYTES, max_latency=LOTE_LATENCIA
+        )
+        self._topic_path = None
+        self._lock = threading.Lock()
+        self._lock_fila = threading.Lock()
+        self._thread = None
+        self._totais = {'publicadas': 0, 'falhadas': 0, 'em_curso': 0, 'reenviadas': 0}
+
+        atexit.register(self.fechar)
+        self._recuperar_reenvios()
+        if os.path.exists(fila_pendentes):
+            self._iniciar_reenvio()
+
+    def publicar(self, mensagem, **atributos):
+        """
+        Entregar a mensagem (dict) ao lote em curso; retorna de imediato
+        Retorna o futuro da publicação (None se o cliente a recusou e já foi para a fila em disco)
+        """
+        registo = {'mensagem': mensagem, 'atributos': atributos}
+        with self._lock:
+            self._totais['em_curso'] += 1
+        try:
+            futuro = self._publicar_registo(registo)
+        except Exception as e:
+            self._concluida(registo, erro=e)
+            return None
+        futuro.add_done_callback(lambda f: self._concluida(registo, futuro=f))
+        return futuro
+
+    def publicar_e_aguardar(self, mensagem, timeout=REENVIO_TIMEOUT, **atributos):
+        """
+        Publicar e esperar pela confirmação (ambientes serverless, em que o CPU é
+        limitado e a instância pode terminar assim que a invocação retorna)
+        Retorna True se a mensagem foi publicada; as falhas vão para a fila em disco
+        """
+        futuro = self.publicar(mensagem, **atributos)
+        if futuro is None:
+            return False
+        try:
+            futuro.result(timeout=timeout)
+            return True
+        except Exception as e:
+            logger.warning(f"Notificação não confirmada em {timeout} s: {str(e)}")
+            return False
+
+    def pendentes(self):
+        """Número de mensagens à espera de reenvio na fila em disco"""
+        with self._lock_fila:
+            try:
+                with open(self.fila_pendentes, encoding='utf-8') as f:
+                    return sum(1 for _ in f)
+            except FileNotFoundError:
+                return 0
+
+    def estatisticas(self):
+        pendentes = self.pendentes()
+        with self._lock:
+            return {**self._totais, 'pendentes_disco': pendentes}
+
+    def reenviar_pendentes(self):
+        """
+        Reenviar as mensagens da fila em disco, em lotes de REENVIO_LOTE
+        Se um lote falhar por completo (Pub/Sub indisponível) pára e deixa o resto para depois
+        Retorna o número de mensagens reenviadas
+        """
+        registos, a_reenviar = self._retirar_fila()
+        reenviadas = 0
+
+        for inicio in range(0, len(registos), REENVIO_LOTE):
+            lote = registos[inicio:inicio + REENVIO_LOTE]
+            futuros = []
+            for registo in lote:
+                try:
+                    futuros.append((registo, self._publicar_registo(registo)))
+                except Exception:
+                    futuros.append((registo, None))
+
+            falhadas = []
+            for registo, futuro in futuros:
+                try:
+                    if futuro is None:
+                        raise RuntimeError('publicação recusada')
+                    futuro.result(timeout=REENVIO_TIMEOUT)
+                except Exception:
+                    falhadas.append(registo)
+
+            reenviadas += len(lote) - len(falhadas)
+            if falhadas:
+                self._guardar_fila(falhadas)
+            if len(falhadas) == len(lote):
+                self._guardar_fila(registos[inicio + REENVIO_LOTE:])
+                break
+
+        if a_reenviar:
+            os.remove(a_reenviar)
+
+        if reenviadas:
+            with self._lock:
+                self._totais['reenviadas'] += reenviadas
+            logger.info(f"Notificações pendentes reenviadas: {reenviadas}")
+        return reenviadas
+
+    def fechar(self):
+        """Enviar os lotes em curso e parar o cliente (as falhas vão para a fila em disco)"""
+        if self._cliente.criado:
+            try:
+                self._cliente.stop()
+            except Exception as e:
+                logger.warning(f"Erro ao terminar o publicador Pub/Sub: {str(e)}")
+
+    def _concluida(self, registo, futuro=None, erro=None):
+        """Callback de cada publicação (corre na thread do cliente Pub/Sub)"""
+        if erro is None:
+            erro = futuro.exception()
+
+        with self._lock:
+            self._totais['em_curso'] -= 1
+            self._totais['falhadas' if erro else 'publicadas'] += 1
+
+        if erro:
+            logger.warning(f"Notificação não publicada, guardada para reenvio: {str(erro)}")
+            try:
+                self._guardar_fila([registo])
+            except OSError as e:
+                logger.error(f"Notificação perdida, não foi possível guardá-la em disco: {str(e)}")
+
+    def _publicar_registo(self, registo):
+        if self._topic_path is None:
+            self._topic_path = self._cliente.topic_path(self._projeto, self._topico)
+        dados = json.dumps(registo['mensagem'], default=str).encode('utf-8')
+        return self._cliente.publish(self._topic_path, dados, **(registo.get('atributos') or {}))
+
+    def _guardar_fila(self, registos):
+        if not registos:
+            return
+        with self._lock_fila:
+            with open(self.fila_pendentes, 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(registo, default=str) + '\n' for registo in registos)
+        self._iniciar_reenvio()
+
+    def _retirar_fila(self):
+        """
+        Retirar as mensagens da fila em disco; retorna (registos, ficheiro a apagar no fim)
+        A fila é renomeada, para não perder linhas escritas entretanto por outro processo,
+        e o ficheiro renomeado só é apagado depois do reenvio (as falhas voltam à fila)
+        O nome é único por reenvio: a thread de reenvio e uma chamada direta podem correr ao mesmo tempo
+        """
+        a_reenviar = f"{self.fila_pendentes}.{os.getpid()}.{uuid.uuid4().hex}.reenvio"
+        with self._lock_fila:
+            try:
+                os.replace(self.fila_pendentes, a_reenviar)
+            except FileNotFoundError:
+                return [], None
+        with open(a_reenviar, encoding='utf-8') as f:
+            linhas = f.readlines()
+
+        registos = []
+        for linha in linhas:
+            try:
+                registos.append(json.loads(linha))
+            except ValueError:
+                # Linha truncada (processo terminado a meio da escrita)
+                logger.warning("Linha inválida ignorada na fila de notificações pendentes")
+        return registos, a_reenviar
+
+    def _recuperar_reenvios(self):
+        """
+        Devolver à fila os ficheiros de reenvio deixados por processos que terminaram
+        a meio de um reenvio (os de processos ainda vivos estão em curso e ficam)
+        """
+        for ficheiro in glob.glob(f"{glob.escape(self.fila_pendentes)}.*.reenvio"):
+            try:
+                pid = int(ficheiro[len(self.fila_pendentes) + 1:-len('.reenvio')].split('.')[0])
+            except ValueError:
+                continue
+            if pid != os.getpid() and _processo_ativo(pid):
+                continue
+
+            with self._lock_fila:
+                try:
+                    with open(ficheiro, encoding='utf-8') as origem:
+                        linhas = [linha if linha.endswith('\n') else linha + '\n' for linha in origem]
+                except FileNotFoundError:
+                    continue
+                with open(self.fila_pendentes, 'a', encoding='utf-8') as destino:
+                    destino.writelines(linhas)
+                os.remove(ficheiro)
+            logger.info(f"Recuperadas {len(linhas)} notificações de um reenvio interrompido ({ficheiro})")
+
+    def _iniciar_reenvio(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._ciclo_reenvio, name='pubsub-reenvio', daemon=True)
+                self._thread.start()
+
+    def _ciclo_reenvio(self):
+        while True:
+            time.sleep(REENVIO_INTERVALO)
+            try:
+                self.reenviar_pendentes()
+            except Exception as e:
+                logger.warning(f"Erro no reenvio das notificações pendentes: {str(e)}")
+
+
+def _processo_ativo(pid):
+    """Se o processo 'pid' ainda existe (no Windows, sem sinal 0, assume-se que sim)"""
+    if os.name == 'nt':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,128 @@
+"""
+Tarefas em Segundo Plano
+Registo em memória de tarefas executadas num pool de threads,
+com estado e progresso consultáveis em /api/jobs/<id>
+Nota: o registo é por processo; com gunicorn usar um worker com várias threads
+(ex: gunicorn --workers 1 --threads 8) para que o estado seja visível em todos os pedidos
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Estados possíveis de uma tarefa
+PENDENTE = 'pendente'
+EM_EXECUCAO = 'em_execucao'
+CONCLUIDA = 'concluida'
+ERRO = 'erro'
+
+
+class FilaCheia(Exception):
+    """A fila de tarefas pendentes atingiu o limite (max_pendentes)"""
+
+
+class Tarefa:
+    """Estado de uma tarefa; a função executada atualiza o progresso com atualizar()"""
+
+    def __init__(self, tipo):
+        self.id = uuid.uuid4().hex
+        self.tipo = tipo
+        self.estado = PENDENTE
+        self.progresso = {}
+        self.resultado = None
+        self.erro = None
+        self.criada_em = datetime.now()
+        self.atualizada_em = self.criada_em
+        self._lock = threading.Lock()
+
+    def atualizar(self, **progresso):
+        with self._lock:
+            self.progresso.update(progresso)
+            self.atualizada_em = datetime.now()
+
+    def para_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'tipo': self.tipo,
+                'estado': self.estado,
+                'progresso': dict(self.progresso),
+                'resultado': self.resultado,
+                'erro': self.erro,
+                'criada_em': self.criada_em.isoformat(),
+                'atualizada_em': self.atualizada_em.isoformat()
+            }
+
+
+class RegistoTarefas:
+    """
+    Executa tarefas num pool de threads e guarda as últimas 'max_tarefas'
+    Com 'max_pendentes', criar() rejeita novas tarefas (FilaCheia) quando já há
+    esse número à espera de um worker, em vez de deixar a fila crescer sem limite
+    """
+
+    def __init__(self, max_workers=2, max_tarefas=200, max_pendentes=None, prefixo='tarefa'):
+        self.max_workers = max_workers
+        self.max_tarefas = max_tarefas
+        self.max_pendentes = max_pendentes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=prefixo)
+        self._tarefas = OrderedDict()
+        self._pendentes = 0
+        self._em_execucao = 0
+        self._lock = threading.Lock()
+
+    def criar(self, tipo, funcao, *args, **kwargs):
+        """
+        Agendar funcao(tarefa, *args, **kwargs); o valor retornado fica em tarefa.resultado
+        Retorna a Tarefa criada; FilaCheia se a fila de pendentes estiver no limite
+        """
+        tarefa = Tarefa(tipo)
+        with self._lock:
+            if self.max_pendentes is not None and self._pendentes >= self.max_pendentes:
+                raise FilaCheia(f'Fila cheia ({self._pendentes} tarefas pendentes)')
+            self._pendentes += 1
+            self._tarefas[tarefa.id] = tarefa
+            while len(self._tarefas) > self.max_tarefas:
+                self._tarefas.popitem(last=False)
+
+        self._executor.submit(self._executar, tarefa, funcao, args, kwargs)
+        logger.info(f"Tarefa {tipo} criada: {tarefa.id}")
+        return tarefa
+
+    def obter(self, tarefa_id):
+        """Estado da tarefa como dict, ou None se não existir"""
+        with self._lock:
+            tarefa = self._tarefas.get(tarefa_id)
+        return tarefa.para_dict() if tarefa else None
+
+    def estatisticas(self):
+        """Ocupação do pool e da fila"""
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'em_execucao': self._em_execucao,
+                'pendentes': self._pendentes,
+                'max_pendentes': self.max_pendentes
+            }
+
+    def _executar(self, tarefa, funcao, args, kwargs):
+        with self._lock:
+            self._pendentes -= 1
+            self._em_execucao += 1
+        tarefa.estado = EM_EXECUCAO
+        tarefa.atualizar()
+        try:
+            tarefa.resultado = funcao(tarefa, *args, **kwargs)
+            tarefa.estado = CONCLUIDA
+            logger.info(f"Tarefa {tarefa.tipo} concluída: {tarefa.id}")
+        except Exception as e:
+            tarefa.erro = str(e)
+            tarefa.estado = ERRO
+            logger.error(f"Erro na tarefa {tarefa.tipo} {tarefa.id}: {str(e)}")
+        with self._lock:
+            self._em_execucao -= 1
+        tarefa.atualizar()
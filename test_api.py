@@ -4,7 +4,12 @@ Exemplos de testes para o fluxo de processamento de imagens
 
 import requests
 import json
+import os
+import tempfile
+import threading
+import time
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # Configurações
 BASE_URL_UPLOAD = "http://localhost:5000"
@@ -287,6 +292,106 @@ def teste_obter_safe_search(doc_id):
         print_error(f"Erro ao obter análise: {e}")
 
 
+# ============================================================================
+# TESTE 9: Motor de Webhooks (servidores HTTP locais)
+# ============================================================================
+
+def _servidor_webhooks(atraso=0, falhas_iniciais=0):
+    """Servidor HTTP local que imita um destino de webhooks; retorna (servidor, estado)"""
+    estado = {'recebidos': [], 'em_curso': 0, 'max_em_curso': 0, 'falhas': falhas_iniciais}
+    lock = threading.Lock()
+    
+    class Destino(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+        
+        def do_POST(self):
+            corpo = self.rfile.read(int(self.headers['Content-Length']))
+            with lock:
+                estado['em_curso'] += 1
+                estado['max_em_curso'] = max(estado['max_em_curso'], estado['em_curso'])
+                falhar = estado['falhas'] > 0
+                estado['falhas'] -= falhar
+            time.sleep(atraso)
+            
+            if self.path == '/rejeita':
+                codigo = 400
+            elif falhar:
+                codigo = 503
+            else:
+                codigo = 200
+                with lock:
+                    estado['recebidos'].append(json.loads(corpo))
+            with lock:
+                estado['em_curso'] -= 1
+            
+            self.send_response(codigo)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        
+        def log_message(self, *args):
+            pass
+    
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), Destino)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor, estado
+
+
+def teste_webhooks():
+    print_header("TESTE 9: Motor de Webhooks (servidores locais)")
+    import webhooks
+    
+    webhooks.ESPERA_BASE = 0.05  # repetições rápidas no teste
+    rapido, estado_rapido = _servidor_webhooks(falhas_iniciais=3)
+    lento, estado_lento = _servidor_webhooks(atraso=0.5)
+    url_rapido = f"http://127.0.0.1:{rapido.server_port}"
+    url_lento = f"http://127.0.0.1:{lento.server_port}"
+    
+    pasta = tempfile.mkdtemp()
+    motor = webhooks.MotorWebhooks(caminho=os.path.join(pasta, 'fila.db'), workers=8, por_destino=2)
+    
+    try:
+        print_info("A agendar 20 webhooks para um destino lento e 20 para um destino rápido (3 falhas 503)...")
+        inicio = time.perf_counter()
+        for i in range(20):
+            motor.enviar(f"{url_lento}/notificacao", {'i': i})
+            motor.enviar(f"{url_rapido}/notificacao", {'i': i})
+        motor.enviar(f"{url_rapido}/rejeita", {'i': -1})
+        print_info(f"Agendamento: {(time.perf_counter() - inicio) * 1000:.1f} ms para 41 webhooks")
+        
+        # O destino rápido não pode ficar à espera do lento
+        limite = time.monotonic() + 10
+        while len(estado_rapido['recebidos']) < 20 and time.monotonic() < limite:
+            time.sleep(0.05)
+        if len(estado_rapido['recebidos']) == 20 and len(estado_lento['recebidos']) < 20:
+            print_success(f"Destino rápido servido em {time.perf_counter() - inicio:.1f} s, "
+                          f"com o lento ainda em {len(estado_lento['recebidos'])}/20")
+        else:
+            print_error("O destino lento atrasou as entregas ao destino rápido")
+        
+        if motor.aguardar(timeout=30):
+            print_success("Todas as entregas concluídas")
+        else:
+            print_error("Ficaram entregas por fazer")
+        
+        estatisticas = motor.estatisticas()
+        print_info(f"Estatísticas: {json.dumps(estatisticas)}")
+        
+        verificacoes = [
+            (sorted(d['i'] for d in estado_rapido['recebidos']) == list(range(20)), "destino rápido recebeu tudo, com repetições"),
+            (sorted(d['i'] for d in estado_lento['recebidos']) == list(range(20)), "destino lento recebeu tudo"),
+            (estado_lento['max_em_curso'] <= 2, f"máximo de pedidos em curso no destino lento: {estado_lento['max_em_curso']} (limite 2)"),
+            (estatisticas['falhadas_fila'] == 1, "resposta 400 marcada como falhada sem novas tentativas"),
+            (estatisticas['repetidas'] >= 3, f"{estatisticas['repetidas']} novas tentativas após 503"),
+        ]
+        for ok, descricao in verificacoes:
+            (print_success if ok else print_error)(descricao)
+        return all(ok for ok, _ in verificacoes)
+    finally:
+        motor.fechar()
+        rapido.shutdown()
+        lento.shutdown()
+
+
 # ============================================================================
 # MENU INTERATIVO
 # ============================================================================
@@ -305,6 +410,7 @@ def menu_principal():
   6. Obter Texto (OCR)
   7. Obter Rostos
   8. Obter Análise de Segurança
+  9. Motor de Webhooks (servidores locais)
   0. Sair
         """)
         
@@ -358,6 +464,9 @@ def menu_principal():
             else:
                 print_error("ID inválido")
                 
+        elif opcao == "9":
+            teste_webhooks()
+                
         elif opcao == "0":
             print_success("Até logo!")
             break
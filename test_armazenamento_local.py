@@ -0,0 +1,24 @@
+"""
+Testes do armazenamento local (python -m pytest test_armazenamento_local.py)
+"""
+import armazenamento_local
+
+
+def test_limpar_e_voltar_a_inserir(tmp_path):
+    """Depois de limpar(), os novos registos não podem devolver dados dos apagados"""
+    armazenamento = armazenamento_local.ArmazenamentoLog(str(tmp_path / 'analises.log'))
+    for i in range(5):
+        armazenamento.inserir({'id': f'a{i}', 'data_processamento': f'2026-01-0{i + 1}', 'valor': 'antigo'})
+    # A leitura enche o buffer do leitor com o início do ficheiro
+    assert armazenamento.obter('a0')['valor'] == 'antigo'
+
+    assert armazenamento.limpar() == 5
+
+    for i in range(5):
+        armazenamento.inserir({'id': f'b{i}', 'data_processamento': f'2026-02-0{i + 1}', 'valor': 'novo'})
+    for i in range(5):
+        assert armazenamento.obter(f'b{i}') == {
+            'id': f'b{i}', 'data_processamento': f'2026-02-0{i + 1}', 'valor': 'novo'
+        }
+    assert armazenamento.obter('a0') is None
+    assert len(armazenamento) == 5
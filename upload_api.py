@@ -2,9 +2,11 @@
 API para Upload de Imagens para Google Cloud Storage
 """
 from flask import Flask, request, jsonify
-from google.cloud import storage
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
+import threading
+
+import clientes
 
 app = Flask(__name__)
 
@@ -12,10 +14,19 @@ app = Flask(__name__)
 BUCKET_NAME = "meu-bucket-imagens"
 INPUT_FOLDER = "input/"
 PROJECT_ID = "projectcloud-484416"
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# URLs assinadas para upload direto ao bucket
+URL_VALIDADE = timedelta(minutes=int(os.environ.get('UPLOAD_URL_VALIDADE_MIN', 15)))
+TAMANHO_MAX_UPLOAD = int(os.environ.get('UPLOAD_MAX_MB', 20)) * 1024 * 1024
+
+# Cliente do Storage (criado no primeiro upload, ver clientes.py)
+storage_client = clientes.cliente('storage', project=PROJECT_ID)
+bucket = clientes.preguicoso(lambda: storage_client.bucket(BUCKET_NAME), 'bucket')
 
-# Inicializar cliente do Storage
-storage_client = storage.Client(project=PROJECT_ID)
-bucket = storage_client.bucket(BUCKET_NAME)
+# Credenciais usadas para assinar os URLs (obtidas uma vez, renovadas só quando expiram)
+_credenciais = None
+_lock_credenciais = threading.Lock()
 
 
 @app.route('/upload', methods=['POST'])
@@ -38,15 +49,11 @@ def upload_imagem():
             return jsonify({'erro': 'Nome de arquivo vazio'}), 400
         
         # Validar tipo de arquivo
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
-        ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
-        
-        if ext not in allowed_extensions:
-            return jsonify({'erro': f'Tipo de arquivo não permitido. Use: {allowed_extensions}'}), 400
+        if not _extensao_permitida(file.filename):
+            return jsonify({'erro': f'Tipo de arquivo não permitido. Use: {ALLOWED_EXTENSIONS}'}), 400
         
         # Gerar nome único com timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        nome_arquivo = f"{INPUT_FOLDER}{timestamp}_{file.filename}"
+        timestamp, nome_arquivo = _nome_destino(file.filename)
         
         # Fazer upload para Cloud Storage
         blob = bucket.blob(nome_arquivo)
@@ -64,6 +71,133 @@ def upload_imagem():
         return jsonify({'erro': str(e)}), 500
 
 
+@app.route('/upload/url', methods=['POST'])
+def url_upload():
+    """
+    Endpoint para obter um URL de upload direto para o bucket (input/)
+    O cliente envia a imagem para o URL devolvido, sem passar pela API;
+    a Cloud Function processa o ficheiro quando o upload termina
+    Esperado (JSON): {"nome_arquivo": "foto.jpg", "content_type": "image/jpeg",
+                      "resumivel": false, "tamanho": 123456}
+    'tamanho' (bytes) é obrigatório e limita o upload: o GCS recusa um ficheiro maior
+    Sem 'resumivel' retorna um URL assinado V4 para PUT (válido UPLOAD_URL_VALIDADE_MIN minutos);
+    com 'resumivel' retorna o URL de uma sessão de upload resumível com esse tamanho
+    
+    Exemplo com curl:
+    curl -X POST -H "Content-Type: application/json" \\
+         -d '{"nome_arquivo": "imagem.jpg", "content_type": "image/jpeg", "tamanho": 123456}' \\
+         http://localhost:5000/upload/url
+    curl -X PUT -H "Content-Type: image/jpeg" -H "x-goog-content-length-range: 0,123456" \\
+         --upload-file imagem.jpg "<url>"
+    """
+    try:
+        dados = request.get_json(silent=True) or {}
+        nome = os.path.basename(dados.get('nome_arquivo', ''))
+        content_type = dados.get('content_type', '')
+        tamanho = dados.get('tamanho')
+        
+        if not nome:
+            return jsonify({'erro': 'Nome de arquivo vazio'}), 400
+        if not _extensao_permitida(nome):
+            return jsonify({'erro': f'Tipo de arquivo não permitido. Use: {ALLOWED_EXTENSIONS}'}), 400
+        if not content_type.startswith('image/'):
+            return jsonify({'erro': 'content_type deve ser image/*'}), 400
+        # bool é subclasse de int: true/false não são tamanhos
+        if isinstance(tamanho, bool) or not isinstance(tamanho, int) or not 0 < tamanho <= TAMANHO_MAX_UPLOAD:
+            return jsonify({'erro': f'tamanho (bytes) obrigatório, entre 1 e {TAMANHO_MAX_UPLOAD}'}), 400
+        
+        timestamp, nome_arquivo = _nome_destino(nome)
+        blob = bucket.blob(nome_arquivo)
+        
+        if dados.get('resumivel'):
+            # A sessão é iniciada aqui; o cliente envia os bytes (em partes) para o URL
+            url = blob.create_resumable_upload_session(
+                content_type=content_type,
+                size=tamanho,
+                origin=request.headers.get('Origin')
+            )
+            cabecalhos = {'Content-Type': content_type}
+            # O GCS mantém as sessões resumíveis durante uma semana
+            expira_em = datetime.now(timezone.utc) + timedelta(days=7)
+        else:
+            cabecalhos = {
+                'Content-Type': content_type,
+                'x-goog-content-length-range': f'0,{tamanho}'
+            }
+            url = blob.generate_signed_url(
+                version='v4',
+                expiration=URL_VALIDADE,
+                method='PUT',
+                content_type=content_type,
+                headers={'x-goog-content-length-range': cabecalhos['x-goog-content-length-range']},
+                **_credenciais_assinatura()
+            )
+            expira_em = datetime.now(timezone.utc) + URL_VALIDADE
+        
+        return jsonify({
+            'sucesso': True,
+            'url': url,
+            'metodo': 'PUT',
+            'cabecalhos': cabecalhos,
+            'resumivel': bool(dados.get('resumivel')),
+            'blob_path': nome_arquivo,
+            'bucket': BUCKET_NAME,
+            'timestamp': timestamp,
+            'expira_em': expira_em.isoformat()
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'erro': str(e)}), 500
+
+
+class CredenciaisSemAssinatura(Exception):
+    """As credenciais do ambiente não permitem assinar URLs (ex: credenciais de utilizador)"""
+
+
+def _extensao_permitida(nome):
+    ext = nome.rsplit('.', 1)[1].lower() if '.' in nome else ''
+    return ext in ALLOWED_EXTENSIONS
+
+
+def _nome_destino(nome):
+    """Nome único do blob em input/ (prefixo com timestamp)"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return timestamp, f"{INPUT_FOLDER}{timestamp}_{nome}"
+
+
+def _credenciais_assinatura():
+    """
+    Argumentos extra para assinar URLs V4
+    Com uma chave de conta de serviço a assinatura é local; nas credenciais do
+    ambiente (Cloud Run, Compute Engine) é feita pela API IAM signBlob
+    As credenciais são obtidas uma vez e o token só é renovado quando expira
+    """
+    global _credenciais
+    import google.auth
+    from google.auth import credentials as google_credentials
+    from google.auth.transport import requests as google_requests
+    
+    with _lock_credenciais:
+        if _credenciais is None:
+            _credenciais, _ = google.auth.default()
+        credenciais = _credenciais
+        if isinstance(credenciais, google_credentials.Signing):
+            return {}
+        
+        if not hasattr(credenciais, 'service_account_email'):
+            raise CredenciaisSemAssinatura(
+                'As credenciais do ambiente não são de uma conta de serviço e não podem assinar URLs; '
+                'use GOOGLE_APPLICATION_CREDENTIALS com uma chave de conta de serviço '
+                'ou "resumivel": true'
+            )
+        if not credenciais.valid:
+            credenciais.refresh(google_requests.Request())
+        return {
+            'service_account_email': credenciais.service_account_email,
+            'access_token': credenciais.token
+        }
+
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
@@ -77,6 +211,7 @@ def index():
         'api': 'Upload de Imagens - Google Cloud',
         'endpoints': {
             'POST /upload': 'Fazer upload de imagem (multipart/form-data)',
+            'POST /upload/url': 'Obter URL assinado (ou sessão resumível) para upload direto ao bucket',
             'GET /health': 'Verificar status da API'
         }
     }), 200
@@ -0,0 +1,113 @@
+"""
+Upload em Lote
+Lê as imagens de um pedido (vários ficheiros multipart, ou um arquivo zip enviado
+como ficheiro ou no corpo do pedido) uma de cada vez para ficheiros temporários
+(ver ingestao.py) e processa-as num pool partilhado, com um número limitado de
+imagens em curso por pedido. Os resultados são emitidos pela ordem em que terminam
+"""
+from concurrent.futures import wait, FIRST_COMPLETED
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+
+import ingestao
+
+logger = logging.getLogger(__name__)
+
+# Configuração
+EXTENSOES_PERMITIDAS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+LOTE_WORKERS = int(os.environ.get('UPLOAD_LOTE_WORKERS', 8))
+LOTE_JANELA = int(os.environ.get('UPLOAD_LOTE_JANELA', 16))  # imagens em curso por pedido
+
+# Zip no corpo do pedido: fica em memória até este tamanho, depois passa para disco
+TAMANHO_SPOOL = 16 * 1024 * 1024
+TIPOS_ZIP = {'application/zip', 'application/x-zip-compressed'}
+
+
+def extensao_permitida(nome):
+    return os.path.splitext(nome)[1].lower() in EXTENSOES_PERMITIDAS
+
+
+def ler_imagens(pedido):
+    """
+    Gerador de (nome, FicheiroRecebido, erro) para cada imagem do pedido
+    Aceita os campos multipart 'files' (repetido) e 'file', ficheiros .zip entre eles,
+    ou um zip no corpo do pedido (Content-Type: application/zip)
+    """
+    if pedido.mimetype in TIPOS_ZIP:
+        with tempfile.SpooledTemporaryFile(max_size=TAMANHO_SPOOL) as temporario:
+            shutil.copyfileobj(pedido.stream, temporario, 1024 * 1024)
+            temporario.seek(0)
+            yield from _imagens_zip('pedido.zip', temporario)
+        return
+
+    for ficheiro in pedido.files.getlist('files') + pedido.files.getlist('file'):
+        if ficheiro.filename.lower().endswith('.zip'):
+            yield from _imagens_zip(ficheiro.filename, ficheiro.stream)
+        elif not extensao_permitida(ficheiro.filename):
+            yield ficheiro.filename, None, 'Tipo de arquivo não permitido'
+        else:
+            yield _receber(ficheiro.filename, ficheiro.stream)
+
+
+def _imagens_zip(nome_zip, ficheiro):
+    """Ler as imagens de um zip, uma entrada de cada vez"""
+    try:
+        arquivo = zipfile.ZipFile(ficheiro)
+    except zipfile.BadZipFile:
+        yield nome_zip, None, 'Arquivo zip inválido'
+        return
+
+    with arquivo:
+        for info in arquivo.infolist():
+            nome = os.path.basename(info.filename)
+            if info.is_dir() or not nome or nome.startswith('.') or info.filename.startswith('__MACOSX/'):
+                continue
+            if not extensao_permitida(nome):
+                yield nome, None, 'Tipo de arquivo não permitido'
+            else:
+                with arquivo.open(info) as entrada:
+                    yield _receber(nome, entrada)
+
+
+def _receber(nome, origem):
+    """Copiar uma imagem para disco; (nome, FicheiroRecebido, None) ou (nome, None, erro)"""
+    try:
+        return nome, ingestao.receber(origem, nome), None
+    except (ValueError, zipfile.BadZipFile) as e:
+        return nome, None, str(e)
+
+
+def processar_em_paralelo(executor, imagens, processar, janela=LOTE_JANELA):
+    """
+    Aplicar processar(nome, ficheiro) -> dict a cada imagem no executor
+    Gerador de um dict por imagem ('arquivo', 'sucesso' e o resultado ou 'erro'),
+    pela ordem de conclusão; no máximo 'janela' imagens em curso de cada vez
+    """
+    em_curso = {}
+
+    for nome, ficheiro, erro in imagens:
+        if erro:
+            yield {'arquivo': nome, 'sucesso': False, 'erro': erro}
+            continue
+
+        while len(em_curso) >= janela:
+            yield from _recolher(em_curso)
+        em_curso[executor.submit(processar, nome, ficheiro)] = nome
+
+    while em_curso:
+        yield from _recolher(em_curso)
+
+
+def _recolher(em_curso):
+    """Esperar por pelo menos uma imagem em curso e emitir as que terminaram"""
+    concluidos, _ = wait(em_curso, return_when=FIRST_COMPLETED)
+    for futuro in concluidos:
+        nome = em_curso.pop(futuro)
+        try:
+            yield {'arquivo': nome, 'sucesso': True, **futuro.result()}
+        except Exception as e:
+            logger.error(f"Erro ao processar {nome}: {str(e)}")
+            yield {'arquivo': nome, 'sucesso': False, 'erro': str(e)}
@@ -0,0 +1,282 @@
+"""
+Envio de Webhooks
+Motor de entrega com uma requests.Session partilhada (ligações keep-alive em pool),
+um número limitado de pedidos em curso por destino, novas tentativas com espera
+exponencial e jitter, e uma fila persistente em SQLite. enviar() só grava a entrega
+na fila: o envio corre nas threads do motor, por isso um destino lento não atrasa
+o processamento (nem o ack) das mensagens Pub/Sub.
+Vários processos podem partilhar a mesma fila: cada entrega é reclamada com um
+UPDATE atómico que a adia pelo tempo do envio
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Configuração
+WEBHOOKS_FILA = os.environ.get('WEBHOOKS_FILA', 'webhooks_pendentes.db')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', 16))
+WEBHOOK_POR_DESTINO = int(os.environ.get('WEBHOOK_POR_DESTINO', 4))  # pedidos em curso por host
+WEBHOOK_TIMEOUT = (3, int(os.environ.get('WEBHOOK_TIMEOUT_S', 10)))  # (ligação, leitura)
+WEBHOOK_MAX_TENTATIVAS = int(os.environ.get('WEBHOOK_MAX_TENTATIVAS', 8))
+ESPERA_BASE = 1     # segundos antes da 2ª tentativa (duplica a cada falha)
+ESPERA_MAX = 600    # limite da espera entre tentativas
+
+# Respostas 4xx que vale a pena repetir; as restantes falham de imediato
+REPETIR_4XX = {408, 425, 429}
+
+# Estados das entregas na fila
+PENDENTE = 'pendente'
+FALHADA = 'falhada'
+
+
+class MotorWebhooks:
+    """Entrega de webhooks em segundo plano a partir de uma fila SQLite"""
+
+    def __init__(self, caminho=WEBHOOKS_FILA, workers=WEBHOOK_WORKERS, por_destino=WEBHOOK_POR_DESTINO,
+                 timeout=WEBHOOK_TIMEOUT, max_tentativas=WEBHOOK_MAX_TENTATIVAS):
+        self.caminho = caminho
+        self.workers = workers
+        self.por_destino = por_destino
+        self.timeout = timeout
+        self.max_tentativas = max_tentativas
+        # Uma entrega reclamada fica adiada por este tempo; se o processo morrer a meio volta à fila
+        self.prazo_reclamacao = sum(timeout) + 30
+
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS entregas ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, destino TEXT NOT NULL, url TEXT NOT NULL, '
+                'corpo TEXT NOT NULL, estado TEXT NOT NULL, tentativas INTEGER NOT NULL DEFAULT 0, '
+                'proxima REAL NOT NULL, erro TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_entregas_proxima ON entregas (estado, destino, proxima)')
+
+        # Pool de ligações keep-alive: uma por worker e por host
+        self.sessao = requests.Session()
+        adaptador = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=0)
+        self.sessao.mount('http://', adaptador)
+        self.sessao.mount('https://', adaptador)
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook')
+        self._condicao = threading.Condition()
+        self._em_curso = {}  # destino -> número de pedidos em curso
+        self._fechado = False
+        self._totais = {'entregues': 0, 'falhadas': 0, 'repetidas': 0}
+        self._latencias = []
+
+        self._thread = threading.Thread(target=self._ciclo, name='webhooks', daemon=True)
+        self._thread.start()
+
+    def _conn(self):
+        """Uma ligação por thread (em WAL as leituras não bloqueiam a escrita)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.caminho, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    # ------------------------------------------------------------------------
+    # Operações
+    # ------------------------------------------------------------------------
+
+    def enviar(self, url, dados):
+        """Gravar a entrega na fila (retorna de imediato); o envio é feito pelo motor"""
+        with self._conn() as conn:
+            conn.execute(
+                'INSERT INTO entregas (destino, url, corpo, estado, proxima) VALUES (?, ?, ?, ?, ?)',
+                (_destino(url), url, json.dumps(dados, default=str), PENDENTE, time.time())
+            )
+        with self._condicao:
+            self._condicao.notify()
+
+    def estatisticas(self):
+        """Totais, entregas na fila (pendentes / falhadas), pedidos em curso e latência"""
+        contagens = dict(self._conn().execute('SELECT estado, COUNT(*) FROM entregas GROUP BY estado').fetchall())
+        with self._condicao:
+            latencias = sorted(self._latencias)
+            return {
+                **self._totais,
+                'pendentes': contagens.get(PENDENTE, 0),
+                'falhadas_fila': contagens.get(FALHADA, 0),
+                'em_curso': dict(self._em_curso),
+                'latencia_p50_ms': latencias[len(latencias) // 2] * 1000 if latencias else 0,
+                'latencia_p95_ms': latencias[int(len(latencias) * 0.95)] * 1000 if latencias else 0,
+            }
+
+    def repetir_falhadas(self):
+        """Devolver à fila as entregas que esgotaram as tentativas; retorna quantas"""
+        with self._conn() as conn:
+            n = conn.execute(
+                'UPDATE entregas SET estado = ?, tentativas = 0, proxima = ? WHERE estado = ?',
+                (PENDENTE, time.time(), FALHADA)
+            ).rowcount
+        with self._condicao:
+            self._condicao.notify()
+        return n
+
+    def aguardar(self, timeout=None):
+        """Esperar até não haver entregas pendentes nem em curso; True se a fila esvaziou"""
+        limite = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condicao:
+                em_curso = sum(self._em_curso.values())
+            pendentes = self._conn().execute(
+                'SELECT COUNT(*) FROM entregas WHERE estado = ?', (PENDENTE,)
+            ).fetchone()[0]
+            if not em_curso and not pendentes:
+                return True
+            if limite is not None and time.monotonic() >= limite:
+                return False
+            time.sleep(0.05)
+
+    def fechar(self):
+        """Parar o motor; as entregas por fazer ficam na fila para o próximo arranque"""
+        with self._condicao:
+            self._fechado = True
+            self._condicao.notify()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        self.sessao.close()
+
+    # ------------------------------------------------------------------------
+    # Envio
+    # ------------------------------------------------------------------------
+
+    def _ciclo(self):
+        """Despachar as entregas vencidas para os workers, respeitando os limites por destino"""
+        while True:
+            with self._condicao:
+                if self._fechado:
+                    return
+            try:
+                espera = self._despachar()
+            except Exception as e:
+                logger.error(f"Erro no motor de webhooks: {e}")
+                espera = 1
+            with self._condicao:
+                if not self._fechado:
+                    self._condicao.wait(espera)
+
+    def _despachar(self):
+        """Reclamar e submeter o que puder ser enviado agora; retorna quanto esperar até à próxima"""
+        conn = self._conn()
+        agora = time.time()
+
+        for (destino,) in conn.execute(
+            'SELECT DISTINCT destino FROM entregas WHERE estado = ? AND proxima <= ?', (PENDENTE, agora)
+        ).fetchall():
+            with self._condicao:
+                livres = min(
+                    self.por_destino - self._em_curso.get(destino, 0),
+                    self.workers - sum(self._em_curso.values())
+                )
+            if livres <= 0:
+                continue
+
+            for entrega in conn.execute(
+                'SELECT id, url, corpo, tentativas FROM entregas '
+                'WHERE estado = ? AND destino = ? AND proxima <= ? ORDER BY proxima LIMIT ?',
+                (PENDENTE, destino, agora, livres)
+            ).fetchall():
+                # Reclamar (outro processo pode ter pegado nesta entrega entretanto)
+                with conn:
+                    reclamada = conn.execute(
+                        'UPDATE entregas SET proxima = ? WHERE id = ? AND estado = ? AND proxima <= ?',
+                        (agora + self.prazo_reclamacao, entrega[0], PENDENTE, agora)
+                    ).rowcount
+                if not reclamada:
+                    continue
+                with self._condicao:
+                    self._em_curso[destino] = self._em_curso.get(destino, 0) + 1
+                self._executor.submit(self._entregar, destino, *entrega)
+
+        proxima = conn.execute(
+            'SELECT MIN(proxima) FROM entregas WHERE estado = ?', (PENDENTE,)
+        ).fetchone()[0]
+        return max(0.01, min(proxima - time.time(), 5)) if proxima is not None else 5
+
+    def _entregar(self, destino, entrega_id, url, corpo, tentativas):
+        """Um pedido HTTP; sucesso apaga a entrega, falha reagenda-a (ou marca-a como falhada)"""
+        inicio = time.perf_counter()
+        espera_minima = 0
+        try:
+            resposta = self.sessao.post(
+                url, data=corpo.encode('utf-8'), headers={'Content-Type': 'application/json'}, timeout=self.timeout
+            )
+            erro = None if resposta.ok else f"HTTP {resposta.status_code}"
+            definitivo = 400 <= resposta.status_code < 500 and resposta.status_code not in REPETIR_4XX
+            espera_minima = _retry_after(resposta)
+        except requests.RequestException as e:
+            erro, definitivo = str(e), False
+
+        latencia = time.perf_counter() - inicio
+        try:
+            if erro is None:
+                self._concluir(entrega_id)
+            else:
+                self._reagendar(entrega_id, url, tentativas + 1, erro, definitivo, espera_minima)
+        finally:
+            with self._condicao:
+                self._em_curso[destino] -= 1
+                if not self._em_curso[destino]:
+                    del self._em_curso[destino]
+                if erro is None:
+                    self._totais['entregues'] += 1
+                    self._latencias = self._latencias[-999:] + [latencia]
+                self._condicao.notify()
+
+    def _concluir(self, entrega_id):
+        with self._conn() as conn:
+            conn.execute('DELETE FROM entregas WHERE id = ?', (entrega_id,))
+        logger.debug(f"🌐 Webhook {entrega_id} entregue")
+
+    def _reagendar(self, entrega_id, url, tentativas, erro, definitivo, espera_minima):
+        if definitivo or tentativas >= self.max_tentativas:
+            with self._conn() as conn:
+                conn.execute(
+                    'UPDATE entregas SET estado = ?, tentativas = ?, erro = ? WHERE id = ?',
+                    (FALHADA, tentativas, erro, entrega_id)
+                )
+            with self._condicao:
+                self._totais['falhadas'] += 1
+            logger.error(f"Webhook para {url} falhou após {tentativas} tentativa(s): {erro}")
+            return
+
+        # Espera exponencial com jitter total, para os destinos não receberem as repetições todas juntas
+        espera = max(random.uniform(0, min(ESPERA_MAX, ESPERA_BASE * 2 ** tentativas)), espera_minima)
+        with self._conn() as conn:
+            conn.execute(
+                'UPDATE entregas SET tentativas = ?, proxima = ?, erro = ? WHERE id = ?',
+                (tentativas, time.time() + espera, erro, entrega_id)
+            )
+        with self._condicao:
+            self._totais['repetidas'] += 1
+        logger.warning(f"Webhook para {url} falhou ({erro}), nova tentativa em {espera:.1f} s")
+
+
+def _destino(url):
+    """Host (e porta) do URL: os limites de concorrência são por destino"""
+    partes = urlsplit(url)
+    return f"{partes.scheme}://{partes.netloc}"
+
+
+def _retry_after(resposta):
+    """Segundos pedidos pelo destino no cabeçalho Retry-After (0 se ausente ou em formato de data)"""
+    try:
+        return min(float(resposta.headers.get('Retry-After', 0)), ESPERA_MAX)
+    except ValueError:
+        return 0